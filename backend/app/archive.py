@@ -0,0 +1,300 @@
+"""Archival of closed terms' attendance records to compressed columnar files.
+
+``archive_term`` copies every record of a finished term into
+``ARCHIVE_DIR/attendance-term-<id>.npz`` and deletes those records from
+attendance_records in the transaction that registers the file. The counters and
+daily rollups stay in the database, so stats and trends do not change, while
+the hot table and its indexes only keep growing with the open terms.
+
+The file holds the records sorted by (user_id, timestamp) in chunks of
+ARCHIVE_CHUNK_SIZE: one compressed numpy member per column and chunk (string
+columns dictionary-encoded per chunk), plus a small index of each chunk's user
+and time range. Writing, reading and deleting all go one chunk at a time, so
+no step holds a whole term in memory.
+
+Readers that need raw records (the export, the defaulter bitmaps) ask
+``archives_overlapping`` which files a time range reaches into and iterate
+``load(entry).batches(...)``, which only decompresses the chunks that can
+match; files never change once written, so their indexes are cached.
+"""
+from collections import Counter
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+import logging
+import os
+import zipfile
+
+import numpy as np
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.orm import Session
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "./archive")
+# Days after a term ends before it may be archived, leaving room for late appeals
+ARCHIVE_GRACE_DAYS = int(os.getenv("ARCHIVE_GRACE_DAYS", "30"))
+# Records per chunk: the most a reader or the archiver decompresses at once
+ARCHIVE_CHUNK_SIZE = int(os.getenv("ARCHIVE_CHUNK_SIZE", "100000"))
+ARCHIVE_BATCH_SIZE = 10000
+FORMAT_VERSION = 2
+
+TIME_COLUMNS = ("timestamp", "created_at", "updated_at")
+STRING_COLUMNS = ("type", "method", "status", "session_id", "location", "capture_image_url")
+COLUMNS = ("id", "user_id", "confidence_score") + TIME_COLUMNS + STRING_COLUMNS
+
+
+def _member(name: str, chunk: int) -> str:
+    return f"{name}.{chunk}"
+
+
+class ArchivedRecords:
+    """Index of one archive file; the records are read chunk by chunk"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with np.load(path, allow_pickle=False) as f:
+            version = int(f["format"])
+            if version != FORMAT_VERSION:
+                raise ValueError(f"Archive {path} has format {version}, expected {FORMAT_VERSION}")
+            self.chunk_rows = f["chunk_rows"]
+            self.first_user, self.last_user = f["chunk_first_user"], f["chunk_last_user"]
+            self.first_time, self.last_time = f["chunk_first_time"], f["chunk_last_time"]
+
+    def __len__(self):
+        return int(self.chunk_rows.sum())
+
+    def _chunks(self, user_ids: Optional[np.ndarray], start: Optional[datetime], end: Optional[datetime]) -> np.ndarray:
+        mask = self.chunk_rows > 0
+        if user_ids is not None:
+            if not len(user_ids):
+                return np.flatnonzero(np.zeros_like(mask))
+            mask &= (self.first_user <= user_ids.max()) & (self.last_user >= user_ids.min())
+        if start is not None:
+            mask &= self.last_time >= np.datetime64(start, "us")
+        if end is not None:
+            mask &= self.first_time < np.datetime64(end, "us")
+        return np.flatnonzero(mask)
+
+    @staticmethod
+    def _column(f, name: str, chunk: int, rows: np.ndarray) -> List:
+        """Python values of one column for ``rows`` of a chunk (None where the database had NULL)"""
+        values = f[_member(name, chunk)][rows]
+        if name in STRING_COLUMNS:
+            strings = f[_member(name + "__values", chunk)].tolist() + [None]
+            return [strings[c] for c in values.tolist()]  # code -1 picks the trailing None
+        if name == "confidence_score":
+            return [None if v != v else v for v in values.tolist()]
+        return values.tolist()  # datetime64[us] converts to datetime
+
+    def batches(self, columns: Sequence[str], user_ids: Optional[Sequence[int]] = None, start: Optional[datetime] = None,
+                end: Optional[datetime] = None, newest_first: bool = False,
+                size: int = ARCHIVE_BATCH_SIZE) -> Iterator[List[Tuple]]:
+        """Rows of ``columns`` for ``user_ids`` with ``start <= timestamp < end``,
+        by (user_id, timestamp) or the reverse. Blocking.
+        """
+        wanted = None if user_ids is None else np.asarray(list(user_ids), dtype=np.int64)
+        chunks = self._chunks(wanted, start, end)
+        with np.load(self.path, allow_pickle=False) as f:
+            for chunk in (chunks[::-1] if newest_first else chunks):
+                mask = np.ones(int(self.chunk_rows[chunk]), dtype=bool)
+                if wanted is not None:
+                    mask &= np.isin(f[_member("user_id", chunk)], wanted)
+                if start is not None or end is not None:
+                    timestamps = f[_member("timestamp", chunk)]
+                    if start is not None:
+                        mask &= timestamps >= np.datetime64(start, "us")
+                    if end is not None:
+                        mask &= timestamps < np.datetime64(end, "us")
+                rows = np.flatnonzero(mask)
+                if newest_first:
+                    rows = rows[::-1]
+                for i in range(0, len(rows), size):
+                    part = rows[i:i + size]
+                    yield list(zip(*(self._column(f, name, chunk, part) for name in columns)))
+
+    def status_counts(self) -> Counter:
+        """(user_id, status) -> record count"""
+        counts: Counter = Counter()
+        with np.load(self.path, allow_pickle=False) as f:
+            for chunk in np.flatnonzero(self.chunk_rows > 0):
+                statuses = f[_member("status__values", chunk)]
+                pairs, totals = np.unique(np.stack([f[_member("user_id", chunk)], f[_member("status", chunk)]]),
+                                          axis=1, return_counts=True)
+                for (user_id, code), total in zip(pairs.T.tolist(), totals.tolist()):
+                    counts[(user_id, str(statuses[code]))] += total
+        return counts
+
+
+def _encode_strings(values: List[Optional[str]]) -> Tuple[np.ndarray, np.ndarray]:
+    distinct = sorted({v for v in values if v is not None})
+    index = {v: i for i, v in enumerate(distinct)}
+    codes = np.array([index[v] if v is not None else -1 for v in values], dtype=np.int32)
+    return codes, np.array(distinct, dtype=str)
+
+
+def _chunk_arrays(rows: Sequence[Tuple]) -> Dict[str, np.ndarray]:
+    columns = dict(zip(COLUMNS, zip(*rows)))
+    arrays: Dict[str, np.ndarray] = {
+        "id": np.array(columns["id"], dtype=np.int64),
+        "user_id": np.array(columns["user_id"], dtype=np.int64),
+        "confidence_score": np.array([np.nan if v is None else v for v in columns["confidence_score"]], dtype=np.float64),
+    }
+    for name in TIME_COLUMNS:
+        arrays[name] = np.array(columns[name], dtype="datetime64[us]")
+    for name in STRING_COLUMNS:
+        arrays[name], arrays[name + "__values"] = _encode_strings(columns[name])
+    return arrays
+
+
+def _write_array(zf: zipfile.ZipFile, name: str, array: np.ndarray) -> None:
+    # The same member layout as np.savez_compressed, written one array at a time
+    with zf.open(name + ".npy", "w", force_zip64=True) as f:
+        np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+
+
+def _path(relative: str) -> str:
+    return os.path.join(ARCHIVE_DIR, relative)
+
+
+@lru_cache(maxsize=64)
+def _load(path: str) -> ArchivedRecords:
+    return ArchivedRecords(path)
+
+
+def load(entry: models.AttendanceArchive) -> ArchivedRecords:
+    return _load(_path(entry.path))
+
+
+def term_bounds(term: models.AcademicTerm) -> Tuple[datetime, datetime]:
+    return datetime.combine(term.start_date, time.min), datetime.combine(term.end_date + timedelta(days=1), time.min)
+
+
+def archives_overlapping(db: Session, start: Optional[datetime] = None, end: Optional[datetime] = None) -> List[models.AttendanceArchive]:
+    """Archives holding records with ``start <= timestamp < end``, oldest first"""
+    a = models.AttendanceArchive
+    q = select(a).where(a.records > 0)
+    if start is not None:
+        q = q.where(a.end > start)
+    if end is not None:
+        q = q.where(a.start < end)
+    return list(db.execute(q.order_by(a.start)).scalars())
+
+
+def archivable_terms(db: Session, today: Optional[date] = None, grace_days: int = ARCHIVE_GRACE_DAYS) -> List[models.AcademicTerm]:
+    """Terms that ended more than ``grace_days`` ago and are not archived yet"""
+    today = today or datetime.utcnow().date()
+    t, a = models.AcademicTerm, models.AttendanceArchive
+    return list(db.execute(
+        select(t).where(t.end_date < today - timedelta(days=grace_days), t.id.notin_(select(a.term_id))).order_by(t.start_date)
+    ).scalars())
+
+
+def _check_archivable(db: Session, term: models.AcademicTerm, today: date, grace_days: int) -> None:
+    t, ar, ap = models.AcademicTerm, models.AttendanceRecord, models.Appeal
+    if db.get(models.AttendanceArchive, term.id) is not None:
+        raise ValueError(f"Term {term.name} is already archived")
+    cutoff = today - timedelta(days=grace_days)
+    if term.end_date >= cutoff:
+        raise ValueError(f"Term {term.name} ends {term.end_date}; it can be archived after {term.end_date + timedelta(days=grace_days)}")
+    # Records are moved by time range, so a still-open overlapping term would lose some of its own
+    open_overlap = db.execute(
+        select(t.name).where(t.id != term.id, t.start_date <= term.end_date, t.end_date >= term.start_date, t.end_date >= cutoff)
+    ).scalars().first()
+    if open_overlap:
+        raise ValueError(f"Term {term.name} overlaps {open_overlap}, which is not closed yet")
+    start, end = term_bounds(term)
+    pending = db.execute(
+        select(func.count()).select_from(ap).join(ar, ar.id == ap.attendance_id)
+        .where(ap.status == "pending", ar.timestamp >= start, ar.timestamp < end)
+    ).scalar_one()
+    if pending:
+        raise ValueError(f"Term {term.name} has {pending} pending appeals; resolve them first")
+
+
+def archive_term(db: Session, term: models.AcademicTerm, today: Optional[date] = None,
+                 grace_days: int = ARCHIVE_GRACE_DAYS) -> models.AttendanceArchive:
+    """Write the term's records to an archive file and delete them from attendance_records.
+
+    Raises ValueError if the term cannot be archived yet. The caller commits;
+    until then the records are still in the table and the file is unreferenced.
+    """
+    today = today or datetime.utcnow().date()
+    _check_archivable(db, term, today, grace_days)
+    ar = models.AttendanceRecord
+    start, end = term_bounds(term)
+    result = db.execute(
+        select(*(getattr(ar, name) for name in COLUMNS))
+        .where(ar.timestamp >= start, ar.timestamp < end)
+        .order_by(ar.user_id, ar.timestamp, ar.id)
+        .execution_options(yield_per=ARCHIVE_CHUNK_SIZE)
+    )
+
+    relative = f"attendance-term-{term.id}.npz"
+    path = _path(relative)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    tmp = path + ".tmp"
+    index: Dict[str, list] = {"chunk_rows": [], "chunk_first_user": [], "chunk_last_user": [],
+                              "chunk_first_time": [], "chunk_last_time": []}
+    with open(tmp, "wb") as raw:
+        with zipfile.ZipFile(raw, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+            for chunk, rows in enumerate(result.partitions(ARCHIVE_CHUNK_SIZE)):
+                arrays = _chunk_arrays(rows)
+                for name, array in arrays.items():
+                    _write_array(zf, _member(name, chunk), array)
+                index["chunk_rows"].append(len(rows))
+                index["chunk_first_user"].append(arrays["user_id"][0])
+                index["chunk_last_user"].append(arrays["user_id"][-1])
+                index["chunk_first_time"].append(arrays["timestamp"].min())
+                index["chunk_last_time"].append(arrays["timestamp"].max())
+            _write_array(zf, "format", np.array(FORMAT_VERSION))
+            for name, values in index.items():
+                _write_array(zf, name, np.array(values, dtype="datetime64[us]" if name.endswith("_time") else np.int64))
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp, path)
+    _load.cache_clear()
+    records = _load(path)
+    total = len(records)
+
+    # The ids come back from the file, so exactly the records it holds are deleted
+    for batch in records.batches(("id",)):
+        ids = [row[0] for row in batch]
+        # Resolved appeals keep their decision; the record they pointed at now lives in the file
+        db.execute(update(models.Appeal).where(models.Appeal.attendance_id.in_(ids)).values(attendance_id=None))
+        db.execute(delete(ar).where(ar.id.in_(ids)))
+    entry = models.AttendanceArchive(term_id=term.id, path=relative, start=start, end=end, records=total)
+    db.add(entry)
+    logger.info(f"Archived {total} attendance records of term {term.name} to {path} ({os.path.getsize(path)} bytes)")
+    return entry
+
+
+EXPORT_COLUMNS = ("timestamp", "type", "method", "confidence_score", "status", "location")
+
+
+def export_batches(entry: models.AttendanceArchive, user_id: Optional[int], start: Optional[datetime],
+                   end: Optional[datetime]) -> Iterator[List[Tuple]]:
+    """Archived (user_id, *EXPORT_COLUMNS) rows: newest first for one user, otherwise by (user, timestamp).
+
+    Blocking; iterate from a worker thread. Names and class membership are
+    resolved by the caller, one batch at a time.
+    """
+    if user_id is not None:
+        return load(entry).batches(("user_id",) + EXPORT_COLUMNS, [user_id], start, end, newest_first=True)
+    return load(entry).batches(("user_id",) + EXPORT_COLUMNS, None, start, end)
+
+
+def archived_counts(db: Session) -> Counter:
+    """(user_id, status) -> record count over every archive, for rebuilding the counters"""
+    counts: Counter = Counter()
+    for entry in archives_overlapping(db):
+        counts.update(load(entry).status_counts())
+    return counts
+
+
+def archived_days(db: Session) -> List[Tuple[date, date]]:
+    """(first, last) day of every archived range; their daily rollups can no longer be rebuilt"""
+    a = models.AttendanceArchive
+    return [(start.date(), (end - timedelta(days=1)).date()) for start, end in db.execute(select(a.start, a.end).order_by(a.start))]
@@ -0,0 +1,145 @@
+"""Audit trail written to the ``logs`` table off the request path.
+
+Handlers call ``await audit.record(action, user_id, **details)``, which only
+puts the event on a bounded in-memory queue. A background task started by the
+application lifespan drains the queue and writes it with one multi-row INSERT
+per batch -- when AUDIT_BATCH_SIZE events are waiting or AUDIT_FLUSH_INTERVAL_SEC
+after the first one arrived, whichever comes first.
+
+When the database falls behind and the queue fills up, ``record`` waits up to
+AUDIT_ENQUEUE_TIMEOUT_SEC for room (backpressure) and then drops the event;
+drops are counted in ``edutrack_audit_events_total{outcome="dropped"}``.
+Shutdown writes whatever is still queued.
+"""
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+import asyncio
+import json
+import logging
+import os
+import time
+
+from sqlalchemy import insert
+
+from . import database, metrics, models
+
+logger = logging.getLogger(__name__)
+
+AUDIT_ENABLED = os.getenv("AUDIT_ENABLED", "true").lower() == "true"
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "500"))
+AUDIT_FLUSH_INTERVAL_SEC = float(os.getenv("AUDIT_FLUSH_INTERVAL_SEC", "1"))
+AUDIT_ENQUEUE_TIMEOUT_SEC = float(os.getenv("AUDIT_ENQUEUE_TIMEOUT_SEC", "0.05"))
+
+# Put on the queue by stop(): everything before it is written, then the writer exits
+_STOP = object()
+
+
+class AuditWriter:
+    def __init__(self, maxsize: int = AUDIT_QUEUE_SIZE, batch_size: int = AUDIT_BATCH_SIZE,
+                 interval: float = AUDIT_FLUSH_INTERVAL_SEC, enqueue_timeout: float = AUDIT_ENQUEUE_TIMEOUT_SEC):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.interval = interval
+        self.enqueue_timeout = enqueue_timeout
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._dropped = 0
+        self._warned_at = 0.0
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def record(self, action: str, user_id: Optional[int] = None, **details: Any) -> bool:
+        """Queue one event; returns False if it was dropped"""
+        if not AUDIT_ENABLED:
+            return False
+        if self._task is None:
+            # No writer running (CLI, scripts): nothing would ever drain the queue
+            metrics.audit_events.inc(outcome="dropped")
+            return False
+        row = {
+            "user_id": user_id,
+            "action": action,
+            "details": json.dumps(details, default=str, separators=(",", ":")) if details else None,
+            "created_at": datetime.utcnow(),
+        }
+        try:
+            self._queue.put_nowait(row)
+            return True
+        except asyncio.QueueFull:
+            pass
+        try:
+            await asyncio.wait_for(self._queue.put(row), timeout=self.enqueue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            metrics.audit_events.inc(outcome="dropped")
+            self._dropped += 1
+            # One warning per 10 seconds rather than one per dropped event
+            if time.monotonic() - self._warned_at >= 10:
+                logger.warning(f"Audit queue full ({self.maxsize}), dropped {self._dropped} events")
+                self._warned_at, self._dropped = time.monotonic(), 0
+            return False
+
+    async def _next_batch(self) -> List[Any]:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size and batch[-1] is not _STOP:
+            if self._queue.empty():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _write(self, batch: List[Dict[str, Any]]) -> None:
+        start = time.perf_counter()
+        try:
+            async with database.async_engine.begin() as conn:
+                await conn.execute(insert(models.Log), batch)
+        except Exception:
+            # Losing audit rows is preferable to wedging the writer on a bad batch
+            metrics.audit_events.inc(len(batch), outcome="failed")
+            logger.exception(f"Could not write {len(batch)} audit events")
+            return
+        metrics.audit_events.inc(len(batch), outcome="written")
+        metrics.audit_flush_seconds.observe(time.perf_counter() - start)
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._next_batch()
+            stopping = batch[-1] is _STOP
+            if stopping:
+                batch.pop()
+            if batch:
+                await self._write(batch)
+            if stopping:
+                return
+
+    async def start(self) -> None:
+        if not AUDIT_ENABLED or self._task is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._task = asyncio.create_task(self._run(), name="audit-writer")
+
+    async def stop(self) -> None:
+        """Write everything still queued, then stop the writer"""
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        await self._queue.put(_STOP)
+        await task
+
+
+writer = AuditWriter()
+audit_queue_depth = metrics.Gauge("edutrack_audit_queue_depth", "Audit events waiting to be written", fn=lambda: writer.pending)
+
+
+async def record(action: str, user_id: Optional[int] = None, **details: Any) -> bool:
+    return await writer.record(action, user_id, **details)
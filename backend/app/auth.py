@@ -1,11 +1,18 @@
+from collections import OrderedDict
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from typing import Dict, Optional, Set, Tuple
 import os
+import threading
+import time
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from . import models, database
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, object_session
+from . import models, database, pubsub
+from .passwords import pwd_context
 
 # Secret key and algorithm for JWT - use environment variables for better security
 SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key-change-in-production")
@@ -14,10 +21,12 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
 REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "7"))
 RESET_TOKEN_EXPIRE_MINUTES = int(os.getenv("RESET_TOKEN_EXPIRE_MINUTES", "10"))
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL_SEC = int(os.getenv("AUTH_CACHE_TTL_SEC", "300"))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/login")
 
+# Blocking variants for scripts and jobs; request handlers use the *_async helpers
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
@@ -54,7 +63,213 @@ def create_tokens(user_data: dict):
         "token_type": "bearer"
     }
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
+@dataclass(frozen=True)
+class Principal:
+    """Lightweight stand-in for the authenticated models.User, safe to cache across requests"""
+    id: int
+    public_id: str
+    name: str
+    email: str
+    role: str
+    class_code: Optional[str]
+    is_active: bool
+
+class _PrincipalCache:
+    """Bounded LRU of decoded access tokens -> Principal, plus public_id -> Principal.
+
+    Token entries expire with the token's ``exp`` claim or after
+    AUTH_CACHE_TTL_SEC, whichever comes first; principals after
+    AUTH_CACHE_TTL_SEC. Both are dropped per user with invalidate_user, which
+    runs when a change to a user's role, password or is_active commits (bulk
+    update()/delete() clear everything) and, through a pubsub signal, in the
+    other workers too.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[Principal, float]]" = OrderedDict()
+        self._tokens_by_user: Dict[str, Set[str]] = {}
+        # public_id -> Principal, so a new token of a known user skips the database
+        self._principals: "OrderedDict[str, Tuple[Principal, float]]" = OrderedDict()
+
+    def get(self, token: str) -> Optional[Principal]:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                self._drop(token)
+                return None
+            self._entries.move_to_end(token)
+            return entry[0]
+
+    def put(self, token: str, principal: Principal, exp: float) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._drop(token)
+            self._entries[token] = (principal, min(exp, time.time() + self.ttl))
+            self._tokens_by_user.setdefault(principal.public_id, set()).add(token)
+            while len(self._entries) > self.maxsize:
+                self._drop(next(iter(self._entries)))
+
+    def get_principal(self, public_id: str) -> Optional[Principal]:
+        with self._lock:
+            entry = self._principals.get(public_id)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._principals[public_id]
+                return None
+            self._principals.move_to_end(public_id)
+            return entry[0]
+
+    def put_principal(self, principal: Principal) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._principals[principal.public_id] = (principal, time.time() + self.ttl)
+            self._principals.move_to_end(principal.public_id)
+            while len(self._principals) > self.maxsize:
+                self._principals.popitem(last=False)
+
+    def invalidate_user(self, public_id: str) -> None:
+        with self._lock:
+            for token in list(self._tokens_by_user.get(public_id, ())):
+                self._drop(token)
+            self._principals.pop(public_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_user.clear()
+            self._principals.clear()
+
+    def _drop(self, token: str) -> None:
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return
+        tokens = self._tokens_by_user.get(entry[0].public_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[entry[0].public_id]
+
+principal_cache = _PrincipalCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL_SEC)
+
+def invalidate_user(public_id: str) -> None:
+    """Forget cached principals of a user; ORM changes to User do this on commit"""
+    principal_cache.invalidate_user(public_id)
+
+# Users whose cached principals go stale once the session commits; _ALL for a bulk change
+PENDING_INVALIDATIONS = "auth_invalidations"
+INVALIDATE_SIGNAL = "auth.invalidate"
+_ALL = "*"
+_CREDENTIAL_FIELDS = {"role", "password", "is_active"}
+
+def _pending(session: Session) -> Set[str]:
+    return session.info.setdefault(PENDING_INVALIDATIONS, set())
+
+def _on_credentials_change(target, value, oldvalue, initiator):
+    # Evicting here would let a request reload the old row before the change commits
+    session = object_session(target)
+    if session is not None and target.public_id and value != oldvalue:
+        _pending(session).add(target.public_id)
+
+for _attr in (models.User.role, models.User.password, models.User.is_active):
+    event.listen(_attr, "set", _on_credentials_change)
+
+def _bulk_fields(orm_execute_state) -> Set[str]:
+    keys = {getattr(k, "key", k) for k in (getattr(orm_execute_state.statement, "_values", None) or {})}
+    params = orm_execute_state.parameters
+    for row in ([params] if isinstance(params, dict) else params or ()):
+        keys.update(row)
+    return keys
+
+@event.listens_for(Session, "do_orm_execute")
+def _on_bulk_change(orm_execute_state) -> None:
+    # update()/delete() bypass attribute events and may match any number of users
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    if not any(m.class_ is models.User for m in orm_execute_state.all_mappers):
+        return
+    if orm_execute_state.is_delete or _bulk_fields(orm_execute_state) & _CREDENTIAL_FIELDS:
+        _pending(orm_execute_state.session).add(_ALL)
+
+@event.listens_for(Session, "after_flush")
+def _on_users_deleted(session: Session, flush_context) -> None:
+    for obj in session.deleted:
+        if isinstance(obj, models.User) and obj.public_id:
+            _pending(session).add(obj.public_id)
+
+def _evict(public_ids) -> None:
+    if _ALL in public_ids:
+        principal_cache.clear()
+    else:
+        for public_id in public_ids:
+            invalidate_user(public_id)
+
+@event.listens_for(Session, "after_commit")
+def _evict_committed(session: Session) -> None:
+    if session.in_nested_transaction():
+        return  # a released SAVEPOINT also fires after_commit; wait for the real commit
+    public_ids = session.info.pop(PENDING_INVALIDATIONS, None)
+    if not public_ids:
+        return
+    _evict(public_ids)
+    # Other workers hold their own caches
+    pubsub.hub.signal_threadsafe(INVALIDATE_SIGNAL, {"public_ids": sorted(public_ids)})
+
+@event.listens_for(Session, "after_rollback")
+def _discard_rolled_back(session: Session) -> None:
+    # A rolled back SAVEPOINT keeps the outer transaction's changes pending; evicting too much is harmless
+    if not session.in_nested_transaction():
+        session.info.pop(PENDING_INVALIDATIONS, None)
+
+def _on_invalidate(data) -> None:
+    _evict(set(data.get("public_ids") or ()))
+
+pubsub.hub.on_signal(INVALIDATE_SIGNAL, _on_invalidate)
+
+async def load_principal(db: AsyncSession, public_id: str) -> Optional[Principal]:
+    u = models.User
+    row = (await db.execute(
+        select(u.id, u.public_id, u.name, u.email, u.role, u.class_code, u.is_active).where(u.public_id == public_id)
+    )).first()
+    return Principal(*row) if row else None
+
+async def preload_principals(db: AsyncSession, limit: int) -> int:
+    """Warm the principal cache with the most recently updated active users"""
+    u = models.User
+    rows = (await db.execute(
+        select(u.id, u.public_id, u.name, u.email, u.role, u.class_code, u.is_active)
+        .where(u.is_active == True).order_by(u.updated_at.desc()).limit(limit)
+    )).all()
+    for row in rows:
+        principal_cache.put_principal(Principal(*row))
+    return len(rows)
+
+def token_subject(token: str) -> Optional[str]:
+    """public_id of a valid access token, without touching the database"""
+    principal = principal_cache.get(token)
+    if principal is not None:
+        return principal.public_id
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    return payload.get("sub") if payload.get("type") == "access" else None
+
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> Principal:
+    return await authenticate(token)
+
+async def authenticate(token: str) -> Principal:
+    """Principal for an access token, raising 401; for callers that get the token outside the Authorization header"""
+    principal = principal_cache.get(token)
+    if principal is not None:
+        return principal
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -70,13 +285,21 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     except JWTError:
         raise credentials_exception
         
-    user = db.query(models.User).filter(models.User.public_id == public_id).first()
-    if user is None:
+    # Only a cache miss touches the database
+    principal = principal_cache.get_principal(public_id)
+    if principal is None:
+        async with database.AsyncSessionLocal() as db:
+            principal = await load_principal(db, public_id)
+        if principal is not None:
+            principal_cache.put_principal(principal)
+    if principal is None or not principal.is_active:
         raise credentials_exception
-    return user
+    principal_cache.put(token, principal, float(payload.get("exp", 0)))
+    return principal
 
 def require_roles(*roles):
-    def dependency(current_user: models.User = Depends(get_current_user)):
+    # Works on the cached Principal, so a cache hit needs no database access
+    async def dependency(current_user: Principal = Depends(get_current_user)):
         if roles and (current_user.role not in roles):
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Insufficient permissions")
         return current_user
@@ -86,7 +309,7 @@ require_admin = require_roles("admin")
 require_teacher = require_roles("teacher", "admin")
 require_student = require_roles("student", "admin")
 
-def refresh_access_token(refresh_token: str, db: Session = Depends(database.get_db)):
+async def refresh_access_token(refresh_token: str, db: AsyncSession = Depends(database.get_db)):
     """Create a new access token using a valid refresh token"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -103,7 +326,7 @@ def refresh_access_token(refresh_token: str, db: Session = Depends(database.get_
     except JWTError:
         raise credentials_exception
         
-    user = db.query(models.User).filter(models.User.public_id == public_id).first()
+    user = (await db.execute(select(models.User.id).where(models.User.public_id == public_id))).first()
     if user is None:
         raise credentials_exception
         
@@ -117,27 +340,26 @@ def refresh_access_token(refresh_token: str, db: Session = Depends(database.get_
 
 # Password reset helpers using OTP tokens stored in DB
 
-def create_password_reset(user: models.User, db: Session) -> models.PasswordReset:
+async def create_password_reset(user: models.User, db: AsyncSession) -> models.PasswordReset:
     from secrets import token_urlsafe
     token = token_urlsafe(16)
     expires_at = datetime.utcnow() + timedelta(minutes=RESET_TOKEN_EXPIRE_MINUTES)
     pr = models.PasswordReset(user_id=user.id, token=token, expires_at=expires_at, used=False)
     db.add(pr)
-    db.commit()
-    db.refresh(pr)
+    await db.commit()
     return pr
 
-def verify_password_reset(token: str, db: Session) -> models.User:
-    pr = db.query(models.PasswordReset).filter(models.PasswordReset.token == token, models.PasswordReset.used == False).first()
+async def verify_password_reset(token: str, db: AsyncSession) -> models.User:
+    pr = (await db.execute(select(models.PasswordReset).where(models.PasswordReset.token == token, models.PasswordReset.used == False))).scalar_one_or_none()
     if not pr or pr.expires_at < datetime.utcnow():
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid or expired reset token")
-    user = db.query(models.User).filter(models.User.id == pr.user_id).first()
+    user = await db.get(models.User, pr.user_id)
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     return user
 
-def mark_password_reset_used(token: str, db: Session) -> None:
-    pr = db.query(models.PasswordReset).filter(models.PasswordReset.token == token).first()
+async def mark_password_reset_used(token: str, db: AsyncSession) -> None:
+    pr = (await db.execute(select(models.PasswordReset).where(models.PasswordReset.token == token))).scalar_one_or_none()
     if pr:
         pr.used = True
-        db.commit()
\ No newline at end of file
+        await db.commit()
\ No newline at end of file
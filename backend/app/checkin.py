@@ -0,0 +1,203 @@
+"""QR check-in: rotating signed session codes, scan dedupe and batched writes.
+
+The code a teacher projects is self-describing -- session id, type, optional
+class, session start and the current rotation window -- and signed with an HMAC
+key derived from the JWT secret, so a scan is validated without touching the
+database. Codes rotate every QR_ROTATION_SEC and are accepted for one extra
+window to cover clock skew and slow scanners; a photo of the code is useless a
+few seconds later.
+
+Each worker remembers which (user, session) pairs it already recorded, so
+repeated scans are answered from memory. New check-ins wait at most
+QR_BATCH_WINDOW_MS and are written together, one ``marking.record_marks`` batch
+per session, so a class scanning at once costs a handful of INSERTs. The unique
+(user, session) index still rejects a duplicate that reached another worker.
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+
+from . import auth, database, marking, metrics
+
+logger = logging.getLogger(__name__)
+
+QR_ROTATION_SEC = int(os.getenv("QR_ROTATION_SEC", "15"))
+QR_LATE_AFTER_MIN = int(os.getenv("QR_LATE_AFTER_MIN", "10"))
+QR_DEDUPE_SIZE = int(os.getenv("QR_DEDUPE_SIZE", "100000"))
+QR_DEDUPE_TTL_SEC = int(os.getenv("QR_DEDUPE_TTL_SEC", "43200"))
+QR_BATCH_WINDOW_MS = int(os.getenv("QR_BATCH_WINDOW_MS", "50"))
+QR_BATCH_SIZE = int(os.getenv("QR_BATCH_SIZE", "500"))
+
+# Separate key so a QR signature can never be replayed as (or forged from) a JWT
+_KEY = hmac.new(auth.SECRET_KEY.encode(), b"edutrack-qr-checkin", hashlib.sha256).digest()
+
+
+def _b64(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _unb64(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _sign(payload: bytes) -> bytes:
+    return hmac.new(_KEY, payload, hashlib.sha256).digest()[:16]
+
+
+def issue_code(session_id: str, type: str = "lecture", class_code: Optional[str] = None,
+               started_at: Optional[datetime] = None, now: Optional[float] = None) -> Dict[str, Any]:
+    """Code for the current rotation window plus when the display should fetch the next one"""
+    now = time.time() if now is None else now
+    window = int(now // QR_ROTATION_SEC)
+    started_at = started_at or datetime.utcnow()
+    if started_at.tzinfo is not None:
+        started_at = started_at.astimezone(timezone.utc).replace(tzinfo=None)
+    # Naive datetimes are UTC throughout the app
+    started = int(started_at.replace(tzinfo=timezone.utc).timestamp())
+    claims = {"s": session_id, "t": type, "c": class_code, "st": started, "w": window}
+    payload = json.dumps(claims, separators=(",", ":")).encode()
+    return {
+        "code": f"{_b64(payload)}.{_b64(_sign(payload))}",
+        "session_id": session_id,
+        "started_at": started_at.isoformat(),
+        "refresh_in": round((window + 1) * QR_ROTATION_SEC - now, 3),
+    }
+
+
+def verify_code(code: str, now: Optional[float] = None) -> Dict[str, Any]:
+    """Claims of a valid, current code; raises ValueError otherwise"""
+    now = time.time() if now is None else now
+    try:
+        payload_part, signature_part = code.split(".", 1)
+        payload, signature = _unb64(payload_part), _unb64(signature_part)
+    except ValueError:
+        raise ValueError("Malformed code")
+    if not hmac.compare_digest(signature, _sign(payload)):
+        raise ValueError("Invalid code")
+    claims = json.loads(payload)
+    if int(now // QR_ROTATION_SEC) - claims["w"] not in (0, 1):
+        raise ValueError("Code expired")
+    return claims
+
+
+def status_for(claims: Dict[str, Any], scanned_at: datetime) -> str:
+    late_from = datetime.fromtimestamp(claims["st"], timezone.utc).replace(tzinfo=None) + timedelta(minutes=QR_LATE_AFTER_MIN)
+    return "late" if scanned_at > late_from else "present"
+
+
+class DedupeCache:
+    """Bounded LRU of (user_id, session_id) pairs already recorded, with a TTL"""
+
+    def __init__(self, maxsize: int = QR_DEDUPE_SIZE, ttl: float = QR_DEDUPE_TTL_SEC):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[int, str], float]" = OrderedDict()
+
+    def add(self, key: Tuple[int, str]) -> bool:
+        """Claim ``key``; False if it was already claimed"""
+        now = time.monotonic()
+        with self._lock:
+            expires = self._entries.get(key)
+            if expires is not None and expires > now:
+                return False
+            self._entries[key] = now + self.ttl
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return True
+
+    def discard(self, key: Tuple[int, str]) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class Coalescer:
+    """Collects check-ins for up to ``window`` seconds and writes them per session in one transaction"""
+
+    def __init__(self, window: float = QR_BATCH_WINDOW_MS / 1000.0, batch_size: int = QR_BATCH_SIZE):
+        self.window = window
+        self.batch_size = batch_size
+        self._pending: List[Tuple[str, str, Dict[str, Any], asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes: set = set()
+
+    async def submit(self, session_id: str, type: str, mark: Dict[str, Any]) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((session_id, type, mark, future))
+        if len(self._pending) >= self.batch_size:
+            self._flush_now()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush_now)
+        return await future
+
+    def _flush_now(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._write(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _write(self, batch: List[Tuple[str, str, Dict[str, Any], asyncio.Future]]) -> None:
+        groups: Dict[Tuple[str, str], List[Tuple[Dict[str, Any], asyncio.Future]]] = {}
+        for session_id, type, mark, future in batch:
+            groups.setdefault((session_id, type), []).append((mark, future))
+        metrics.qr_batch_size.observe(len(batch))
+        try:
+            async with database.AsyncSessionLocal() as db:
+                outcomes = []
+                for (session_id, type), items in groups.items():
+                    results = await db.run_sync(marking.record_marks, session_id, [m for m, _ in items], type=type)
+                    outcomes.append((items, results))
+                await db.commit()
+        except Exception as e:
+            logger.exception(f"Could not write {len(batch)} QR check-ins")
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for items, results in outcomes:
+            for (_, future), result in zip(items, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def stop(self) -> None:
+        """Write whatever is pending and wait for in-flight batches"""
+        self._flush_now()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+
+dedupe = DedupeCache()
+coalescer = Coalescer()
+
+
+async def check_in(user: auth.Principal, claims: Dict[str, Any], location: Optional[str] = None) -> Dict[str, Any]:
+    """Record one validated scan; ``result`` is created, duplicate or error"""
+    key = (user.id, claims["s"])
+    if not dedupe.add(key):
+        metrics.qr_checkins.inc(result="cached_duplicate")
+        return {"result": "duplicate"}
+    scanned_at = datetime.utcnow()
+    mark = {"user_id": user.id, "status": status_for(claims, scanned_at), "method": "QR", "location": location}
+    try:
+        result = await coalescer.submit(claims["s"], claims["t"], mark)
+    except Exception:
+        # Let the student scan again once the database is back
+        dedupe.discard(key)
+        raise
+    metrics.qr_checkins.inc(result=result["result"])
+    return {**result, "status": mark["status"]} if result["result"] == "created" else result
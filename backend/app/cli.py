@@ -0,0 +1,215 @@
+"""Maintenance commands, run from the backend directory as ``python -m app.cli <command>``"""
+import argparse
+from datetime import date
+import logging
+import sys
+
+from sqlalchemy import null, select, update
+
+from . import archive, database, migrations, models, defaulters, face_index, rollups
+
+logger = logging.getLogger(__name__)
+
+
+def migrate_schema(args) -> int:
+    """Add the tables, columns and indexes of models.py that the database lacks"""
+    with database.engine.connect() as conn:
+        todo = migrations.missing(conn)
+        if args.dry_run or not todo:
+            print("\n".join(f"missing {migrations.describe([item])}" for item in todo) or "schema is up to date")
+            return 0
+        applied = migrations.upgrade(conn)
+        conn.commit()
+    print(f"applied {migrations.describe(applied)}")
+    return 0
+
+
+def migrate_face_encodings(args) -> int:
+    """Convert JSON face encodings to packed float32 blobs in id-ordered batches"""
+    with database.engine.connect() as conn:
+        # An upgraded database may not have face_encoding_blob yet
+        if ("column", "users", "face_encoding_blob") in migrations.missing(conn):
+            migrations.upgrade(conn)
+            conn.commit()
+            print("added users.face_encoding_blob (and the rest of the pending schema upgrade)")
+    converted = skipped = 0
+    last_id = 0
+    with database.SessionLocal() as db:
+        while True:
+            rows = db.execute(
+                select(models.User.id, models.User.face_encoding)
+                .where(models.User.id > last_id, models.User.face_encoding.isnot(None), models.User.face_encoding_blob.is_(None))
+                .order_by(models.User.id)
+                .limit(args.batch_size)
+            ).all()
+            if not rows:
+                break
+            updates = []
+            for user_id, encoding in rows:
+                if not isinstance(encoding, list) or len(encoding) != face_index.FACE_ENCODING_DIM:
+                    skipped += 1
+                    continue
+                updates.append({"id": user_id, "face_encoding_blob": face_index.pack_encoding(encoding)})
+            if updates:
+                # ORM bulk UPDATE by primary key: one executemany per batch
+                db.execute(update(models.User), updates)
+                if args.drop_json:
+                    # null() stores SQL NULL; a plain None would be written as JSON 'null'
+                    db.execute(
+                        update(models.User).where(models.User.id.in_([u["id"] for u in updates])).values(face_encoding=null())
+                    )
+            db.commit()
+            converted += len(updates)
+            last_id = rows[-1][0]
+            logger.info(f"Converted {converted} face encodings so far")
+    print(f"converted={converted} skipped={skipped}")
+    return 0
+
+
+def face_snapshot(args) -> int:
+    """Rebuild the memory-mappable gallery snapshot from the database"""
+    path = args.path or face_index.FACE_SNAPSHOT_PATH
+    if not path:
+        print("No snapshot path: pass --path or set FACE_SNAPSHOT_PATH", file=sys.stderr)
+        return 2
+    gallery = face_index.FaceGallery()
+    with database.SessionLocal() as db:
+        gallery.load(db)
+    size = gallery.save_snapshot(path)
+    print(f"wrote {size} encodings to {path}")
+    return 0
+
+
+def rebuild_counters(args) -> int:
+    """Recompute the per-user attendance counters from attendance_records"""
+    with database.SessionLocal() as db:
+        rows = rollups.rebuild_counters(db)
+        db.commit()
+    print(f"rebuilt {rows} counter rows")
+    return 0
+
+
+def backfill_rollups(args) -> int:
+    """Build the daily attendance rollups (and counters) from existing records"""
+    since = date.fromisoformat(args.since) if args.since else None
+    with database.SessionLocal() as db:
+        rows = rollups.rebuild_daily(db, since)
+        if since is None:
+            rollups.rebuild_counters(db)
+        db.commit()
+    print(f"attendance_daily now holds {rows} rows")
+    return 0
+
+
+def create_term(args) -> int:
+    """Register an academic term used by the defaulter list"""
+    start, end = date.fromisoformat(args.start), date.fromisoformat(args.end)
+    if end < start:
+        print("--end must not be before --start", file=sys.stderr)
+        return 2
+    with database.SessionLocal() as db:
+        term = models.AcademicTerm(name=args.name, start_date=start, end_date=end)
+        db.add(term)
+        db.commit()
+        print(f"created term {term.id}: {term.name} {start} .. {end}")
+    return 0
+
+
+def notify_defaulters(args) -> int:
+    """Send shortage notifications to every student below the threshold; meant for a daily cron job"""
+    attendance = defaulters.term_attendance(args.term_id, max_age=0)
+    if attendance is None:
+        print("No academic term found", file=sys.stderr)
+        return 2
+    below = attendance.below(args.threshold, args.class_code)
+    if args.dry_run:
+        for row in below:
+            info = attendance.describe(row)
+            print(f"{info['user_id']} {info['name']} {info['class_code'] or '-'} {info['percentage']}%")
+        print(f"{len(below)} of {len(attendance)} students below {args.threshold:g}% in {attendance.term_name}")
+        return 0
+    with database.SessionLocal() as db:
+        sent = defaulters.notify_defaulters(db, attendance, args.threshold, args.class_code)
+        db.commit()
+    print(f"notified {sent} of {len(attendance)} students below {args.threshold:g}% in {attendance.term_name}")
+    return 0
+
+
+def archive_terms(args) -> int:
+    """Move the records of closed terms out of attendance_records into archive files"""
+    with database.SessionLocal() as db:
+        if args.term_id is not None:
+            term = db.get(models.AcademicTerm, args.term_id)
+            if term is None:
+                print(f"No term {args.term_id}", file=sys.stderr)
+                return 2
+            terms = [term]
+        else:
+            terms = archive.archivable_terms(db, grace_days=args.grace_days)
+        if args.dry_run:
+            for term in terms:
+                print(f"would archive term {term.id}: {term.name} {term.start_date} .. {term.end_date}")
+            return 0
+        failed = 0
+        for term in terms:
+            try:
+                entry = archive.archive_term(db, term, grace_days=args.grace_days)
+                db.commit()
+            except ValueError as e:
+                db.rollback()
+                failed += 1
+                print(f"skipped term {term.id}: {e}", file=sys.stderr)
+                continue
+            print(f"archived term {term.id}: {term.name}, {entry.records} records to {entry.path}")
+    return 1 if failed else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.cli", description="EduTrack maintenance commands")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("migrate-schema", help="Add new tables, columns and indexes to an existing database")
+    p.add_argument("--dry-run", action="store_true", help="List what is missing without changing anything")
+    p.set_defaults(func=migrate_schema)
+
+    p = sub.add_parser("migrate-face-encodings", help="Pack JSON face encodings into the binary column")
+    p.add_argument("--batch-size", type=int, default=500)
+    p.add_argument("--drop-json", action="store_true", help="Clear the JSON column once a row is converted")
+    p.set_defaults(func=migrate_face_encodings)
+
+    p = sub.add_parser("face-snapshot", help="Write the face gallery snapshot shared by workers")
+    p.add_argument("--path", default=None)
+    p.set_defaults(func=face_snapshot)
+
+    p = sub.add_parser("rebuild-counters", help="Recompute the attendance stats counters from raw records")
+    p.set_defaults(func=rebuild_counters)
+
+    p = sub.add_parser("backfill-rollups", help="Build the daily attendance rollups used by reports")
+    p.add_argument("--since", default=None, help="Only rebuild days from this ISO date on (counters are left alone)")
+    p.set_defaults(func=backfill_rollups)
+
+    p = sub.add_parser("create-term", help="Register an academic term")
+    p.add_argument("--name", required=True)
+    p.add_argument("--start", required=True, help="ISO date of the first day")
+    p.add_argument("--end", required=True, help="ISO date of the last day")
+    p.set_defaults(func=create_term)
+
+    p = sub.add_parser("notify-defaulters", help="Notify students whose term attendance is below the threshold")
+    p.add_argument("--threshold", type=float, default=defaulters.DEFAULTER_THRESHOLD)
+    p.add_argument("--term-id", type=int, default=None, help="Defaults to the term containing today")
+    p.add_argument("--class-code", default=None)
+    p.add_argument("--dry-run", action="store_true", help="List the students without notifying them")
+    p.set_defaults(func=notify_defaulters)
+
+    p = sub.add_parser("archive-terms", help="Archive the attendance records of closed terms")
+    p.add_argument("--term-id", type=int, default=None, help="Defaults to every closed term not archived yet")
+    p.add_argument("--grace-days", type=int, default=archive.ARCHIVE_GRACE_DAYS, help="Days after a term ends before it is archived")
+    p.add_argument("--dry-run", action="store_true", help="List the terms without archiving them")
+    p.set_defaults(func=archive_terms)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
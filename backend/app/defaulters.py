@@ -0,0 +1,311 @@
+"""Per-term attendance bitmaps and the defaulter list computed from them.
+
+For every active student the term is one row of bits, one bit per session held
+for the student's class (``np.packbits``, so 500 sessions take 63 bytes). A
+class's sessions are the distinct ``session_id`` values recorded for its
+students during the term; a set bit means the student was present or late.
+Percentages for the whole cohort are then a single vectorized popcount.
+
+Bitmaps are built with one streamed query and cached per worker, so "students
+below X%" is answered from memory. They are kept current without rebuilding:
+every attendance change goes through ``rollups.add_records``, which notes it on
+the session, and once that session commits the change is applied to the cached
+bitmaps (a copy is updated and swapped in). Commits in other workers arrive as
+a pub/sub signal that marks the cache stale; the next request rebuilds the
+term in the background while the previous bitmaps keep being served.
+DEFAULTER_CACHE_TTL_SEC bounds the age of a cache no change reached.
+"""
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import copy
+import itertools
+import logging
+import os
+import threading
+
+import numpy as np
+from sqlalchemy import event, insert, select
+from sqlalchemy.orm import Session
+
+from . import archive, database, models, pubsub, rollups
+
+logger = logging.getLogger(__name__)
+
+DEFAULTER_THRESHOLD = float(os.getenv("DEFAULTER_THRESHOLD", "75"))
+DEFAULTER_CACHE_TTL_SEC = int(os.getenv("DEFAULTER_CACHE_TTL_SEC", "300"))
+BUILD_BATCH_SIZE = 10000
+STALE_SIGNAL = "defaulters.stale"
+
+# Set bits per byte value
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+
+
+class TermAttendance:
+    """Packed attendance bitmaps of every active student for one term"""
+
+    def __init__(self, term: models.AcademicTerm, students: List[Any], class_codes: List[str],
+                 student_class: np.ndarray, columns: List[Dict[str, int]], held: np.ndarray, bits: np.ndarray):
+        self.term_id = term.id
+        self.term_name = term.name
+        self.start, self.end = archive.term_bounds(term)
+        self.user_ids = np.array([s.id for s in students], dtype=np.int64)
+        self.row_of = {s.id: i for i, s in enumerate(students)}
+        self.public_ids = [s.public_id for s in students]
+        self.names = [s.name for s in students]
+        self.class_codes = class_codes
+        self.student_class = student_class  # index into class_codes per student
+        self.columns = columns  # per class: session_id -> bit
+        self.held = held  # sessions held per class
+        self.bits = bits  # (students, bytes) packed bitmaps
+        self.built_at = datetime.utcnow()
+        self.stale = False  # set when another worker changed attendance
+        self._derive()
+
+    def _derive(self) -> None:
+        # One vectorized pass for the whole cohort
+        bits, students = self.bits, len(self.user_ids)
+        self.attended = _POPCOUNT[bits].sum(axis=1, dtype=np.int64) if bits.size else np.zeros(students, np.int64)
+        self.sessions = self.held[self.student_class] if students else np.zeros(0, np.int64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.percentages = np.where(self.sessions > 0, self.attended * 100.0 / self.sessions, np.nan)
+
+    def with_changes(self, changes: Dict[Tuple[int, str], bool]) -> "TermAttendance":
+        """Copy with ``(user_id, session_id) -> attended`` applied.
+
+        Setting a bit to its final value is idempotent, so a change the bitmaps
+        already contain can safely be applied again.
+        """
+        updated = copy.copy(self)
+        updated.columns = [dict(c) for c in self.columns]
+        updated.held = self.held.copy()
+        bits = self.bits.copy()
+        for (user_id, session_id), attended in changes.items():
+            row = self.row_of.get(user_id)
+            if row is None:
+                continue  # enrolled after the build; picked up by the next rebuild
+            cls = self.student_class[row]
+            col = updated.columns[cls].get(session_id)
+            if col is None:
+                col = updated.columns[cls][session_id] = len(updated.columns[cls])
+                updated.held[cls] += 1
+            if col >= bits.shape[1] * 8:
+                bits = np.pad(bits, ((0, 0), (0, max(col // 8 + 1, 2 * bits.shape[1]) - bits.shape[1])))
+            mask = np.uint8(0x80 >> (col % 8))
+            if attended:
+                bits[row, col // 8] |= mask
+            else:
+                bits[row, col // 8] &= ~mask
+        updated.bits = bits
+        updated._derive()
+        return updated
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def below(self, threshold: float, class_code: Optional[str] = None) -> np.ndarray:
+        """Row indices of students under ``threshold`` percent, lowest first"""
+        mask = self.percentages < threshold  # NaN (no sessions yet) never matches
+        if class_code is not None:
+            if class_code not in self.class_codes:
+                return np.zeros(0, dtype=np.int64)
+            mask &= self.student_class == self.class_codes.index(class_code)
+        rows = np.flatnonzero(mask)
+        return rows[np.argsort(self.percentages[rows], kind="stable")]
+
+    def describe(self, row: int) -> Dict[str, Any]:
+        return {
+            "user_id": self.public_ids[row],
+            "name": self.names[row],
+            "class_code": self.class_codes[self.student_class[row]] or None,
+            "attended": int(self.attended[row]),
+            "sessions": int(self.sessions[row]),
+            "percentage": round(float(self.percentages[row]), 1),
+        }
+
+
+def current_term(db: Session, today: Optional[date] = None) -> Optional[models.AcademicTerm]:
+    today = today or datetime.utcnow().date()
+    t = models.AcademicTerm
+    return db.execute(
+        select(t).where(t.start_date <= today, t.end_date >= today).order_by(t.start_date.desc()).limit(1)
+    ).scalar_one_or_none()
+
+
+def build(db: Session, term: models.AcademicTerm) -> TermAttendance:
+    u, ar = models.User, models.AttendanceRecord
+    students = db.execute(
+        select(u.id, u.public_id, u.name, u.class_code).where(u.role == "student", u.is_active == True).order_by(u.id)
+    ).all()
+    row_of = {s.id: i for i, s in enumerate(students)}
+    class_codes = sorted({s.class_code or "" for s in students})
+    class_index = {code: i for i, code in enumerate(class_codes)}
+    student_class = np.array([class_index[s.class_code or ""] for s in students], dtype=np.int64)
+    columns: List[Dict[str, int]] = [{} for _ in class_codes]  # per class: session_id -> bit
+    grid = np.zeros((len(students), 64), dtype=bool)
+
+    start, end = archive.term_bounds(term)
+    result = db.execute(
+        select(ar.user_id, ar.session_id, ar.status)
+        .where(ar.timestamp >= start, ar.timestamp < end, ar.session_id.isnot(None))
+        .execution_options(yield_per=BUILD_BATCH_SIZE)
+    )
+    # An archived term's records come from its file (plus any marked since, still in the table)
+    batches = result.partitions()
+    entry = db.get(models.AttendanceArchive, term.id)
+    if entry is not None and entry.records:
+        archived = archive.load(entry).batches(("user_id", "session_id", "status"), start=start, end=end, size=BUILD_BATCH_SIZE)
+        archived = ([row for row in batch if row[1] is not None] for batch in archived)
+        batches = itertools.chain(archived, batches)
+    for batch in batches:
+        rows, cols = [], []
+        for user_id, session_id, record_status in batch:
+            row = row_of.get(user_id)
+            if row is None:
+                continue
+            session_cols = columns[student_class[row]]
+            col = session_cols.setdefault(session_id, len(session_cols))
+            if record_status in rollups.ATTENDED_STATUSES:
+                rows.append(row)
+                cols.append(col)
+        width = max((len(c) for c in columns), default=0)
+        if width > grid.shape[1]:
+            grown = np.zeros((len(students), max(width, grid.shape[1] * 2)), dtype=bool)
+            grown[:, : grid.shape[1]] = grid
+            grid = grown
+        if rows:
+            grid[np.array(rows), np.array(cols)] = True
+    width = max((len(c) for c in columns), default=0)
+    bits = np.packbits(grid[:, :width], axis=1)
+    held = np.array([len(c) for c in columns], dtype=np.int64)
+    logger.info(f"Built attendance bitmaps for term {term.name}: {len(students)} students, up to {width} sessions per class")
+    return TermAttendance(term, students, class_codes, student_class, columns, held, bits)
+
+
+_cache: Dict[int, TermAttendance] = {}
+_cache_lock = threading.Lock()  # guards _cache and _building; held only for cheap swaps
+_build_locks: Dict[int, threading.Lock] = {}
+# Per term being rebuilt: its bounds and the local changes committed meanwhile, and whether
+# another worker signalled
+_building: Dict[int, Tuple[datetime, datetime, List[Dict[Tuple[int, str], bool]]]] = {}
+_signalled: Dict[int, bool] = {}
+
+
+def _fresh(cached: Optional[TermAttendance], max_age: float) -> bool:
+    return cached is not None and not cached.stale and (datetime.utcnow() - cached.built_at).total_seconds() < max_age
+
+
+def term_attendance(term_id: Optional[int] = None, max_age: float = DEFAULTER_CACHE_TTL_SEC) -> Optional[TermAttendance]:
+    """Cached bitmaps for ``term_id`` (default: the current term), rebuilt when stale or older than ``max_age``.
+
+    The scan runs outside the cache lock, one per term; while it runs, other
+    callers get the previous bitmaps (or wait, if there are none yet).
+    Blocking; call from a worker thread or a script.
+    """
+    with database.SessionLocal() as db:
+        term = db.get(models.AcademicTerm, term_id) if term_id is not None else current_term(db)
+        if term is None:
+            return None
+        with _cache_lock:
+            cached = _cache.get(term.id)
+            if _fresh(cached, max_age):
+                return cached
+            build_lock = _build_locks.setdefault(term.id, threading.Lock())
+        if not build_lock.acquire(blocking=cached is None):
+            return cached
+        try:
+            with _cache_lock:
+                cached = _cache.get(term.id)
+                if _fresh(cached, max_age):
+                    return cached
+                _building[term.id] = (*archive.term_bounds(term), [])
+                _signalled[term.id] = False
+            try:
+                built = build(db, term)
+            finally:
+                with _cache_lock:
+                    missed, signalled = _building.pop(term.id)[2], _signalled.pop(term.id)
+            with _cache_lock:
+                # Commits that raced the scan may or may not be in it; applying them again is harmless
+                for changes in missed:
+                    built = built.with_changes(changes)
+                built.stale = signalled
+                _cache[term.id] = built
+            return built
+        finally:
+            build_lock.release()
+
+
+def _final_states(rows: Iterable[Tuple[int, Optional[str], str, datetime, int]]) -> Dict[Tuple[int, str], Tuple[datetime, bool]]:
+    """(user_id, session_id) -> (timestamp, attended) after the committed changes"""
+    final: Dict[Tuple[int, str], Tuple[datetime, bool]] = {}
+    for user_id, session_id, status, timestamp, sign in rows:
+        # A new record is added once; a correction takes the old row out and adds the new one
+        if session_id is not None and sign > 0:
+            final[(user_id, session_id)] = (timestamp, status in rollups.ATTENDED_STATUSES)
+    return final
+
+
+def _within(final: Dict[Tuple[int, str], Tuple[datetime, bool]], start: datetime, end: datetime) -> Dict[Tuple[int, str], bool]:
+    return {key: attended for key, (timestamp, attended) in final.items() if start <= timestamp < end}
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_committed(session: Session) -> None:
+    if session.in_nested_transaction():
+        return  # a released SAVEPOINT also fires after_commit; wait for the real commit
+    rows = session.info.pop(rollups.PENDING_CHANGES, None)
+    if not rows:
+        return
+    final = _final_states(rows)
+    with _cache_lock:
+        for term_id, cached in list(_cache.items()):
+            changes = _within(final, cached.start, cached.end)
+            if changes:
+                _cache[term_id] = cached.with_changes(changes)
+        for start, end, missed in _building.values():
+            changes = _within(final, start, end)
+            if changes:
+                missed.append(changes)
+    pubsub.hub.signal_threadsafe(STALE_SIGNAL, {})
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_rolled_back(session: Session) -> None:
+    # A rolled back SAVEPOINT (e.g. marking's retry after an IntegrityError) keeps the outer transaction's changes
+    if not session.in_nested_transaction():
+        session.info.pop(rollups.PENDING_CHANGES, None)
+
+
+def _on_stale(_: Dict[str, Any]) -> None:
+    # Another worker committed attendance changes; rebuild on the next request
+    with _cache_lock:
+        for cached in _cache.values():
+            cached.stale = True
+        for term_id in _signalled:
+            _signalled[term_id] = True
+
+
+pubsub.hub.on_signal(STALE_SIGNAL, _on_stale)
+
+
+def notify_defaulters(db: Session, attendance: TermAttendance, threshold: float = DEFAULTER_THRESHOLD,
+                      class_code: Optional[str] = None) -> int:
+    """Insert one shortage notification per student below ``threshold`` with a single INSERT"""
+    created_at = datetime.utcnow()
+    rows = [
+        {
+            "user_id": int(attendance.user_ids[row]),
+            "title": "Attendance shortage",
+            "message": (
+                f"Your attendance in {attendance.term_name} is {attendance.percentages[row]:.1f}% "
+                f"({attendance.attended[row]}/{attendance.sessions[row]} sessions), below the required {threshold:g}%."
+            ),
+            "type": "shortage",
+            "is_read": False,
+            "created_at": created_at,
+        }
+        for row in attendance.below(threshold, class_code)
+    ]
+    if rows:
+        db.execute(insert(models.Notification), rows)
+    return len(rows)
@@ -0,0 +1,332 @@
+from datetime import timezone
+from typing import Dict, List, Optional, Sequence, Tuple
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+from sqlalchemy import func, null, select
+from sqlalchemy.orm import Session
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+FACE_ENCODING_DIM = int(os.getenv("FACE_ENCODING_DIM", "128"))
+# "json" keeps writing User.face_encoding, "binary" writes packed float32 to User.face_encoding_blob
+FACE_ENCODING_STORAGE = os.getenv("FACE_ENCODING_STORAGE", "json")
+# Optional gallery snapshot shared by all workers through the page cache
+FACE_SNAPSHOT_PATH = os.getenv("FACE_SNAPSHOT_PATH", "")
+FACE_MATCH_TOLERANCE = float(os.getenv("FACE_MATCH_TOLERANCE", "0.6"))
+# How often a worker compares its gallery with the database to pick up enrolments made elsewhere
+FACE_GALLERY_CHECK_SEC = float(os.getenv("FACE_GALLERY_CHECK_SEC", "10"))
+# Upper bound on the probe x gallery distance block computed at once (float32 cells)
+SEARCH_BLOCK_CELLS = int(os.getenv("FACE_SEARCH_BLOCK_CELLS", str(4 * 1024 * 1024)))
+
+ENCODING_DTYPE = np.dtype("<f4")
+
+
+def pack_encoding(encoding: Sequence[float]) -> bytes:
+    return np.asarray(encoding, dtype=ENCODING_DTYPE).tobytes()
+
+
+def unpack_encoding(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=ENCODING_DTYPE)
+
+
+def store_encoding(user: models.User, encoding: Optional[Sequence[float]]) -> None:
+    """Write an encoding to the column selected by FACE_ENCODING_STORAGE"""
+    # null() stores SQL NULL; a plain None would be written as JSON 'null'
+    if encoding is None:
+        user.face_encoding = null()
+        user.face_encoding_blob = None
+    elif FACE_ENCODING_STORAGE == "binary":
+        user.face_encoding = null()
+        user.face_encoding_blob = pack_encoding(encoding)
+    else:
+        user.face_encoding = [float(v) for v in encoding]
+        user.face_encoding_blob = None
+
+
+class FaceGallery:
+    """In-process index of every enrolled face encoding.
+
+    Encodings live in one contiguous float32 matrix (one row per user) together
+    with their squared norms, so matching a batch of probes is a single matrix
+    product instead of a Python loop over JSON lists. Rows are appended into
+    spare capacity and removed by moving the last row into the hole, which keeps
+    the matrix dense. Searches use the arrays after releasing the lock, so a row
+    they can see is never changed in place: replacing or moving one writes to a
+    fresh copy that is swapped in; appends only fill rows no search can see yet.
+
+    A gallery loaded from a snapshot starts out backed by read-only memory maps
+    that every worker shares; the first update copies it into private memory.
+    ``version`` is the ``gallery_version`` of the data it was loaded from.
+    """
+
+    def __init__(self, dim: int = FACE_ENCODING_DIM):
+        self.dim = dim
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._matrix = np.zeros((0, dim), dtype=np.float32)
+        self._norms = np.zeros(0, dtype=np.float32)
+        self._user_ids = np.zeros(0, dtype=np.int64)
+        self._rows: Dict[int, int] = {}
+        self._public_ids: Dict[int, str] = {}
+        self._size = 0
+        self.version: Tuple[int, int, int] = (0, 0, 0)
+        self.checked_at = 0.0
+
+    def __len__(self):
+        return self._size
+
+    def _coerce(self, encoding: Sequence[float]) -> np.ndarray:
+        vec = np.asarray(encoding, dtype=np.float32).reshape(-1)
+        if vec.shape[0] != self.dim:
+            raise ValueError(f"Face encoding must have {self.dim} values, got {vec.shape[0]}")
+        return vec
+
+    def _reserve(self, capacity: int, copy: bool = False) -> None:
+        """Make room for ``capacity`` rows; ``copy`` forces new arrays (copy-on-write)"""
+        if capacity <= self._matrix.shape[0] and self._matrix.flags.writeable and not copy:
+            return
+        capacity = max(capacity, self._matrix.shape[0] if copy else 2 * self._matrix.shape[0], 64)
+        matrix = np.zeros((capacity, self.dim), dtype=np.float32)
+        norms = np.zeros(capacity, dtype=np.float32)
+        user_ids = np.zeros(capacity, dtype=np.int64)
+        matrix[:self._size] = self._matrix[:self._size]
+        norms[:self._size] = self._norms[:self._size]
+        user_ids[:self._size] = self._user_ids[:self._size]
+        self._matrix, self._norms, self._user_ids = matrix, norms, user_ids
+
+    def _reset(self, matrix: np.ndarray, norms: np.ndarray, user_ids: np.ndarray, public_ids: Sequence[str]) -> None:
+        self._matrix, self._norms, self._user_ids = matrix, norms, user_ids
+        self._size = len(user_ids)
+        self._rows = {int(user_id): row for row, user_id in enumerate(user_ids.tolist())}
+        self._public_ids = {int(user_id): public_id for user_id, public_id in zip(user_ids.tolist(), public_ids)}
+        self.loaded = True
+
+    def load(self, db: Session, version: Optional[Tuple[int, int, int]] = None) -> int:
+        """(Re)build the gallery from every active user with an enrolled face.
+
+        Packed blobs are concatenated and viewed as the matrix in one step; rows
+        still stored as JSON lists are converted one by one.
+        """
+        # Taken before reading the rows: a change in between only makes the next check reload again
+        version = version if version is not None else gallery_version(db)
+        rows = db.execute(
+            select(models.User.id, models.User.public_id, models.User.face_encoding_blob, models.User.face_encoding).where(
+                (models.User.face_encoding_blob.isnot(None)) | (models.User.face_encoding.isnot(None)),
+                models.User.is_active == True,
+            )
+        ).all()
+        blob_size = self.dim * ENCODING_DTYPE.itemsize
+        packed, packed_ids, packed_public, legacy = [], [], [], []
+        for user_id, public_id, blob, encoding in rows:
+            if blob is not None and len(blob) == blob_size:
+                packed.append(blob)
+                packed_ids.append(user_id)
+                packed_public.append(public_id)
+            elif encoding is not None:
+                legacy.append((user_id, public_id, encoding))
+            else:
+                logger.warning(f"Skipping face encoding of user {user_id}: bad blob size {len(blob) if blob is not None else None}")
+        matrix = np.frombuffer(b"".join(packed), dtype=ENCODING_DTYPE).reshape(-1, self.dim).astype(np.float32)
+        with self._lock:
+            self._reset(matrix, np.einsum("ij,ij->i", matrix, matrix), np.asarray(packed_ids, dtype=np.int64), packed_public)
+            self.version = version
+            self._reserve(self._size + len(legacy))
+            for user_id, public_id, encoding in legacy:
+                try:
+                    self._put(user_id, public_id, self._coerce(encoding))
+                except (TypeError, ValueError) as e:
+                    logger.warning(f"Skipping face encoding of user {user_id}: {e}")
+        logger.info(f"Face gallery loaded with {self._size} encodings")
+        return self._size
+
+    def save_snapshot(self, path: str) -> int:
+        """Write the gallery to ``path`` as consecutive .npy arrays.
+
+        The file is written next to the target and renamed over it, so readers
+        never observe a half-written snapshot.
+        """
+        with self._lock:
+            size = self._size
+            arrays = [
+                np.ascontiguousarray(self._matrix[:size]),
+                np.ascontiguousarray(self._norms[:size]),
+                np.ascontiguousarray(self._user_ids[:size]),
+                np.asarray([self._public_ids[int(u)] for u in self._user_ids[:size].tolist()], dtype="S36").reshape(size),
+                np.asarray(self.version, dtype=np.int64),
+            ]
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            for arr in arrays:
+                np.lib.format.write_array(f, arr, version=(1, 0))
+        os.replace(tmp, path)
+        return size
+
+    def load_snapshot(self, path: str) -> int:
+        """Map a snapshot written by save_snapshot without copying or parsing it"""
+        arrays = []
+        with open(path, "rb") as f:
+            for _ in range(5):
+                np.lib.format.read_magic(f)
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                offset = f.tell()
+                count = int(np.prod(shape))
+                if count:
+                    arrays.append(np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape))
+                else:
+                    arrays.append(np.zeros(shape, dtype=dtype))
+                f.seek(offset + count * dtype.itemsize)
+        matrix, norms, user_ids, public_ids, version = arrays
+        if matrix.shape[1:] != (self.dim,):
+            raise ValueError(f"Snapshot {path} holds {matrix.shape[1:]} encodings, expected {self.dim}")
+        with self._lock:
+            self._reset(matrix, norms, user_ids, [p.decode() for p in public_ids.tolist()])
+            self.version = tuple(int(v) for v in version.tolist())
+        logger.info(f"Face gallery mapped from {path} with {self._size} encodings")
+        return self._size
+
+    def _put(self, user_id: int, public_id: str, vec: np.ndarray) -> None:
+        row = self._rows.get(user_id)
+        # Overwriting an existing row would change it under a running search
+        self._reserve(self._size + (1 if row is None else 0), copy=row is not None)
+        if row is None:
+            row = self._size
+            self._size += 1
+            self._rows[user_id] = row
+            self._user_ids[row] = user_id
+        self._matrix[row] = vec
+        self._norms[row] = float(vec @ vec)
+        self._public_ids[user_id] = public_id
+
+    def upsert(self, user_id: int, public_id: str, encoding: Sequence[float]) -> None:
+        vec = self._coerce(encoding)
+        with self._lock:
+            self._put(user_id, public_id, vec)
+
+    def remove(self, user_id: int) -> None:
+        with self._lock:
+            row = self._rows.pop(user_id, None)
+            if row is None:
+                return
+            # Copy even when dropping the last row: the next append would reuse it in place
+            self._reserve(self._size, copy=True)
+            self._public_ids.pop(user_id, None)
+            last = self._size - 1
+            if row != last:
+                moved = int(self._user_ids[last])
+                self._matrix[row] = self._matrix[last]
+                self._norms[row] = self._norms[last]
+                self._user_ids[row] = moved
+                self._rows[moved] = row
+            self._size = last
+
+    def search(self, probes: Sequence[Sequence[float]], tolerance: float = FACE_MATCH_TOLERANCE) -> List[Tuple[Optional[int], Optional[str], Optional[float]]]:
+        """Nearest enrolled user for every probe encoding.
+
+        Returns ``(user_id, public_id, distance)`` per probe; ``user_id`` is ``None``
+        when the closest match is farther than ``tolerance`` (``distance`` is still
+        reported) or the gallery is empty (``distance`` is ``None`` too).
+        """
+        queries = np.asarray(probes, dtype=np.float32)
+        if queries.ndim != 2 or queries.shape[1] != self.dim:
+            raise ValueError(f"Probe encodings must have {self.dim} values each")
+        with self._lock:
+            # Views stay valid after the lock is released: rows below size are never written in place
+            size = self._size
+            matrix = self._matrix[:size]
+            norms = self._norms[:size]
+            user_ids = self._user_ids[:size]
+            public_ids = dict(self._public_ids)
+        if size == 0:
+            return [(None, None, None)] * len(queries)
+
+        best_rows = np.empty(len(queries), dtype=np.int64)
+        best_dist = np.empty(len(queries), dtype=np.float32)
+        step = max(1, SEARCH_BLOCK_CELLS // size)
+        for start in range(0, len(queries), step):
+            block = queries[start:start + step]
+            # ||q - g||^2 = ||q||^2 + ||g||^2 - 2 q.g, computed for the whole block at once
+            d2 = norms[None, :] - 2.0 * (block @ matrix.T)
+            d2 += np.einsum("ij,ij->i", block, block)[:, None]
+            rows = np.argmin(d2, axis=1)
+            best_rows[start:start + step] = rows
+            best_dist[start:start + step] = np.sqrt(np.maximum(d2[np.arange(len(block)), rows], 0.0))
+
+        results = []
+        for row, dist in zip(best_rows.tolist(), best_dist.tolist()):
+            if dist > tolerance:
+                results.append((None, None, dist))
+            else:
+                user_id = int(user_ids[row])
+                results.append((user_id, public_ids.get(user_id), dist))
+        return results
+
+
+gallery = FaceGallery()
+_refresh_lock = threading.Lock()
+
+
+def gallery_version(db: Session) -> Tuple[int, int, int]:
+    """(count, max id, max updated_at in microseconds) of the enrolled users.
+
+    Every enrolment, change, removal or deactivation moves at least one of
+    them, so a gallery or snapshot built at another version is out of date.
+    """
+    u = models.User
+    count, max_id, max_updated = db.execute(
+        select(func.count(), func.max(u.id), func.max(u.updated_at)).where(
+            (u.face_encoding_blob.isnot(None)) | (u.face_encoding.isnot(None)), u.is_active == True,
+        )
+    ).one()
+    stamp = int(max_updated.replace(tzinfo=timezone.utc).timestamp() * 1_000_000) if max_updated else 0
+    return count, max_id or 0, stamp
+
+
+def _refresh(db: Session, version: Tuple[int, int, int]) -> None:
+    if FACE_SNAPSHOT_PATH and os.path.exists(FACE_SNAPSHOT_PATH):
+        try:
+            # Mapping is cheap: check the version on a scratch gallery so a stale file is never searched
+            candidate = FaceGallery(gallery.dim)
+            candidate.load_snapshot(FACE_SNAPSHOT_PATH)
+            if candidate.version == version:
+                gallery.load_snapshot(FACE_SNAPSHOT_PATH)
+                return
+            logger.info(f"Face snapshot {FACE_SNAPSHOT_PATH} is out of date; rebuilding it")
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable face snapshot {FACE_SNAPSHOT_PATH}: {e}")
+    gallery.load(db, version)
+    if FACE_SNAPSHOT_PATH:
+        gallery.save_snapshot(FACE_SNAPSHOT_PATH)
+
+
+def get_gallery(db: Session) -> FaceGallery:
+    """Shared gallery, loaded on first use and kept in step with the database.
+
+    At most every FACE_GALLERY_CHECK_SEC the worker compares ``gallery_version``
+    with the version it loaded. On a difference (an enrolment in another worker,
+    a bulk import, a restart after changes) it maps FACE_SNAPSHOT_PATH if that
+    snapshot is current, and otherwise rebuilds from the database and rewrites
+    the snapshot for the other workers.
+    """
+    if gallery.loaded and time.monotonic() - gallery.checked_at < FACE_GALLERY_CHECK_SEC:
+        return gallery
+    # One refresh at a time; while it runs, other requests keep using the current gallery
+    if not _refresh_lock.acquire(blocking=not gallery.loaded):
+        return gallery
+    try:
+        version = gallery_version(db)
+        if not gallery.loaded or gallery.version != version:
+            _refresh(db, version)
+        gallery.checked_at = time.monotonic()
+    finally:
+        _refresh_lock.release()
+    return gallery
+
+
+def confidence_from_distance(distance: float) -> float:
+    return round(max(0.0, min(1.0, 1.0 - distance)), 4)
@@ -0,0 +1,224 @@
+"""Image ingestion: streamed uploads, process-pool resizing, content-addressed storage.
+
+An upload is read in chunks into a temporary file while its SHA-256 is
+computed, so a large camera frame is never held in memory. The digest names the
+stored files -- ``<MEDIA_ROOT>/ab/<sha256>.jpg`` and ``..._thumb.jpg`` -- which
+makes identical frames deduplicate for free: if the file already exists (or is
+being processed) the upload is dropped and the existing URL returned.
+
+Decoding, orientation fix, downscaling and thumbnailing happen on a
+ProcessPoolExecutor, off the event loop and outside the GIL. The handler returns
+the URL as soon as the job is queued; the file appears under MEDIA_URL once the
+worker has written it. Processing needs Pillow; without it uploads get 503.
+
+Stored images show faces of students, so MEDIA_URL is not a public directory:
+the database keeps the plain path and every URL handed to a client is signed
+with ``sign`` -- an HMAC over the path and an expiry -- by a handler that has
+already checked the caller may see it (the student, a teacher or an admin).
+routes/media.py serves a file only for a valid, unexpired signature.
+"""
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import lru_cache, partial
+from typing import Any, Dict, Optional, Set
+import hashlib
+import hmac
+import logging
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+import time
+
+from fastapi import HTTPException, UploadFile, status
+
+from . import metrics
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+MEDIA_ROOT = os.getenv("MEDIA_ROOT", "./media")
+MEDIA_URL = os.getenv("MEDIA_URL", "/media")
+# Lifetime of a signed image URL; URLs are stable within a period so browsers can cache them
+MEDIA_URL_TTL_SEC = int(os.getenv("MEDIA_URL_TTL_SEC", "3600"))
+# Partial uploads and half-written images; outside MEDIA_ROOT (whose files are served)
+# but on the same filesystem, so finished files are renamed into place
+MEDIA_TMP_DIR = os.getenv("MEDIA_TMP_DIR", MEDIA_ROOT.rstrip("/\\") + ".tmp")
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(10 * 1024 * 1024)))
+IMAGE_MAX_SIZE = int(os.getenv("IMAGE_MAX_SIZE", "1280"))  # longest side of the stored image
+IMAGE_THUMB_SIZE = int(os.getenv("IMAGE_THUMB_SIZE", "256"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(4, os.cpu_count() or 1))))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Leading bytes of the formats we accept; anything else is rejected before it is queued
+_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"RIFF")
+_NAME = re.compile(r"[0-9a-f]{64}(_thumb)?\.jpg")
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+_in_flight: Set[str] = set()
+
+
+def available() -> bool:
+    return Image is not None
+
+
+def _paths(digest: str):
+    directory = os.path.join(MEDIA_ROOT, digest[:2])
+    return directory, os.path.join(directory, f"{digest}.jpg"), os.path.join(directory, f"{digest}_thumb.jpg")
+
+
+def urls(digest: str) -> Dict[str, str]:
+    return {"url": f"{MEDIA_URL}/{digest[:2]}/{digest}.jpg", "thumbnail_url": f"{MEDIA_URL}/{digest[:2]}/{digest}_thumb.jpg"}
+
+
+@lru_cache(maxsize=1)
+def _key() -> bytes:
+    # Imported late: pool processes load this module too and need none of auth
+    from .auth import SECRET_KEY
+
+    return hmac.new(SECRET_KEY.encode(), b"edutrack-media-url", hashlib.sha256).digest()
+
+
+def _signature(path: str, expires: int) -> str:
+    return hmac.new(_key(), f"{path}:{expires}".encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def sign(url: Optional[str], now: Optional[float] = None) -> Optional[str]:
+    """``url`` with an expiring signature if it is one of our images; anything else unchanged"""
+    if not url or not url.startswith(MEDIA_URL + "/"):
+        return url
+    now = time.time() if now is None else now
+    # Valid for one to two periods, and the same URL for every request within a period
+    expires = (int(now) // MEDIA_URL_TTL_SEC + 2) * MEDIA_URL_TTL_SEC
+    return f"{url}?expires={expires}&sig={_signature(url, expires)}"
+
+
+def signed(stored: Dict[str, Any]) -> Dict[str, Any]:
+    """An ``ingest`` result with signed URLs, for the response to the uploader"""
+    return {**stored, "url": sign(stored["url"]), "thumbnail_url": sign(stored["thumbnail_url"])}
+
+
+def verify(path: str, expires: int, signature: str, now: Optional[float] = None) -> bool:
+    if expires <= (time.time() if now is None else now):
+        return False
+    return hmac.compare_digest(signature, _signature(path, expires))
+
+
+def file_path(directory: str, name: str) -> Optional[str]:
+    """Location under MEDIA_ROOT of ``<MEDIA_URL>/<directory>/<name>``, or None for anything we never store"""
+    if not _NAME.fullmatch(name) or directory != name[:2]:
+        return None
+    return os.path.join(MEDIA_ROOT, directory, name)
+
+
+def _save(image, path: str, quality: int) -> None:
+    tmp = os.path.join(MEDIA_TMP_DIR, f"{os.path.basename(path)}.{os.getpid()}.tmp")
+    image.save(tmp, "JPEG", quality=quality, optimize=True)
+    os.replace(tmp, path)
+
+
+def process_image(source: str, target: str, thumbnail: str, max_size: int, thumb_size: int, quality: int) -> float:
+    """Runs in a pool process: decode, fix orientation, downscale, write image and thumbnail"""
+    start = time.perf_counter()
+    with Image.open(source) as img:
+        # draft() lets the JPEG decoder skip straight to a smaller scale
+        img.draft("RGB", (max_size, max_size))
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        img.thumbnail((max_size, max_size))
+        _save(img, target, quality)
+        img.thumbnail((thumb_size, thumb_size))
+        _save(img, thumbnail, quality)
+    return time.perf_counter() - start
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn, not fork: the server already runs threads (thread pool, DB drivers)
+            # that a forked child would inherit in whatever state they were in
+            _executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+
+def shutdown() -> None:
+    """Wait for queued images and stop the pool"""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+async def _spool(upload: UploadFile):
+    """Copy the upload to a temporary file in MEDIA_TMP_DIR, hashing as it goes"""
+    os.makedirs(MEDIA_TMP_DIR, mode=0o700, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, path = tempfile.mkstemp(prefix="upload-", suffix=".tmp", dir=MEDIA_TMP_DIR)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if size == 0 and not chunk.startswith(_SIGNATURES):
+                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="JPEG, PNG or WebP image required")
+                size += len(chunk)
+                if size > IMAGE_MAX_BYTES:
+                    raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                        detail=f"Image larger than {IMAGE_MAX_BYTES} bytes")
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        os.unlink(path)
+        raise
+    if size == 0:
+        os.unlink(path)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Empty upload")
+    return path, digest.hexdigest(), size
+
+
+def _done(digest: str, source: str, started: float, future: Future) -> None:
+    _in_flight.discard(digest)
+    try:
+        os.unlink(source)
+    except OSError:
+        pass
+    error = future.exception()
+    if error is not None:
+        metrics.image_uploads.inc(result="failed")
+        logger.error(f"Could not process image {digest}: {error}")
+        return
+    metrics.image_processing_seconds.observe(future.result())
+    metrics.image_queue_seconds.observe(time.perf_counter() - started - future.result())
+
+
+async def ingest(upload: UploadFile) -> Dict[str, Any]:
+    """Store an uploaded image; returns its URLs and whether processing is still pending"""
+    if not available():
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Image processing is not available (Pillow is not installed)")
+    source, digest, size = await _spool(upload)
+    directory, target, thumbnail = _paths(digest)
+    if os.path.exists(thumbnail) or digest in _in_flight:
+        os.unlink(source)
+        metrics.image_uploads.inc(result="duplicate")
+        return {"sha256": digest, "bytes": size, "status": "ready" if digest not in _in_flight else "processing", **urls(digest)}
+    os.makedirs(directory, exist_ok=True)
+    _in_flight.add(digest)
+    started = time.perf_counter()
+    try:
+        future = _get_executor().submit(process_image, source, target, thumbnail, IMAGE_MAX_SIZE, IMAGE_THUMB_SIZE, IMAGE_QUALITY)
+    except BaseException:
+        _in_flight.discard(digest)
+        os.unlink(source)
+        raise
+    future.add_done_callback(partial(_done, digest, source, started))
+    metrics.image_uploads.inc(result="queued")
+    return {"sha256": digest, "bytes": size, "status": "processing", **urls(digest)}
@@ -0,0 +1,154 @@
+"""Set-based student roster import.
+
+The CSV is read as a stream (``TextIOWrapper`` decodes the bytes incrementally)
+and handled in chunks of IMPORT_CHUNK_SIZE rows: one IN query finds the emails
+that already exist, then the new users and their profiles are inserted with one
+multi-row INSERT each (plus a lookup of the new ids where the database has no
+INSERT ... RETURNING). Memory use and round trips depend on the chunk size, not
+on the file size.
+"""
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+import csv
+import io
+import logging
+import os
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "1000"))
+# Rows with an error are reported individually up to this many
+IMPORT_MAX_REPORTED_ERRORS = int(os.getenv("IMPORT_MAX_REPORTED_ERRORS", "1000"))
+
+_MAX_LENGTH = {"name": 255, "email": 255, "class_code": 50}
+
+
+def iter_csv_rows(stream: BinaryIO) -> Iterator[Tuple[int, Dict[str, str]]]:
+    """Yield ``(line_number, row)`` from a binary CSV stream without reading it all"""
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", errors="replace", newline="")
+    try:
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+    finally:
+        # Leave the underlying file to its owner
+        text.detach()
+
+
+def _chunks(rows: Iterable, size: int) -> Iterator[List]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _validate(row: Dict[str, str]) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    name = (row.get("name") or "").strip()
+    email = (row.get("email") or "").strip()
+    class_code = (row.get("class_code") or "").strip() or None
+    if not name or not email:
+        return None, "Missing name or email"
+    if "@" not in email:
+        return None, "Invalid email"
+    values = {"name": name, "email": email, "class_code": class_code}
+    for column, limit in _MAX_LENGTH.items():
+        if values[column] and len(values[column]) > limit:
+            return None, f"{column} longer than {limit} characters"
+    return values, None
+
+
+def _existing_emails(db: Session, emails: Iterable[str]) -> set:
+    wanted = set(emails)
+    if not wanted:
+        return set()
+    return set(db.execute(select(models.User.email).where(models.User.email.in_(wanted))).scalars())
+
+
+def _insert_users(db: Session, users: List[Dict[str, Any]]) -> List[int]:
+    """Insert ``users`` in one statement and return their ids"""
+    u = models.User
+    if db.get_bind().dialect.insert_executemany_returning:
+        return db.execute(insert(u).returning(u.id, sort_by_parameter_order=True), users).scalars().all()
+    # MySQL has no INSERT ... RETURNING; emails are unique, so look the new rows up by them
+    db.execute(insert(u), users)
+    return list(db.execute(select(u.id).where(u.email.in_([user["email"] for user in users]))).scalars())
+
+
+def _import_chunk(db: Session, chunk, seen: set, report: Dict[str, Any]) -> None:
+    candidates = []
+    for line, row in chunk:
+        values, error = _validate(row)
+        if error:
+            _report_error(report, line, row.get("email"), error)
+            continue
+        candidates.append((line, values))
+    for attempt in range(2):
+        existing = _existing_emails(db, (v["email"] for _, v in candidates))
+        users, skipped = [], []
+        chunk_seen = set()
+        for line, values in candidates:
+            email = values["email"]
+            if email in existing:
+                skipped.append((line, email, "Email already registered"))
+            elif email in seen or email in chunk_seen:
+                skipped.append((line, email, "Duplicate email in file"))
+            else:
+                chunk_seen.add(email)
+                users.append({**values, "password": "", "role": "student"})
+        try:
+            with db.begin_nested():
+                if users:
+                    ids = _insert_users(db, users)
+                    db.execute(insert(models.UserProfile), [{"user_id": user_id} for user_id in ids])
+            break
+        except IntegrityError:
+            # Another import or registration took one of the emails meanwhile
+            if attempt:
+                raise
+            logger.warning("Email conflict while importing students, re-checking chunk")
+    seen.update(chunk_seen)
+    for line, email, detail in skipped:
+        report["duplicates"] += 1
+        _report_error(report, line, email, detail, count=False)
+    report["created"] += len(users)
+
+
+def _report_error(report: Dict[str, Any], line: int, email: Optional[str], detail: str, count: bool = True) -> None:
+    if count:
+        report["failed"] += 1
+    if len(report["errors"]) < IMPORT_MAX_REPORTED_ERRORS:
+        report["errors"].append({"row": line, "email": email, "detail": detail})
+
+
+def import_students(
+    db: Session,
+    rows: Iterable[Tuple[int, Dict[str, str]]],
+    chunk_size: int = IMPORT_CHUNK_SIZE,
+    on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> Dict[str, Any]:
+    """Create student accounts (with empty profiles) from ``(line_number, row)`` pairs.
+
+    Rows need ``name`` and ``email``; ``class_code`` is optional. Existing emails
+    and repeats within the file are reported as duplicates, invalid rows as
+    failed. Each chunk is committed on its own, so a large import shows up
+    progressively and a failure keeps the chunks already stored.
+    """
+    report: Dict[str, Any] = {"rows": 0, "created": 0, "duplicates": 0, "failed": 0, "errors": []}
+    seen: set = set()
+    for chunk in _chunks(rows, chunk_size):
+        _import_chunk(db, chunk, seen, report)
+        db.commit()
+        report["rows"] += len(chunk)
+        if on_progress is not None:
+            on_progress({k: report[k] for k in ("rows", "created", "duplicates", "failed")})
+    report["errors"].sort(key=lambda e: e["row"])
+    return report
@@ -0,0 +1,74 @@
+"""In-process registry of background jobs whose progress clients can poll.
+
+Jobs live in the worker that started them, so polling must reach the same
+process (sticky sessions, or a single worker for admin endpoints).
+"""
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import Any, Dict, Optional
+import os
+import threading
+import uuid
+
+# Finished jobs kept for polling; the oldest finished job is dropped first
+JOB_RETENTION = int(os.getenv("JOB_RETENTION", "100"))
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    owner: Optional[str] = None  # public_id of the user who started it
+    status: str = "queued"  # queued, running, done, failed
+    progress: Dict[str, Any] = field(default_factory=dict)
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    created_at: datetime = field(default_factory=datetime.utcnow)
+    finished_at: Optional[datetime] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = asdict(self)
+        data["created_at"] = self.created_at.isoformat()
+        data["finished_at"] = self.finished_at.isoformat() if self.finished_at else None
+        return data
+
+
+class JobRegistry:
+    def __init__(self, retention: int = JOB_RETENTION):
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+
+    def create(self, kind: str, owner: Optional[str] = None) -> Job:
+        job = Job(id=uuid.uuid4().hex, kind=kind, owner=owner)
+        with self._lock:
+            self._jobs[job.id] = job
+            finished = [j.id for j in self._jobs.values() if j.finished_at is not None]
+            for job_id in finished[: max(0, len(finished) - self.retention)]:
+                del self._jobs[job_id]
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def start(self, job: Job) -> None:
+        job.status = "running"
+
+    def update(self, job: Job, **progress) -> None:
+        with self._lock:
+            job.progress = {**job.progress, **progress}
+
+    def finish(self, job: Job, result: Dict[str, Any]) -> None:
+        job.result = result
+        job.status = "done"
+        job.finished_at = datetime.utcnow()
+
+    def fail(self, job: Job, error: str) -> None:
+        job.error = error
+        job.status = "failed"
+        job.finished_at = datetime.utcnow()
+
+
+registry = JobRegistry()
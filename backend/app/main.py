@@ -1,9 +1,16 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from .database import engine, get_db
-from . import models
-from .routes import users, auth
+from fastapi.responses import JSONResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from .database import async_engine, engine, get_db
+from . import audit, checkin, images, metrics, pubsub, ratelimit, replicas, startup
+from .auth import token_subject
+from .routes import appeals, attendance, auth, media, notifications, reports, students
+import json
+import logging
 import os
 from dotenv import load_dotenv
 import time
@@ -11,77 +18,143 @@ import time
 # Load environment variables from .env file
 load_dotenv()
 
-# Parse CORS origins from environment variable
-cors_origins = os.getenv("BACKEND_CORS_ORIGINS", "[\"http://localhost:8080\",\"http://localhost:3000\"]")
-try:
-    import json
-    cors_origins = json.loads(cors_origins)
-except:
-    cors_origins = ["http://localhost:8080", "http://localhost:3000"]
-
-# Create database tables
-models.Base.metadata.create_all(bind=engine)
-
-app = FastAPI(title="EduTrack API", description="API for Automated Attendance System", version="1.0.0")
-
-# CORS middleware with improved security using environment variables
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=cors_origins,  # Use origins from environment variable
-    allow_credentials=True,
-    allow_methods=["GET", "POST", "PUT", "DELETE"],  # Restrict to specific methods
-    allow_headers=["Content-Type", "Authorization", "Accept"],  # Restrict to specific headers
-    expose_headers=["Content-Length"],
-    max_age=600,  # Cache preflight requests for 10 minutes
-)
-
-# Simple in-memory rate limiting (per IP, per window)
-RATE_LIMIT_REQUESTS = int(os.getenv("RATE_LIMIT_REQUESTS", "100"))
-RATE_LIMIT_WINDOW_SEC = int(os.getenv("RATE_LIMIT_WINDOW_SEC", "60"))
-_rate_store = {}
-
-@app.middleware("http")
+logger = logging.getLogger(__name__)
+
+API_V1_PREFIX = "/api/v1"
+METRICS_PATH = f"{API_V1_PREFIX}/metrics"
+DEFAULT_CORS_ORIGINS = ["http://localhost:8080", "http://localhost:3000"]
+
+def _request_subject(request: Request):
+    """public_id behind the request's access token, without touching the database"""
+    authorization = request.headers.get("authorization", "")
+    if authorization[:7].lower() == "bearer ":
+        return token_subject(authorization[7:])
+    # EventSource clients (the notification stream) cannot set headers and send ?token= instead
+    token = request.query_params.get("token")
+    return token_subject(token) if token else None
+
+def _cors_origins():
+    # Parse CORS origins from environment variable
+    raw = os.getenv("BACKEND_CORS_ORIGINS", json.dumps(DEFAULT_CORS_ORIGINS))
+    try:
+        return json.loads(raw)
+    except json.JSONDecodeError:
+        logger.warning(f"BACKEND_CORS_ORIGINS is not valid JSON, using {DEFAULT_CORS_ORIGINS}")
+        return DEFAULT_CORS_ORIGINS
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Schema check, pool prefill and cache warm-up happen before the worker takes traffic
+    app.state.startup_timings = await startup.warm_up()
+    await replicas.router.start()
+    # Started up front (not on the first push-stream client) so cross-worker signals are received
+    await pubsub.hub.start()
+    await audit.writer.start()
+    yield
+    # Flush pending check-ins and queued audit events while the engine is still open
+    await checkin.coalescer.stop()
+    await audit.writer.stop()
+    await pubsub.hub.stop()
+    # Let queued images finish so their URLs do not point at nothing
+    await run_in_threadpool(images.shutdown)
+    await replicas.router.stop()
+    await async_engine.dispose()
+    engine.dispose()
+
+def _route_label(request: Request) -> str:
+    # Full route template (e.g. /api/v1/appeals/{appeal_id}/approve) keeps label cardinality bounded.
+    # scope["route"] is the route as declared on its APIRouter, so its path lacks the include
+    # prefix ("/stats"); create_app records the full template of every included route.
+    route = request.scope.get("route")
+    if route is None:
+        return "unmatched"
+    return request.app.state.route_templates.get(id(route)) or getattr(route, "path", None) or "unmatched"
+
 async def error_and_rate_middleware(request: Request, call_next):
+    start = time.perf_counter()
+    sql_tally = [0, 0.0]
+    token = metrics.request_sql.set(sql_tally)
+    metrics.http_in_flight.inc()
+    status_code = 500
+    user = None
     try:
-        # Rate limit
-        ip = request.client.host if request.client else "unknown"
-        now = time.time()
-        window = int(now // RATE_LIMIT_WINDOW_SEC)
-        key = f"{ip}:{window}"
-        count = _rate_store.get(key, 0)
-        if count >= RATE_LIMIT_REQUESTS:
-            return JSONResponse(status_code=429, content={"detail": "Too Many Requests"})
-        _rate_store[key] = count + 1
+        # Rate limit per IP, per user and per route (see ratelimit.py for the rules)
+        if request.url.path != METRICS_PATH:
+            ip = request.client.host if request.client else "unknown"
+            user = _request_subject(request)
+            rejected = ratelimit.limiter.check(request.method, request.url.path, ip, user)
+            if rejected:
+                rule, retry_after = rejected
+                metrics.rate_limit_rejections.inc(rule=rule.name)
+                status_code = 429
+                return JSONResponse(status_code=429, content={"detail": "Too Many Requests"},
+                                    headers={"Retry-After": str(retry_after)})
 
         response = await call_next(request)
+        status_code = response.status_code
+        # Read-your-writes: the user's next reads skip the (possibly lagging) replicas
+        replicas.note_response(request, response, user)
         return response
-    except Exception as exc:
+    except Exception:
+        logger.exception(f"Unhandled error on {request.method} {request.url.path}")
         return JSONResponse(status_code=500, content={"detail": "Internal Server Error"})
+    finally:
+        metrics.request_sql.reset(token)
+        metrics.http_in_flight.dec()
+        route = _route_label(request)
+        elapsed = time.perf_counter() - start
+        metrics.http_requests.inc(method=request.method, route=route, status=status_code)
+        metrics.http_latency.observe(elapsed, method=request.method, route=route)
+        metrics.request_sql_queries.observe(sql_tally[0], route=route)
+        metrics.request_sql_seconds.observe(sql_tally[1], route=route)
 
-# Include routers with API versioning
-API_V1_PREFIX = "/api/v1"
-app.include_router(auth.router, prefix=f"{API_V1_PREFIX}/auth", tags=["Authentication"])
-# users router kept under v1 for consistency if exists
-try:
-    app.include_router(users.router, prefix=f"{API_V1_PREFIX}/users", tags=["Users"])
-except Exception:
-    pass
-
-# Placeholder includes for new route modules if present
-try:
-    from .routes import notifications, reports, attendance, students, appeals
-    app.include_router(attendance.router, prefix=f"{API_V1_PREFIX}/attendance", tags=["Attendance"])
-    app.include_router(notifications.router, prefix=f"{API_V1_PREFIX}/notifications", tags=["Notifications"])
-    app.include_router(reports.router, prefix=f"{API_V1_PREFIX}/reports", tags=["Reports"])
-    app.include_router(students.router, prefix=f"{API_V1_PREFIX}/students", tags=["Students"])
-    app.include_router(appeals.router, prefix=f"{API_V1_PREFIX}/appeals", tags=["Appeals"])
-except Exception:
-    pass
-
-@app.get("/")
-def read_root():
-    return {"message": "Welcome to EduTrack API"}
-
-@app.get(f"{API_V1_PREFIX}/health")
-def health_check(db=Depends(get_db)):
-    return {"status": "healthy", "database": "connected"}
\ No newline at end of file
+def create_app() -> FastAPI:
+    app = FastAPI(title="EduTrack API", description="API for Automated Attendance System", version="1.0.0", lifespan=lifespan)
+
+    # CORS middleware with improved security using environment variables
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=_cors_origins(),  # Use origins from environment variable
+        allow_credentials=True,
+        allow_methods=["GET", "POST", "PUT", "DELETE"],  # Restrict to specific methods
+        allow_headers=["Content-Type", "Authorization", "Accept"],  # Restrict to specific headers
+        expose_headers=["Content-Length"],
+        max_age=600,  # Cache preflight requests for 10 minutes
+    )
+    app.middleware("http")(error_and_rate_middleware)
+
+    # Include routers with API versioning
+    routers = [
+        (auth.router, f"{API_V1_PREFIX}/auth", "Authentication"),
+        (attendance.router, f"{API_V1_PREFIX}/attendance", "Attendance"),
+        (notifications.router, f"{API_V1_PREFIX}/notifications", "Notifications"),
+        (reports.router, f"{API_V1_PREFIX}/reports", "Reports"),
+        (students.router, f"{API_V1_PREFIX}/students", "Students"),
+        (appeals.router, f"{API_V1_PREFIX}/appeals", "Appeals"),
+        # Processed uploads, behind signed links (see images.sign)
+        (media.router, images.MEDIA_URL, "Media"),
+    ]
+    app.state.route_templates = {}
+    for router, prefix, tag in routers:
+        app.include_router(router, prefix=prefix, tags=[tag])
+        # Metric labels: id of the declared route -> prefixed template
+        app.state.route_templates.update({id(route): prefix + route.path for route in router.routes})
+
+    @app.get("/")
+    def read_root():
+        return {"message": "Welcome to EduTrack API"}
+
+    @app.get(METRICS_PATH, include_in_schema=False)
+    def metrics_endpoint():
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+    @app.get(f"{API_V1_PREFIX}/health")
+    async def health_check(request: Request, db: AsyncSession = Depends(get_db)):
+        await db.execute(text("SELECT 1"))
+        return {"status": "healthy", "database": "connected",
+                "startup_seconds": getattr(request.app.state, "startup_timings", {}).get("total")}
+
+    return app
+
+# Module-level app for `uvicorn app.main:app`; `uvicorn --factory app.main:create_app` also works
+app = create_app()
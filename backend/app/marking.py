@@ -0,0 +1,110 @@
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+import logging
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from . import models, rollups
+
+logger = logging.getLogger(__name__)
+
+VALID_STATUSES = ("present", "late", "absent")
+VALID_METHODS = ("QR", "face", "manual")
+
+
+def resolve_public_ids(db: Session, public_ids: Iterable[str]) -> Dict[str, int]:
+    """Map user public ids to primary keys with a single IN query"""
+    wanted = {pid for pid in public_ids if pid}
+    if not wanted:
+        return {}
+    rows = db.execute(
+        select(models.User.public_id, models.User.id).where(models.User.public_id.in_(wanted))
+    )
+    return {public_id: user_id for public_id, user_id in rows}
+
+
+def _existing_user_ids(db: Session, session_id: str, user_ids: Iterable[int]) -> set:
+    wanted = set(user_ids)
+    if not wanted:
+        return set()
+    rows = db.execute(
+        select(models.AttendanceRecord.user_id).where(
+            models.AttendanceRecord.session_id == session_id,
+            models.AttendanceRecord.user_id.in_(wanted),
+        )
+    )
+    return {user_id for (user_id,) in rows}
+
+
+def _plan_marks(db: Session, session_id: str, marks: List[Dict[str, Any]], type: str, timestamp: datetime):
+    existing = _existing_user_ids(db, session_id, (m.get("user_id") for m in marks if m.get("user_id")))
+    results: List[Dict[str, Any]] = []
+    rows: List[Dict[str, Any]] = []
+    seen = set()
+    for mark in marks:
+        user_id = mark.get("user_id")
+        status = mark.get("status") or "present"
+        method = mark.get("method") or "manual"
+        if user_id is None:
+            results.append({"result": "error", "detail": "Unknown user"})
+            continue
+        if status not in VALID_STATUSES:
+            results.append({"result": "error", "detail": f"Invalid status '{status}'"})
+            continue
+        if method not in VALID_METHODS:
+            results.append({"result": "error", "detail": f"Invalid method '{method}'"})
+            continue
+        if user_id in existing or user_id in seen:
+            results.append({"result": "duplicate"})
+            continue
+        seen.add(user_id)
+        rows.append({
+            "user_id": user_id,
+            "session_id": session_id,
+            "timestamp": timestamp,
+            "type": type,
+            "method": method,
+            "status": status,
+            "confidence_score": mark.get("confidence_score"),
+            "location": mark.get("location"),
+            "capture_image_url": mark.get("capture_image_url"),
+        })
+        results.append({"result": "created"})
+    return rows, results
+
+
+def record_marks(
+    db: Session,
+    session_id: str,
+    marks: List[Dict[str, Any]],
+    type: str = "lecture",
+    timestamp: Optional[datetime] = None,
+) -> List[Dict[str, Any]]:
+    """Store a batch of marks for one session with a single multi-row INSERT.
+
+    Each mark is a dict with ``user_id`` (primary key, ``None`` if it could not be
+    resolved), ``status``, ``method`` and optional ``confidence_score``, ``location``
+    and ``capture_image_url``. Marks for users that already have a record in the
+    session are reported as duplicates, so replaying a batch is harmless. The
+    attendance rollups are updated in the same transaction.
+    Returns one result dict per mark, in input order. The caller commits.
+    """
+    timestamp = timestamp or datetime.utcnow()
+    for attempt in range(2):
+        rows, results = _plan_marks(db, session_id, marks, type, timestamp)
+        if not rows:
+            return results
+        try:
+            with db.begin_nested():
+                db.execute(insert(models.AttendanceRecord), rows)
+                rollups.add_records(db, rows)
+            return results
+        except IntegrityError:
+            # A concurrent batch for the same session won the race; re-plan so its
+            # rows are reported as duplicates instead of failing the whole batch.
+            if attempt:
+                raise
+            logger.warning("Concurrent roll-call for session %s, retrying", session_id)
+    return results
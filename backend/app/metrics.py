@@ -0,0 +1,206 @@
+"""Minimal in-process metrics with Prometheus text exposition.
+
+Metrics are per worker process; scrape every worker (or aggregate upstream)
+when running several uvicorn workers.
+"""
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import threading
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+
+_registry: List["_Metric"] = []
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """Gauge that is either set explicitly or read from ``fn`` at scrape time.
+
+    ``fn`` returns a number, or a mapping of label-value tuples to numbers for
+    labelled gauges.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=(), fn: Optional[Callable[[], float]] = None):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self):
+        if self.fn is not None:
+            try:
+                value = self.fn()
+            except Exception:
+                return []
+            items = list(value.items()) if isinstance(value, dict) else [((), value)]
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # key -> [per-bucket counts..., sum, count]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def _samples(self):
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        lines = []
+        for key, state in items:
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {_format_value(cumulative)}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {_format_value(state[-1])}")
+        return lines
+
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Shared metrics ----------------------------------------------------------------
+
+http_requests = Counter("edutrack_http_requests_total", "HTTP requests by route, method and status", ("method", "route", "status"))
+http_latency = Histogram("edutrack_http_request_duration_seconds", "HTTP request latency by route", ("method", "route"))
+http_in_flight = Gauge("edutrack_http_requests_in_flight", "HTTP requests currently being served")
+
+sql_queries = Counter("edutrack_sql_queries_total", "SQL statements executed")
+sql_latency = Histogram("edutrack_sql_query_duration_seconds", "SQL statement latency")
+request_sql_queries = Histogram("edutrack_request_sql_queries", "SQL statements issued per request", ("route",), buckets=COUNT_BUCKETS)
+request_sql_seconds = Histogram("edutrack_request_sql_duration_seconds", "Time spent in SQL per request", ("route",))
+
+pool_wait = Histogram("edutrack_db_pool_wait_seconds", "Time spent waiting for a pooled connection",
+                      buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0))
+pool_timeouts = Counter("edutrack_db_pool_timeouts_total", "Connection checkouts that hit pool_timeout")
+db_reads = Counter("edutrack_db_read_sessions_total", "Read-only request sessions by target database and reason", ("target", "reason"))
+
+rate_limit_rejections = Counter("edutrack_rate_limit_rejections_total", "Requests rejected by the rate limiter", ("rule",))
+
+password_hash_latency = Histogram("edutrack_password_hash_duration_seconds", "bcrypt hash/verify time on the worker pool", ("op",),
+                                  buckets=(0.01, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.5))
+password_hash_wait = Histogram("edutrack_password_hash_wait_seconds", "Time a hash/verify call waited for a free worker")
+password_hash_rejections = Counter("edutrack_password_hash_rejections_total", "Hash/verify calls rejected because the queue was full")
+
+pubsub_published = Counter("edutrack_pubsub_published_total", "Events published to the notification hub")
+pubsub_delivered = Counter("edutrack_pubsub_delivered_total", "Events queued for a connected push-stream client")
+pubsub_dropped = Counter("edutrack_pubsub_dropped_total", "Events dropped because a push-stream client fell behind")
+pubsub_reconnects = Counter("edutrack_pubsub_reconnects_total", "Times the pub/sub listener connection was re-established")
+
+qr_checkins = Counter("edutrack_qr_checkins_total", "QR check-ins by result (created, duplicate, cached_duplicate, invalid)", ("result",))
+qr_batch_size = Histogram("edutrack_qr_batch_size", "QR check-ins written per coalesced batch", buckets=COUNT_BUCKETS + (500, 1000))
+
+image_uploads = Counter("edutrack_image_uploads_total", "Image uploads by result (queued, duplicate, failed)", ("result",))
+image_processing_seconds = Histogram("edutrack_image_processing_seconds", "Decode and resize time of one image in the process pool")
+image_queue_seconds = Histogram("edutrack_image_queue_wait_seconds", "Time an image waited for a free pool process")
+
+audit_events = Counter("edutrack_audit_events_total", "Audit events by outcome (written, dropped, failed)", ("outcome",))
+audit_flush_seconds = Histogram("edutrack_audit_flush_duration_seconds", "Time to write one batch of audit events")
+
+# Per-request SQL tally: [statements, seconds]; set by the HTTP middleware
+request_sql: ContextVar[Optional[List[float]]] = ContextVar("request_sql", default=None)
+
+
+def record_sql(duration: float) -> None:
+    sql_queries.inc()
+    sql_latency.observe(duration)
+    tally = request_sql.get()
+    if tally is not None:
+        tally[0] += 1
+        tally[1] += duration
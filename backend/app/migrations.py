@@ -0,0 +1,75 @@
+"""Additive schema upgrades for databases created from older models.
+
+``create_all`` only creates tables that do not exist yet; columns and indexes
+added to an existing table never reach the database that way. ``upgrade``
+reflects the live schema and applies what models.py declares but the database
+lacks: missing tables (through create_all), then ``ALTER TABLE ... ADD
+COLUMN`` for missing columns, then ``CREATE INDEX`` for missing indexes.
+
+Only additions are handled. A new column must be nullable or have a server
+default, since existing rows need a value; type changes, renames and drops are
+left to a hand-written migration, and ``missing`` keeps reporting anything
+``upgrade`` could not apply.
+"""
+from typing import List, Tuple
+import logging
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+# (kind, table, name) with kind one of "table", "column", "index"
+Missing = Tuple[str, str, str]
+
+
+def missing(conn) -> List[Missing]:
+    """Tables, columns and indexes declared in models.py that the database lacks"""
+    insp = inspect(conn)
+    existing = set(insp.get_table_names())
+    result: List[Missing] = []
+    for table in models.Base.metadata.sorted_tables:
+        if table.name not in existing:
+            result.append(("table", table.name, table.name))
+            continue
+        columns = {c["name"] for c in insp.get_columns(table.name)}
+        result.extend(("column", table.name, c.name) for c in table.columns if c.name not in columns)
+        indexes = {i["name"] for i in insp.get_indexes(table.name)}
+        indexes |= {u["name"] for u in insp.get_unique_constraints(table.name)}
+        result.extend(("index", table.name, i.name) for i in sorted(table.indexes, key=lambda i: i.name) if i.name not in indexes)
+    return result
+
+
+def describe(items: List[Missing]) -> str:
+    return ", ".join(f"{kind} {table}.{name}" if kind != "table" else f"table {table}" for kind, table, name in items)
+
+
+def upgrade(conn) -> List[Missing]:
+    """Create what ``missing`` reports; returns what was applied. The caller commits.
+
+    Raises RuntimeError for a missing column that cannot be added to a table
+    with rows (NOT NULL without a server default).
+    """
+    todo = missing(conn)
+    if not todo:
+        return []
+    metadata = models.Base.metadata
+    if any(kind == "table" for kind, _, _ in todo):
+        metadata.create_all(bind=conn)
+    preparer = conn.dialect.identifier_preparer
+    for kind, table_name, name in todo:
+        if kind != "column":
+            continue
+        column = metadata.tables[table_name].c[name]
+        if not column.nullable and column.server_default is None:
+            raise RuntimeError(f"Column {table_name}.{name} is NOT NULL without a server default; add it with a manual migration")
+        ddl = CreateColumn(column).compile(dialect=conn.dialect)
+        conn.execute(text(f"ALTER TABLE {preparer.format_table(metadata.tables[table_name])} ADD COLUMN {ddl}"))
+    for kind, table_name, name in todo:
+        if kind == "index":
+            index = next(i for i in metadata.tables[table_name].indexes if i.name == name)
+            index.create(bind=conn)
+    logger.info(f"Schema upgraded: {describe(todo)}")
+    return todo
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Float, JSON, ForeignKey, Index, Text
+from sqlalchemy import Column, Integer, String, Boolean, Date, DateTime, Float, JSON, ForeignKey, Index, Text, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -18,7 +18,9 @@ class User(Base):
     name = Column(String(255), nullable=False)  # Changed from full_name to match auth implementation
     password = Column(String(255), nullable=False)  # Changed from hashed_password to match auth implementation
     role = Column(String(50), default="student", nullable=False)  # student, teacher, admin
+    class_code = Column(String(50), nullable=True)  # class/section a student is enrolled in
     face_encoding = Column(JSON, nullable=True)  # Store facial encoding
+    face_encoding_blob = Column(LargeBinary, nullable=True)  # Same encoding packed as little-endian float32
     profile_image_url = Column(String(500), nullable=True)
     is_active = Column(Boolean, default=True, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
@@ -37,6 +39,7 @@ class User(Base):
         Index('idx_user_email', email),
         Index('idx_user_public_id', public_id),
         Index('idx_user_role', role),
+        Index('idx_user_class_code', class_code),
     )
 
 class UserProfile(Base):
@@ -62,6 +65,7 @@ class AttendanceRecord(Base):
     location = Column(String(255), nullable=True)
     capture_image_url = Column(String(500), nullable=True)
     status = Column(String(50), default="present", nullable=False)  # present, late, absent
+    session_id = Column(String(64), nullable=True)  # lecture/roll-call session the mark belongs to
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
     
@@ -71,7 +75,36 @@ class AttendanceRecord(Base):
     # Indexes for common queries
     __table_args__ = (
         Index('idx_attendance_user_timestamp', user_id, timestamp),
+        Index('idx_attendance_timestamp_id', timestamp, id),
         Index('idx_attendance_status', status),
+        Index('idx_attendance_user_session', user_id, session_id, unique=True),
+    )
+
+class AttendanceCounter(Base):
+    """Per-user, per-status record counts maintained alongside attendance_records"""
+    __tablename__ = "attendance_counters"
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    status = Column(String(50), primary_key=True)
+    count = Column(Integer, default=0, nullable=False)
+
+class AttendanceDaily(Base):
+    """Per-user attendance counts for one day and status"""
+    __tablename__ = "attendance_daily"
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    status = Column(String(50), primary_key=True)
+    count = Column(Integer, default=0, nullable=False)
+
+class AttendanceClassDaily(Base):
+    """Per-class attendance counts for one day and status ('' for students without a class)"""
+    __tablename__ = "attendance_class_daily"
+    class_code = Column(String(50), primary_key=True)
+    day = Column(Date, primary_key=True)
+    status = Column(String(50), primary_key=True)
+    count = Column(Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        Index('idx_class_daily_day', day),
     )
 
 class Notification(Base):
@@ -85,6 +118,11 @@ class Notification(Base):
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     user = relationship("User", back_populates="notifications")
 
+    __table_args__ = (
+        Index('idx_notification_user_read', user_id, is_read),
+        Index('idx_notification_user_created', user_id, created_at, id),
+    )
+
 class Appeal(Base):
     __tablename__ = "appeals"
     id = Column(Integer, primary_key=True)
@@ -96,6 +134,13 @@ class Appeal(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
     user = relationship("User", back_populates="appeals")
 
+    # Keyset pagination: institution-wide, per student, and per status
+    __table_args__ = (
+        Index('idx_appeal_created', created_at, id),
+        Index('idx_appeal_user_created', user_id, created_at, id),
+        Index('idx_appeal_status_created', status, created_at, id),
+    )
+
 class Log(Base):
     __tablename__ = "logs"
     id = Column(Integer, primary_key=True)
@@ -113,4 +158,33 @@ class PasswordReset(Base):
     expires_at = Column(DateTime, nullable=False)
     used = Column(Boolean, default=False, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
-    user = relationship("User", back_populates="password_resets")
\ No newline at end of file
+    user = relationship("User", back_populates="password_resets")
+
+class AcademicTerm(Base):
+    """A teaching term; attendance percentages and defaulter lists are computed per term"""
+    __tablename__ = "academic_terms"
+    id = Column(Integer, primary_key=True)
+    name = Column(String(100), unique=True, nullable=False)
+    start_date = Column(Date, nullable=False)
+    end_date = Column(Date, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        Index('idx_term_dates', start_date, end_date),
+    )
+
+class AttendanceArchive(Base):
+    """Attendance records of a closed term moved to a compressed file (see archive.py)"""
+    __tablename__ = "attendance_archives"
+    term_id = Column(Integer, ForeignKey("academic_terms.id", ondelete="CASCADE"), primary_key=True)
+    path = Column(String(500), nullable=False)  # relative to ARCHIVE_DIR
+    start = Column(DateTime, nullable=False)  # records with start <= timestamp < end were moved
+    end = Column(DateTime, nullable=False)
+    records = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+class SchemaVersion(Base):
+    """Fingerprint of the schema the database was last created from (see startup.ensure_schema)"""
+    __tablename__ = "schema_version"
+    version = Column(String(64), primary_key=True)
+    applied_at = Column(DateTime, default=datetime.utcnow, nullable=False)
@@ -0,0 +1,55 @@
+from datetime import datetime
+from typing import Optional, Sequence
+
+from sqlalchemy import Boolean, DateTime, String, Text, insert, literal, select
+from sqlalchemy.orm import Session
+
+from . import models
+
+
+def audience_query(
+    role: Optional[str] = None,
+    user_public_ids: Optional[Sequence[str]] = None,
+    class_code: Optional[str] = None,
+):
+    """SELECT of active user ids matching every given filter"""
+    u = models.User
+    q = select(u.id).where(u.is_active == True)
+    if role:
+        q = q.where(u.role == role)
+    if user_public_ids is not None:
+        q = q.where(u.public_id.in_(set(user_public_ids)))
+    if class_code:
+        q = q.where(u.class_code == class_code)
+    return q
+
+
+def broadcast(
+    db: Session,
+    title: str,
+    message: str,
+    type: str = "info",
+    role: Optional[str] = None,
+    user_public_ids: Optional[Sequence[str]] = None,
+    class_code: Optional[str] = None,
+    created_at: Optional[datetime] = None,
+) -> int:
+    """Create one notification per matching user with a single INSERT .. SELECT.
+
+    The recipients never leave the database, so cost and memory stay flat however
+    large the audience. Returns the number of rows written. The caller commits.
+    """
+    created_at = created_at or datetime.utcnow()
+    audience = audience_query(role, user_public_ids, class_code).add_columns(
+        literal(title, String),
+        literal(message, Text),
+        literal(type, String),
+        literal(False, Boolean),
+        literal(created_at, DateTime),
+    )
+    result = db.execute(
+        insert(models.Notification).from_select(
+            ["user_id", "title", "message", "type", "is_read", "created_at"], audience
+        )
+    )
+    return result.rowcount
@@ -0,0 +1,51 @@
+"""Keyset (cursor) pagination over a (timestamp, id) ordering, newest first.
+
+A page is fetched with ``WHERE (ts, id) < (:ts, :id) ORDER BY ts DESC, id DESC
+LIMIT n``, which walks a (…, ts, id) index from the cursor position, so every
+page costs the same however deep the client has scrolled.
+"""
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import base64
+
+from fastapi import HTTPException, status
+from sqlalchemy import tuple_
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(ts: datetime, id: int) -> str:
+    return base64.urlsafe_b64encode(f"{ts.isoformat()}|{id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        ts, id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(ts), int(id)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def paginate(query, ts_column, id_column, cursor: Optional[str], limit: int):
+    """Apply the cursor, newest-first order and ``limit + 1`` (to detect a next page)"""
+    if cursor:
+        ts, id = decode_cursor(cursor)
+        query = query.where(tuple_(ts_column, id_column) < tuple_(ts, id))
+    return query.order_by(ts_column.desc(), id_column.desc()).limit(limit + 1)
+
+
+def page(rows: List[Any], limit: int, key: Callable[[Any], Tuple[datetime, int]],
+         serialize: Callable[[Any], Dict[str, Any]] = dict) -> Dict[str, Any]:
+    """Build ``{"items": [...], "next_cursor": ...}`` from the ``limit + 1`` rows fetched.
+
+    The default ``serialize`` suits row mappings (``result.mappings()``) whose
+    labels are already the response field names.
+    """
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "items": [serialize(r) for r in rows],
+        "next_cursor": encode_cursor(*key(rows[-1])) if more else None,
+    }
@@ -0,0 +1,85 @@
+"""Password hashing off the event loop.
+
+bcrypt spends a fixed, deliberately large amount of CPU per call (~200 ms at
+cost 12). The async helpers here run it on a dedicated thread pool -- the
+bcrypt C extension releases the GIL, so the threads hash in parallel -- and
+cap how many calls may be waiting, so a sign-in storm gets a fast 503 instead
+of an ever-growing backlog.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# bcrypt cost factor; hashes made with any other cost are upgraded on the next login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(8, os.cpu_count() or 1))))
+# Calls allowed to wait for a worker before new ones are rejected with 503
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", "256"))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+_pending = 0
+_pending_lock = threading.Lock()
+
+metrics.Gauge("edutrack_password_hash_pending", "Password hash/verify calls queued or running", fn=lambda: _pending)
+
+
+async def _submit(op: str, fn, *args):
+    global _pending
+    with _pending_lock:
+        if _pending >= PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE:
+            metrics.password_hash_rejections.inc()
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many sign-in requests, please retry shortly",
+                headers={"Retry-After": "1"},
+            )
+        _pending += 1
+    queued = time.perf_counter()
+
+    def run():
+        started = time.perf_counter()
+        metrics.password_hash_wait.observe(started - queued)
+        try:
+            return fn(*args)
+        finally:
+            metrics.password_hash_latency.observe(time.perf_counter() - started, op=op)
+
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, run)
+    finally:
+        with _pending_lock:
+            _pending -= 1
+
+
+async def hash_password_async(password: str) -> str:
+    return await _submit("hash", pwd_context.hash, password)
+
+
+async def verify_password_async(password: str, hashed: Optional[str]) -> Tuple[bool, Optional[str]]:
+    """Check ``password`` against ``hashed`` on the pool.
+
+    Returns ``(ok, new_hash)``; ``new_hash`` is set when the stored hash used a
+    different bcrypt cost (or scheme) and should be replaced.
+    """
+    if not hashed:
+        return False, None
+    return await _submit("verify", pwd_context.verify_and_update, password, hashed)
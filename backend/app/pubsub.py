@@ -0,0 +1,364 @@
+"""In-process pub/sub hub feeding the notification push stream.
+
+Publishers hand the hub an event plus its audience (the same role /
+user_public_ids / class_code filters as notify.broadcast). The hub passes it
+through a backend so every worker sees it, and each worker delivers it to its
+own matching subscribers straight from memory -- an idle connected client costs
+one queue and no database work.
+
+Backends (PUBSUB_BACKEND):
+
+* ``local`` - events stay in this process. Right for a single worker, and the
+  stand-in for tests and development.
+* ``postgres`` - LISTEN/NOTIFY on the primary database (asyncpg), so all
+  workers and hosts share events without another service.
+
+The same channel carries internal signals between workers (``signal`` /
+``on_signal``), e.g. "attendance changed, your cached bitmaps are stale". A
+worker never receives its own signals.
+"""
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set
+import asyncio
+import itertools
+import json
+import logging
+import os
+import uuid
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+PUBSUB_BACKEND = os.getenv("PUBSUB_BACKEND", "local")
+PUBSUB_CHANNEL = os.getenv("PUBSUB_CHANNEL", "edutrack_events")
+# Events waiting for a slow client; older ones are dropped beyond this
+SUBSCRIBER_QUEUE_SIZE = int(os.getenv("SUBSCRIBER_QUEUE_SIZE", "100"))
+PUBSUB_KEEPALIVE_SEC = float(os.getenv("PUBSUB_KEEPALIVE_SEC", "30"))
+PUBSUB_RECONNECT_MIN_SEC = float(os.getenv("PUBSUB_RECONNECT_MIN_SEC", "1"))
+PUBSUB_RECONNECT_MAX_SEC = float(os.getenv("PUBSUB_RECONNECT_MAX_SEC", "30"))
+# NOTIFY payloads are capped at 8000 bytes
+_MAX_NOTIFY_PAYLOAD = 7900
+# Identifies this worker's own signals when the backend echoes them back
+_ORIGIN = uuid.uuid4().hex
+
+
+@dataclass(eq=False)
+class Subscriber:
+    public_id: str
+    role: str
+    class_code: Optional[str]
+    queue: asyncio.Queue
+    loop: asyncio.AbstractEventLoop
+    id: int = 0
+    dropped: int = 0
+
+
+@dataclass
+class Audience:
+    role: Optional[str] = None
+    user_public_ids: Optional[Sequence[str]] = None
+    class_code: Optional[str] = None
+
+    def matches(self, sub: Subscriber) -> bool:
+        return (
+            (not self.role or sub.role == self.role)
+            and (self.user_public_ids is None or sub.public_id in self.user_public_ids)
+            and (not self.class_code or sub.class_code == self.class_code)
+        )
+
+
+class LocalBackend:
+    """Delivers straight back to this process's hub"""
+
+    async def start(self, deliver: Callable[[Dict[str, Any]], None]) -> None:
+        self._deliver = deliver
+
+    async def publish(self, message: Dict[str, Any]) -> None:
+        self._deliver(message)
+
+    async def stop(self) -> None:
+        pass
+
+
+def _size(message: Dict[str, Any]) -> int:
+    return len(json.dumps(message, default=str).encode())
+
+
+def _payloads(message: Dict[str, Any]) -> List[str]:
+    """NOTIFY payloads for ``message``, each under _MAX_NOTIFY_PAYLOAD.
+
+    An oversized event loses its message text first (clients re-read it from
+    the list endpoint); if a long recipient list still does not fit, the event
+    goes out once per slice of recipients. Raises ValueError if even that fails.
+    """
+    if _size(message) <= _MAX_NOTIFY_PAYLOAD:
+        return [json.dumps(message, default=str)]
+    if "event" not in message:
+        raise ValueError(f"signal {message.get('signal')} exceeds {_MAX_NOTIFY_PAYLOAD} bytes")
+    message = {**message, "event": {**message["event"], "message": None, "truncated": True}}
+    if _size(message) <= _MAX_NOTIFY_PAYLOAD:
+        return [json.dumps(message, default=str)]
+    ids = message["audience"].get("user_public_ids")
+    if not ids:
+        raise ValueError(f"event exceeds {_MAX_NOTIFY_PAYLOAD} bytes even without its message")
+    room = _MAX_NOTIFY_PAYLOAD - _size({**message, "audience": {**message["audience"], "user_public_ids": []}})
+    slices, part, used = [], [], 0
+    for public_id in ids:
+        cost = len(json.dumps(public_id).encode()) + 2  # quotes are counted; plus ", "
+        if part and used + cost > room:
+            slices.append(part)
+            part, used = [], 0
+        part.append(public_id)
+        used += cost
+    slices.append(part)
+    return [json.dumps({**message, "audience": {**message["audience"], "user_public_ids": part}}, default=str) for part in slices]
+
+
+class PostgresBackend:
+    """LISTEN/NOTIFY over a dedicated asyncpg connection.
+
+    A background task pings the connection every PUBSUB_KEEPALIVE_SEC and, once
+    it is gone, reconnects with exponential backoff up to
+    PUBSUB_RECONNECT_MAX_SEC. Events sent while this worker is disconnected
+    do not reach it; clients catch up from the notification list.
+    """
+
+    def __init__(self, dsn: str, channel: str = PUBSUB_CHANNEL):
+        self.dsn = dsn
+        self.channel = channel
+        self._conn = None
+        self._lost: Optional[asyncio.Event] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, deliver: Callable[[Dict[str, Any]], None]) -> None:
+        self._deliver = deliver
+        self._lock = asyncio.Lock()
+        await self._connect()
+        self._task = asyncio.create_task(self._watch(), name="pubsub-listener")
+
+    async def _connect(self) -> None:
+        import asyncpg
+
+        conn = await asyncpg.connect(self.dsn)
+        lost = asyncio.Event()
+        conn.add_termination_listener(lambda _: lost.set())
+        await conn.add_listener(self.channel, self._on_notify)
+        self._conn, self._lost = conn, lost
+
+    def _on_notify(self, conn, pid, channel, payload) -> None:
+        self._deliver(json.loads(payload))
+
+    async def _alive(self) -> bool:
+        try:
+            await asyncio.wait_for(self._lost.wait(), timeout=PUBSUB_KEEPALIVE_SEC)
+            return False
+        except asyncio.TimeoutError:
+            pass
+        try:
+            # Catches connections that died without closing, e.g. behind a dropped NAT entry
+            async with self._lock:
+                await asyncio.wait_for(self._conn.execute("SELECT 1"), timeout=PUBSUB_KEEPALIVE_SEC)
+            return True
+        except Exception as e:
+            logger.warning(f"Pub/sub listener connection failed its keep-alive: {e}")
+            return False
+
+    async def _watch(self) -> None:
+        while True:
+            if await self._alive():
+                continue
+            logger.warning("Pub/sub listener connection lost, reconnecting")
+            self._conn.terminate()
+            delay = PUBSUB_RECONNECT_MIN_SEC
+            while True:
+                try:
+                    await self._connect()
+                    break
+                except Exception as e:
+                    logger.warning(f"Pub/sub reconnect failed, retrying in {delay:g}s: {e}")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, PUBSUB_RECONNECT_MAX_SEC)
+            metrics.pubsub_reconnects.inc()
+            logger.info("Pub/sub listener reconnected")
+
+    async def publish(self, message: Dict[str, Any]) -> None:
+        import asyncpg
+
+        try:
+            async with self._lock:
+                for payload in _payloads(message):
+                    await self._conn.execute("SELECT pg_notify($1, $2)", self.channel, payload)
+        except (asyncpg.InterfaceError, OSError) as e:
+            # The data is already committed; only the live push is lost
+            self._lost.set()
+            logger.warning(f"Pub/sub event not sent, connection lost: {e}")
+        except (asyncpg.PostgresError, ValueError) as e:
+            logger.warning(f"Pub/sub event not sent: {e}")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+
+def _make_backend(name: str):
+    if name == "postgres":
+        from .database import SQLALCHEMY_DATABASE_URL
+
+        # asyncpg takes a plain libpq URL
+        scheme, sep, rest = SQLALCHEMY_DATABASE_URL.partition("://")
+        return PostgresBackend("postgresql" + sep + rest)
+    return LocalBackend()
+
+
+class Hub:
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else _make_backend(PUBSUB_BACKEND)
+        self._ids = itertools.count(1)
+        self._subscribers: Dict[int, Subscriber] = {}
+        # Indexes so a targeted event only visits candidate subscribers
+        self._by_user: Dict[str, Set[int]] = {}
+        self._by_role: Dict[str, Set[int]] = {}
+        self._by_class: Dict[str, Set[int]] = {}
+        self._started = False
+        self._start_lock: Optional[asyncio.Lock] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._handlers: Dict[str, List[Callable[[Dict[str, Any]], None]]] = {}
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    async def start(self) -> None:
+        if self._started:
+            return
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if not self._started:
+                await self.backend.start(self._deliver)
+                self._loop = asyncio.get_running_loop()
+                self._started = True
+
+    async def stop(self) -> None:
+        if self._started:
+            await self.backend.stop()
+            self._started = False
+
+    async def subscribe(self, public_id: str, role: str, class_code: Optional[str]) -> Subscriber:
+        await self.start()
+        sub = Subscriber(public_id, role, class_code, asyncio.Queue(SUBSCRIBER_QUEUE_SIZE), asyncio.get_running_loop())
+        sub.id = next(self._ids)
+        self._subscribers[sub.id] = sub
+        self._by_user.setdefault(public_id, set()).add(sub.id)
+        self._by_role.setdefault(role, set()).add(sub.id)
+        if class_code:
+            self._by_class.setdefault(class_code, set()).add(sub.id)
+        return sub
+
+    def unsubscribe(self, sub: Subscriber) -> None:
+        if self._subscribers.pop(sub.id, None) is None:
+            return
+        for index, key in ((self._by_user, sub.public_id), (self._by_role, sub.role), (self._by_class, sub.class_code)):
+            ids = index.get(key)
+            if ids is not None:
+                ids.discard(sub.id)
+                if not ids:
+                    del index[key]
+
+    async def publish(self, event: Dict[str, Any], audience: Audience) -> None:
+        """Send ``event`` to every subscriber (in any worker) matching ``audience``"""
+        await self.start()
+        metrics.pubsub_published.inc()
+        await self.backend.publish({
+            "event": event,
+            "audience": {
+                "role": audience.role,
+                "user_public_ids": list(audience.user_public_ids) if audience.user_public_ids is not None else None,
+                "class_code": audience.class_code,
+            },
+        })
+
+    def on_signal(self, name: str, handler: Callable[[Dict[str, Any]], None]) -> None:
+        """Call ``handler(data)`` when another worker sends signal ``name``"""
+        self._handlers.setdefault(name, []).append(handler)
+
+    async def signal(self, name: str, data: Dict[str, Any]) -> None:
+        await self.start()
+        await self.backend.publish({"signal": name, "origin": _ORIGIN, "data": data})
+
+    def signal_threadsafe(self, name: str, data: Dict[str, Any]) -> None:
+        """Send a signal from synchronous code in any thread; a no-op until the hub runs (CLI, scripts)"""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+
+        loop.call_soon_threadsafe(lambda: loop.create_task(self._try_signal(name, data)))
+
+    async def _try_signal(self, name: str, data: Dict[str, Any]) -> None:
+        try:
+            await self.signal(name, data)
+        except Exception as e:
+            logger.warning(f"Could not send signal {name}: {e}")
+
+    def _candidates(self, audience: Audience) -> Set[int]:
+        if audience.user_public_ids is not None:
+            ids: Set[int] = set()
+            for public_id in audience.user_public_ids:
+                ids |= self._by_user.get(public_id, set())
+            return ids
+        if audience.class_code:
+            return set(self._by_class.get(audience.class_code, ()))
+        if audience.role:
+            return set(self._by_role.get(audience.role, ()))
+        return set(self._subscribers)
+
+    def _deliver(self, message: Dict[str, Any]) -> None:
+        if "signal" in message:
+            if message.get("origin") != _ORIGIN:
+                for handler in self._handlers.get(message["signal"], ()):
+                    try:
+                        handler(message.get("data") or {})
+                    except Exception:
+                        logger.exception(f"Signal handler for {message['signal']} failed")
+            return
+        raw = message["audience"]
+        audience = Audience(raw.get("role"), raw.get("user_public_ids"), raw.get("class_code"))
+        if audience.user_public_ids is not None:
+            audience.user_public_ids = set(audience.user_public_ids)
+        event = message["event"]
+        for sub_id in self._candidates(audience):
+            sub = self._subscribers.get(sub_id)
+            if sub is None or not audience.matches(sub):
+                continue
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is sub.loop:
+                self._offer(sub, event)
+            else:
+                sub.loop.call_soon_threadsafe(self._offer, sub, event)
+
+    @staticmethod
+    def _offer(sub: Subscriber, event: Dict[str, Any]) -> None:
+        if sub.queue.full():
+            # Keep the newest events for a client that is not keeping up
+            sub.queue.get_nowait()
+            sub.dropped += 1
+            metrics.pubsub_dropped.inc()
+        sub.queue.put_nowait(event)
+        metrics.pubsub_delivered.inc()
+
+
+hub = Hub()
+
+metrics.Gauge("edutrack_pubsub_subscribers", "Push-stream clients connected to this worker", fn=lambda: len(hub))
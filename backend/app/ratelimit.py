@@ -0,0 +1,217 @@
+"""Sliding-window rate limiting with pluggable counter storage.
+
+Each rule counts requests per key (client IP or authenticated user) using the
+sliding-window-counter approximation: the previous window's count, weighted by
+how much of it still overlaps the sliding window, plus the current window's
+count. Every check is O(1) and keeps three numbers per key.
+
+Backends:
+
+* ``memory`` - per-process LRU dictionary, bounded by RATE_LIMIT_MAX_KEYS and
+  pruned of expired windows as requests arrive.
+* ``shared`` - fixed-size slot table in a memory-mapped file (``/dev/shm`` by
+  default) guarded by ``flock``, so every worker on the host enforces one
+  budget. Memory is fixed at RATE_LIMIT_SHARED_SLOTS * 24 bytes.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+import fcntl
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_REQUESTS = int(os.getenv("RATE_LIMIT_REQUESTS", "100"))
+RATE_LIMIT_WINDOW_SEC = int(os.getenv("RATE_LIMIT_WINDOW_SEC", "60"))
+RATE_LIMIT_USER_REQUESTS = int(os.getenv("RATE_LIMIT_USER_REQUESTS", "300"))
+# Shared by everyone behind one address (a campus NAT), so sized for a lecture hall logging in at once
+RATE_LIMIT_LOGIN_REQUESTS = int(os.getenv("RATE_LIMIT_LOGIN_REQUESTS", "600"))
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+RATE_LIMIT_SHARED_PATH = os.getenv(
+    "RATE_LIMIT_SHARED_PATH",
+    os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "edutrack-ratelimit"),
+)
+RATE_LIMIT_SHARED_SLOTS = int(os.getenv("RATE_LIMIT_SHARED_SLOTS", "65536"))
+# Optional JSON list of rules replacing the defaults, e.g.
+# [{"name": "login", "limit": 10, "window": 60, "key": "ip", "path": "/api/v1/auth/login"}]
+RATE_LIMIT_RULES = os.getenv("RATE_LIMIT_RULES", "")
+
+
+@dataclass(frozen=True)
+class Rule:
+    name: str
+    limit: int
+    window: int
+    key: str = "ip"  # "ip", "anonymous_ip" (only requests without a valid token) or "user"
+    path: str = ""  # path prefix the rule applies to; "" matches everything
+    methods: Tuple[str, ...] = ()
+
+    def matches(self, method: str, path: str) -> bool:
+        return path.startswith(self.path) and (not self.methods or method in self.methods)
+
+
+def _advance(state: Tuple[int, int, int], now: float, window: int) -> Tuple[int, int, int, float]:
+    """Roll (window_index, current, previous) forward to ``now`` and return the estimate"""
+    index = int(now // window)
+    win, curr, prev = state
+    if win != index:
+        prev = curr if win == index - 1 else 0
+        curr = 0
+        win = index
+    elapsed = (now - index * window) / window
+    return win, curr, prev, prev * (1.0 - elapsed) + curr
+
+
+def _retry_after(now: float, window: int) -> int:
+    return max(1, math.ceil(window - (now % window)))
+
+
+class MemoryBackend:
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        # key -> [window_index, current, previous, expires_at]
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def hit(self, key: str, limit: int, window: int, now: float) -> bool:
+        with self._lock:
+            self._prune(now)
+            entry = self._entries.get(key)
+            win, curr, prev, estimate = _advance(tuple(entry[:3]) if entry else (0, 0, 0), now, window)
+            allowed = estimate < limit
+            if allowed:
+                curr += 1
+            # A key is useless once both of its windows have passed
+            self._entries[key] = [win, curr, prev, (win + 2) * window]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+            return allowed
+
+    def _prune(self, now: float, budget: int = 2) -> None:
+        # Least recently used keys sit at the front; drop a couple of expired ones per call
+        for _ in range(budget):
+            if not self._entries:
+                return
+            key, entry = next(iter(self._entries.items()))
+            if entry[3] > now:
+                return
+            del self._entries[key]
+
+
+class SharedMemoryBackend:
+    """Slot table shared by all processes that map the same file.
+
+    Keys are hashed with a process-independent hash into one of a fixed number
+    of slots (short linear probing). A colliding key takes over a slot whose
+    windows have expired, or the first probed slot when none has.
+    """
+
+    SLOT = struct.Struct("<QqII")  # key hash, window index, current, previous
+    PROBES = 4
+
+    def __init__(self, path: str = RATE_LIMIT_SHARED_PATH, slots: int = RATE_LIMIT_SHARED_SLOTS):
+        self.path = path
+        self.slots = slots
+        size = slots * self.SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+
+    def hit(self, key: str, limit: int, window: int, now: float) -> bool:
+        h = self._hash(key)
+        index = int(now // window)
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                offset, state = None, (0, 0, 0)
+                fallback = None
+                for probe in range(self.PROBES):
+                    off = ((h + probe) % self.slots) * self.SLOT.size
+                    slot_hash, win, curr, prev = self.SLOT.unpack_from(self._map, off)
+                    if slot_hash == h:
+                        offset, state = off, (win, curr, prev)
+                        break
+                    if fallback is None and (slot_hash == 0 or win < index - 1):
+                        fallback = off
+                if offset is None:
+                    offset = fallback if fallback is not None else (h % self.slots) * self.SLOT.size
+                win, curr, prev, estimate = _advance(state, now, window)
+                allowed = estimate < limit
+                if allowed:
+                    curr += 1
+                self.SLOT.pack_into(self._map, offset, h, win, curr, prev)
+                return allowed
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+def _default_rules() -> List[Rule]:
+    if RATE_LIMIT_RULES:
+        return [Rule(**{**r, "methods": tuple(r.get("methods", ()))}) for r in json.loads(RATE_LIMIT_RULES)]
+    return [
+        Rule("login", RATE_LIMIT_LOGIN_REQUESTS, RATE_LIMIT_WINDOW_SEC, "ip", "/api/v1/auth/login", ("POST",)),
+        # Signed-in users are limited per user; per-IP budgets would be shared across a whole NAT
+        Rule("ip", RATE_LIMIT_REQUESTS, RATE_LIMIT_WINDOW_SEC, "anonymous_ip"),
+        Rule("user", RATE_LIMIT_USER_REQUESTS, RATE_LIMIT_WINDOW_SEC, "user"),
+    ]
+
+
+def _make_backend(name: str):
+    if name == "shared":
+        try:
+            return SharedMemoryBackend()
+        except OSError as e:
+            logger.warning(f"Shared rate-limit store unavailable ({e}); falling back to per-process memory")
+    return MemoryBackend()
+
+
+class RateLimiter:
+    def __init__(self, rules: Optional[List[Rule]] = None, backend=None):
+        self.rules = rules if rules is not None else _default_rules()
+        self.backend = backend if backend is not None else _make_backend(RATE_LIMIT_BACKEND)
+
+    def check(self, method: str, path: str, ip: str, user: Optional[str], now: Optional[float] = None) -> Optional[Tuple[Rule, int]]:
+        """Count the request against every matching rule.
+
+        Returns ``(rule, retry_after_seconds)`` for the first rule that rejects
+        it, or ``None`` when it is allowed. User rules are skipped for
+        anonymous requests, ``anonymous_ip`` rules for authenticated ones.
+        """
+        now = time.time() if now is None else now
+        for rule in self.rules:
+            if not rule.matches(method, path):
+                continue
+            if rule.key == "user":
+                subject = user
+            elif rule.key == "anonymous_ip":
+                subject = ip if user is None else None
+            else:
+                subject = ip
+            if subject is None:
+                continue
+            if not self.backend.hit(f"{rule.name}:{subject}", rule.limit, rule.window, now):
+                return rule, _retry_after(now, rule.window)
+        return None
+
+
+limiter = RateLimiter()
@@ -0,0 +1,210 @@
+"""Routing of read-only queries to replica databases.
+
+Report, stats, record-list and export handlers take their session from
+``get_read_db`` instead of ``database.get_db``. With REPLICA_DATABASE_URLS
+unset this is the primary, exactly as before. With replicas configured each
+request gets the next healthy replica in turn, so heavy reads stop competing
+with attendance marking for the primary's connections and I/O.
+
+A background task runs ``SELECT 1`` on every replica each
+REPLICA_HEALTH_INTERVAL_SEC; a replica that fails or times out is taken out of
+rotation until a later check succeeds. A replica that cannot hand out a
+connection when a request starts is taken out at once and that request falls
+back to the primary, as does every request while no replica is healthy.
+
+Replicas lag behind the primary, so with REPLICA_READ_YOUR_WRITES a user who
+just changed something reads from the primary for the next REPLICA_STICKY_SEC:
+the worker that served the write remembers the user, and a short-lived cookie
+carries the same hint to the other workers.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+import asyncio
+import itertools
+import logging
+import os
+import threading
+import time
+
+from fastapi import Request, Response
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+
+from . import database, metrics
+from .auth import token_subject
+
+logger = logging.getLogger(__name__)
+
+REPLICA_HEALTH_INTERVAL_SEC = float(os.getenv("REPLICA_HEALTH_INTERVAL_SEC", "5"))
+REPLICA_HEALTH_TIMEOUT_SEC = float(os.getenv("REPLICA_HEALTH_TIMEOUT_SEC", "2"))
+REPLICA_READ_YOUR_WRITES = os.getenv("REPLICA_READ_YOUR_WRITES", "true").lower() == "true"
+# Should comfortably exceed the usual replication lag
+REPLICA_STICKY_SEC = float(os.getenv("REPLICA_STICKY_SEC", "5"))
+STICKY_COOKIE = "edutrack_read_primary"
+STICKY_MAX_USERS = 100000
+
+_SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+@dataclass(eq=False)
+class Replica:
+    name: str
+    engine: AsyncEngine
+    sessionmaker: async_sessionmaker
+    healthy: bool = True
+
+
+class ReplicaRouter:
+    def __init__(self, engines: Dict[str, AsyncEngine]):
+        self.replicas = [
+            Replica(name, engine, async_sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False))
+            for name, engine in engines.items()
+        ]
+        self._turn = itertools.count()
+        self._task: Optional[asyncio.Task] = None
+        self._lock = threading.Lock()
+        # public_id -> monotonic time until which the user reads from the primary
+        self._writers: "OrderedDict[str, float]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.replicas)
+
+    def healthy(self) -> List[Replica]:
+        return [r for r in self.replicas if r.healthy]
+
+    def pick(self) -> Optional[Replica]:
+        """Next healthy replica in round-robin order, or None"""
+        healthy = self.healthy()
+        return healthy[next(self._turn) % len(healthy)] if healthy else None
+
+    def mark_down(self, replica: Replica, error: object) -> None:
+        if replica.healthy:
+            logger.warning(f"Read replica {replica.name} taken out of rotation: {error}")
+        replica.healthy = False
+
+    def mark_up(self, replica: Replica) -> None:
+        if not replica.healthy:
+            logger.info(f"Read replica {replica.name} back in rotation")
+        replica.healthy = True
+
+    def note_write(self, user: Optional[str]) -> None:
+        if user is None:
+            return
+        with self._lock:
+            self._writers[user] = time.monotonic() + REPLICA_STICKY_SEC
+            self._writers.move_to_end(user)
+            while len(self._writers) > STICKY_MAX_USERS:
+                self._writers.popitem(last=False)
+
+    def wrote_recently(self, user: Optional[str]) -> bool:
+        if user is None:
+            return False
+        with self._lock:
+            until = self._writers.get(user)
+            return until is not None and until > time.monotonic()
+
+    @staticmethod
+    async def _probe(replica: Replica) -> None:
+        async with replica.engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    async def check(self, replica: Replica) -> bool:
+        try:
+            # Bounds the connect as well as the query: a blackholed host never answers either
+            await asyncio.wait_for(self._probe(replica), timeout=REPLICA_HEALTH_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            self.mark_down(replica, f"no answer within {REPLICA_HEALTH_TIMEOUT_SEC}s")
+            return False
+        except (DBAPIError, OSError) as e:
+            self.mark_down(replica, e)
+            return False
+        self.mark_up(replica)
+        return True
+
+    async def check_all(self) -> None:
+        await asyncio.gather(*(self.check(r) for r in self.replicas))
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(REPLICA_HEALTH_INTERVAL_SEC)
+            try:
+                await self.check_all()
+            except Exception:
+                logger.exception("Read replica health check failed")
+
+    async def start(self) -> None:
+        """Check every replica once, then keep checking in the background"""
+        if not self.enabled or self._task is not None:
+            return
+        await self.check_all()
+        logger.info(f"Read replicas: {len(self.healthy())} of {len(self.replicas)} healthy")
+        self._task = asyncio.create_task(self._run(), name="replica-health")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+
+router = ReplicaRouter(database.replica_engines)
+replica_up = metrics.Gauge("edutrack_db_replica_up", "1 while a read replica is in rotation", ("replica",),
+                           fn=lambda: {(r.name,): int(r.healthy) for r in router.replicas})
+
+
+def _subject(request: Request) -> Optional[str]:
+    authorization = request.headers.get("authorization", "")
+    return token_subject(authorization[7:]) if authorization[:7].lower() == "bearer " else None
+
+
+def _reads_primary(request: Request) -> bool:
+    if not REPLICA_READ_YOUR_WRITES:
+        return False
+    try:
+        if float(request.cookies.get(STICKY_COOKIE, "0")) > time.time():
+            return True
+    except ValueError:
+        pass
+    return router.wrote_recently(_subject(request))
+
+
+def note_response(request: Request, response: Response, user: Optional[str]) -> None:
+    """Called for every response: after a successful write, pin the user's reads to the primary"""
+    if not (router.enabled and REPLICA_READ_YOUR_WRITES) or request.method in _SAFE_METHODS or response.status_code >= 400:
+        return
+    router.note_write(user)
+    response.set_cookie(STICKY_COOKIE, f"{time.time() + REPLICA_STICKY_SEC:.3f}", max_age=int(REPLICA_STICKY_SEC) + 1,
+                        httponly=True, samesite="lax")
+
+
+# Dependency for read-only handlers: a replica session when one is usable, otherwise the primary
+async def get_read_db(request: Request):
+    db = None
+    if router.enabled:
+        if _reads_primary(request):
+            metrics.db_reads.inc(target="primary", reason="read_your_writes")
+        else:
+            replica = router.pick()
+            if replica is None:
+                metrics.db_reads.inc(target="primary", reason="no_healthy_replica")
+            else:
+                db = replica.sessionmaker()
+                try:
+                    # Check out (and pre-ping) now, while falling back is still possible
+                    await asyncio.wait_for(db.connection(), timeout=database.REPLICA_CONNECT_TIMEOUT_SEC)
+                    metrics.db_reads.inc(target=replica.name, reason="replica")
+                except (DBAPIError, OSError, asyncio.TimeoutError) as e:
+                    await db.close()
+                    db = None
+                    router.mark_down(replica, e if str(e) else f"no connection within {database.REPLICA_CONNECT_TIMEOUT_SEC}s")
+                    metrics.db_reads.inc(target="primary", reason="replica_failed")
+    async with db or database.AsyncSessionLocal() as session:
+        yield session
@@ -0,0 +1,120 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.orm import Session
+
+from . import models, rollups
+
+NOTICE_TITLES = {"approved": "Appeal approved", "rejected": "Appeal rejected"}
+NOTICE_MESSAGES = {
+    "approved": "Your attendance appeal was approved.",
+    "rejected": "Your attendance appeal was rejected.",
+}
+
+
+def notice_message(decision: str, note: Optional[str] = None) -> str:
+    return NOTICE_MESSAGES[decision] + (f" Note: {note}" if note else "")
+
+
+def resolve_appeals(
+    db: Session,
+    decisions: Sequence[Dict[str, Any]],
+    note: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Approve or reject many pending appeals in the caller's transaction.
+
+    Each decision is ``{"appeal_id", "decision", "attendance_status"}``. The
+    appeals are locked (``SELECT .. FOR UPDATE`` in id order, so concurrent
+    batches cannot deadlock), approved appeals set their attendance record to
+    ``attendance_status`` with the rollups moved from the old status to the new
+    one, and every resolved student gets one notification row, all with
+    set-based statements. Appeals that are missing or no longer pending are
+    reported, not failed.
+
+    Returns ``{"results": [...], "notified": {decision: [public_id, ...]},
+    "created_at": ...}``; ``notified`` drives the push events once the caller
+    has committed.
+    """
+    wanted = {d["appeal_id"]: d for d in decisions}
+    a, u = models.Appeal, models.User
+    rows = db.execute(
+        select(a.id, a.user_id, a.status, a.attendance_id, u.public_id)
+        .join(u, u.id == a.user_id)
+        .where(a.id.in_(wanted))
+        .order_by(a.id)
+        .with_for_update(of=a)
+    ).all()
+    found = {r.id: r for r in rows}
+
+    resolved: Dict[str, List[int]] = defaultdict(list)
+    corrections: List[Dict[str, Any]] = []
+    results: Dict[int, Dict[str, Any]] = {}
+    for appeal_id, d in wanted.items():
+        row = found.get(appeal_id)
+        if row is None:
+            results[appeal_id] = {"result": "error", "detail": "Appeal not found"}
+        elif row.status != "pending":
+            results[appeal_id] = {"result": "skipped", "detail": f"Appeal already {row.status}"}
+        else:
+            resolved[d["decision"]].append(appeal_id)
+            results[appeal_id] = {"result": d["decision"]}
+            if d["decision"] == "approved" and row.attendance_id is not None:
+                corrections.append({"appeal_id": appeal_id, "record_id": row.attendance_id, "user_id": row.user_id,
+                                    "status": d.get("attendance_status") or "present"})
+
+    if corrections:
+        _correct_records(db, corrections, results)
+    for decision, ids in resolved.items():
+        db.execute(update(a).where(a.id.in_(ids)).values(status=decision, updated_at=datetime.utcnow()))
+
+    notified: Dict[str, List[str]] = {}
+    notice_rows = []
+    created_at = datetime.utcnow()
+    for decision, ids in resolved.items():
+        notified[decision] = [found[i].public_id for i in ids]
+        notice_rows.extend(
+            {"user_id": found[i].user_id, "title": NOTICE_TITLES[decision], "message": notice_message(decision, note),
+             "type": "appeal", "is_read": False, "created_at": created_at}
+            for i in ids
+        )
+    if notice_rows:
+        db.execute(insert(models.Notification), notice_rows)
+    return {
+        "results": [{"appeal_id": appeal_id, **results[appeal_id]} for appeal_id in wanted],
+        "notified": notified,
+        "created_at": created_at,
+    }
+
+
+def _correct_records(db: Session, corrections: List[Dict[str, Any]], results: Dict[int, Dict[str, Any]]) -> None:
+    ar = models.AttendanceRecord
+    records = {
+        r.id: r
+        for r in db.execute(
+            select(ar.id, ar.user_id, ar.session_id, ar.status, ar.timestamp)
+            .where(ar.id.in_({c["record_id"] for c in corrections}))
+            .order_by(ar.id)
+            .with_for_update()
+        )
+    }
+    # A student can only correct their own records; the last appeal for a record wins
+    target: Dict[int, str] = {}
+    for c in corrections:
+        record = records.get(c["record_id"])
+        if record is not None and record.user_id == c["user_id"]:
+            target[record.id] = c["status"]
+            results[c["appeal_id"]]["corrected_status"] = c["status"]
+    changed = [records[record_id] for record_id, new_status in target.items() if records[record_id].status != new_status]
+    if not changed:
+        return
+    old_rows = [{"user_id": r.user_id, "session_id": r.session_id, "status": r.status, "timestamp": r.timestamp} for r in changed]
+    new_rows = [{**row, "status": target[r.id]} for row, r in zip(old_rows, changed)]
+    rollups.add_records(db, old_rows, sign=-1)
+    by_status: Dict[str, List[int]] = defaultdict(list)
+    for r in changed:
+        by_status[target[r.id]].append(r.id)
+    for new_status, ids in by_status.items():
+        db.execute(update(ar).where(ar.id.in_(ids)).values(status=new_status, updated_at=datetime.utcnow()))
+    rollups.add_records(db, new_rows)
@@ -0,0 +1,35 @@
+"""JSON responses that skip FastAPI's response_model validation and jsonable_encoder.
+
+Handlers that already build plain dicts/lists (from row mappings, not ORM
+objects) return ``FastJSONResponse(payload)`` and the payload is encoded in a
+single pass. orjson is used when installed; otherwise the standard library
+encoder with compact separators. datetime and date values are written as ISO
+8601 either way.
+"""
+from datetime import date, datetime
+from typing import Any
+import json
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value: Any):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, separators=(",", ":"), ensure_ascii=False, default=_default).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
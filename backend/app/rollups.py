@@ -0,0 +1,201 @@
+from bisect import bisect_right
+from collections import Counter
+from datetime import date, datetime, time, timedelta
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+import logging
+
+from sqlalchemy import Table, and_, delete, func, insert, not_, or_, select, tuple_, update
+from sqlalchemy.orm import Session
+
+from . import archive, models
+
+logger = logging.getLogger(__name__)
+
+# Statuses that count towards a student's attendance percentage
+ATTENDED_STATUSES = ("present", "late")
+# Session.info key collecting (user_id, session_id, status, timestamp, sign) of every applied row
+# until the transaction ends; defaulters.py applies them to its cached bitmaps after commit
+PENDING_CHANGES = "attendance_changes"
+
+
+def upsert_increment(db: Session, table: Table, key_columns: Sequence[str], deltas: Mapping[Tuple, int]) -> None:
+    """Add ``deltas`` (key tuple -> amount) to ``table.count``, creating missing rows.
+
+    Uses a single INSERT .. ON CONFLICT / ON DUPLICATE KEY statement where the
+    dialect supports it, otherwise one lookup plus bulk UPDATE and INSERT.
+    """
+    rows = [{**dict(zip(key_columns, key)), "count": amount} for key, amount in deltas.items() if amount]
+    if not rows:
+        return
+    dialect = db.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        stmt = dialect_insert(table)
+        stmt = stmt.on_conflict_do_update(index_elements=list(key_columns), set_={"count": table.c.count + stmt.excluded.count})
+        db.execute(stmt, rows)
+        return
+    if dialect in ("mysql", "mariadb"):
+        from sqlalchemy.dialects.mysql import insert as mysql_insert
+        stmt = mysql_insert(table)
+        stmt = stmt.on_duplicate_key_update(count=table.c.count + stmt.inserted.count)
+        db.execute(stmt, rows)
+        return
+
+    keys = [table.c[name] for name in key_columns]
+    existing = {tuple(r) for r in db.execute(select(*keys).where(tuple_(*keys).in_(list(deltas))))}
+    updates = [r for r in rows if tuple(r[name] for name in key_columns) in existing]
+    inserts = [r for r in rows if tuple(r[name] for name in key_columns) not in existing]
+    for r in updates:
+        db.execute(
+            update(table)
+            .where(and_(*(table.c[name] == r[name] for name in key_columns)))
+            .values(count=table.c.count + r["count"])
+        )
+    if inserts:
+        db.execute(insert(table), inserts)
+
+
+def _class_codes(db: Session, user_ids: Iterable[int]) -> Dict[int, str]:
+    wanted = set(user_ids)
+    if not wanted:
+        return {}
+    rows = db.execute(select(models.User.id, models.User.class_code).where(models.User.id.in_(wanted)))
+    return {user_id: class_code or "" for user_id, class_code in rows}
+
+
+def add_records(db: Session, rows: Iterable[Mapping[str, Any]], sign: int = 1) -> None:
+    """Apply attendance rows to every rollup: per-user counters, per-user daily
+    counts and per-class daily counts.
+
+    ``rows`` need ``user_id``, ``status`` and ``timestamp`` (plus ``session_id``
+    for the defaulter bitmaps). Pass ``sign=-1`` to take rows back out, e.g.
+    before their status changes.
+    """
+    rows = list(rows)
+    if not rows:
+        return
+    classes = _class_codes(db, (r["user_id"] for r in rows))
+    counters: Counter = Counter()
+    daily: Counter = Counter()
+    class_daily: Counter = Counter()
+    for r in rows:
+        day = r["timestamp"].date()
+        counters[(r["user_id"], r["status"])] += sign
+        daily[(r["user_id"], day, r["status"])] += sign
+        class_daily[(classes.get(r["user_id"], ""), day, r["status"])] += sign
+    upsert_increment(db, models.AttendanceCounter.__table__, ("user_id", "status"), counters)
+    upsert_increment(db, models.AttendanceDaily.__table__, ("user_id", "day", "status"), daily)
+    upsert_increment(db, models.AttendanceClassDaily.__table__, ("class_code", "day", "status"), class_daily)
+    db.info.setdefault(PENDING_CHANGES, []).extend(
+        (r["user_id"], r.get("session_id"), r["status"], r["timestamp"], sign) for r in rows
+    )
+
+
+def rebuild_counters(db: Session) -> int:
+    """Recompute every counter from attendance_records with one INSERT .. SELECT, plus the archived records"""
+    counters = models.AttendanceCounter.__table__
+    records = models.AttendanceRecord.__table__
+    db.execute(delete(counters))
+    db.execute(
+        insert(counters).from_select(
+            ["user_id", "status", "count"],
+            select(records.c.user_id, records.c.status, func.count()).group_by(records.c.user_id, records.c.status),
+        )
+    )
+    upsert_increment(db, counters, ("user_id", "status"), archive.archived_counts(db))
+    return db.execute(select(func.count()).select_from(counters)).scalar_one()
+
+
+def rebuild_daily(db: Session, since: Optional[date] = None) -> int:
+    """Recompute the daily rollups from attendance_records, optionally only from ``since`` on.
+
+    Days inside an archived term are left as they are: their records are no
+    longer in the table to recount.
+    """
+    daily = models.AttendanceDaily.__table__
+    class_daily = models.AttendanceClassDaily.__table__
+    records = models.AttendanceRecord.__table__
+    users = models.User.__table__
+    day = func.date(records.c.timestamp)
+    user_q = select(records.c.user_id, day, records.c.status, func.count())
+    class_code = func.coalesce(users.c.class_code, "")
+    class_q = select(class_code, day, records.c.status, func.count()).join(users, users.c.id == records.c.user_id)
+    archived = archive.archived_days(db)
+    for table in (daily, class_daily):
+        condition = [table.c.day >= since] if since is not None else []
+        if archived:
+            condition.append(not_(or_(*(table.c.day.between(first, last) for first, last in archived))))
+        db.execute(delete(table).where(*condition))
+    if archived:
+        # Records marked into an archived range after archival are not recounted either
+        outside = not_(or_(*(day.between(first, last) for first, last in archived)))
+        user_q = user_q.where(outside)
+        class_q = class_q.where(outside)
+    if since is not None:
+        start = datetime.combine(since, time.min)
+        user_q = user_q.where(records.c.timestamp >= start)
+        class_q = class_q.where(records.c.timestamp >= start)
+    db.execute(insert(daily).from_select(["user_id", "day", "status", "count"], user_q.group_by(records.c.user_id, day, records.c.status)))
+    db.execute(insert(class_daily).from_select(["class_code", "day", "status", "count"], class_q.group_by(class_code, day, records.c.status)))
+    return db.execute(select(func.count()).select_from(daily)).scalar_one()
+
+
+def period_starts(period: str, periods: int, today: date) -> List[date]:
+    """First day of each of the last ``periods`` months or ISO weeks, oldest first"""
+    if period == "month":
+        starts = []
+        year, month = today.year, today.month
+        for _ in range(periods):
+            starts.append(date(year, month, 1))
+            year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+        return starts[::-1]
+    monday = today - timedelta(days=today.weekday())
+    return [monday - timedelta(weeks=i) for i in range(periods - 1, -1, -1)]
+
+
+def period_label(period: str, start: date) -> str:
+    if period == "month":
+        return start.strftime("%b %Y")  # the year keeps ranges over twelve months unambiguous
+    year, week, _ = start.isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+def attendance_trend(
+    db: Session,
+    period: str = "month",
+    periods: int = 6,
+    user_id: Optional[int] = None,
+    class_code: Optional[str] = None,
+    today: Optional[date] = None,
+) -> Dict[str, list]:
+    """Attendance percentage per month or week from the daily rollups.
+
+    Scoped to one user, one class, or (neither given) the whole institution;
+    reads at most one row per day and status, whatever the history size.
+    """
+    today = today or datetime.utcnow().date()
+    starts = period_starts(period, periods, today)
+    if user_id is not None:
+        t = models.AttendanceDaily
+        q = select(t.day, t.status, func.sum(t.count)).where(t.user_id == user_id)
+    else:
+        t = models.AttendanceClassDaily
+        q = select(t.day, t.status, func.sum(t.count))
+        if class_code is not None:
+            q = q.where(t.class_code == class_code)
+    q = q.where(t.day >= starts[0], t.day <= today).group_by(t.day, t.status)
+    attended = [0] * len(starts)
+    totals = [0] * len(starts)
+    for day, record_status, count in db.execute(q):
+        i = bisect_right(starts, day) - 1
+        totals[i] += int(count)
+        if record_status in ATTENDED_STATUSES:
+            attended[i] += int(count)
+    return {
+        "labels": [period_label(period, start) for start in starts],
+        "values": [round(a * 100.0 / n, 1) if n else None for a, n in zip(attended, totals)],
+        "totals": totals,
+    }
@@ -1,40 +1,91 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Body
-from sqlalchemy.orm import Session
-from typing import List, Dict, Any
-from .. import database, models, auth
+from fastapi import APIRouter, Depends, HTTPException, Query, status, Body
+from pydantic import BaseModel, Field
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import date, datetime, time, timedelta
+from typing import List, Dict, Any, Optional
+from .. import audit, database, models, auth, marking, pagination, pubsub, resolution
+from ..responses import FastJSONResponse
 
 router = APIRouter()
 
-@router.get("/", response_model=List[Dict[str, Any]])
-async def list_appeals(current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(database.get_db)):
-    q = db.query(models.Appeal)
+MAX_RESOLUTIONS = 1000
+
+@router.get("/", response_model=Dict[str, Any])
+async def list_appeals(
+    status_filter: Optional[str] = Query(None, alias="status", pattern="^(pending|approved|rejected)$"),
+    user_id: Optional[str] = Query(None, description="Student public id (teachers and admins)"),
+    date_from: Optional[date] = Query(None),
+    date_to: Optional[date] = Query(None),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(pagination.DEFAULT_PAGE_SIZE, ge=1, le=pagination.MAX_PAGE_SIZE),
+    current_user: models.User = Depends(auth.get_current_user),
+    db: AsyncSession = Depends(database.get_db),
+):
+    # Newest first, one page at a time; pass next_cursor back as ?cursor= for the next page
+    a = models.Appeal
+    q = select(a.id, a.status, a.reason, a.user_id, a.attendance_id, a.created_at)
     if current_user.role == "student":
-        q = q.filter(models.Appeal.user_id == current_user.id)
-    items = q.order_by(models.Appeal.created_at.desc()).all()
-    return [{"id": a.id, "status": a.status, "reason": a.reason, "user_id": a.user_id, "attendance_id": a.attendance_id} for a in items]
+        q = q.where(a.user_id == current_user.id)
+    elif user_id:
+        q = q.where(a.user_id == (await db.run_sync(marking.resolve_public_ids, [user_id])).get(user_id))
+    if status_filter:
+        q = q.where(a.status == status_filter)
+    if date_from:
+        q = q.where(a.created_at >= datetime.combine(date_from, time.min))
+    if date_to:
+        q = q.where(a.created_at < datetime.combine(date_to + timedelta(days=1), time.min))
+    rows = (await db.execute(pagination.paginate(q, a.created_at, a.id, cursor, limit))).mappings().all()
+    return FastJSONResponse(pagination.page(rows, limit, lambda r: (r["created_at"], r["id"])))
 
 @router.post("/", response_model=Dict[str, Any])
-async def create_appeal(reason: str = Body(...), attendance_id: int | None = Body(None), current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(database.get_db)):
+async def create_appeal(reason: str = Body(...), attendance_id: int | None = Body(None), current_user: models.User = Depends(auth.get_current_user), db: AsyncSession = Depends(database.get_db)):
     a = models.Appeal(user_id=current_user.id, attendance_id=attendance_id, reason=reason)
     db.add(a)
-    db.commit()
-    db.refresh(a)
+    await db.commit()
+    await audit.record("appeal.create", current_user.id, appeal_id=a.id, attendance_id=attendance_id)
     return {"id": a.id}
 
-@router.post("/{appeal_id}/approve")
-async def approve_appeal(appeal_id: int, _: models.User = Depends(auth.require_teacher), db: Session = Depends(database.get_db)):
-    a = db.query(models.Appeal).filter(models.Appeal.id == appeal_id).first()
-    if not a:
+class Resolution(BaseModel):
+    appeal_id: int
+    decision: str = Field(..., pattern="^(approved|rejected)$")
+    attendance_status: str = Field("present", pattern="^(present|late)$")  # applied to the record when approved
+
+class ResolveAppeals(BaseModel):
+    resolutions: List[Resolution] = Field(..., min_length=1, max_length=MAX_RESOLUTIONS)
+    note: Optional[str] = Field(None, max_length=500)  # appended to the students' notifications
+
+async def _resolve(db: AsyncSession, actor: auth.Principal, decisions: List[Dict[str, Any]], note: Optional[str] = None) -> Dict[str, Any]:
+    outcome = await db.run_sync(resolution.resolve_appeals, decisions, note=note)
+    await db.commit()
+    resolved = {d: [r["appeal_id"] for r in outcome["results"] if r["result"] == d] for d in ("approved", "rejected")}
+    if resolved["approved"] or resolved["rejected"]:
+        await audit.record("appeal.resolve", actor.id, **resolved)
+    for decision, public_ids in outcome["notified"].items():
+        event = {"id": None, "title": resolution.NOTICE_TITLES[decision], "message": resolution.notice_message(decision, note),
+                 "type": "appeal", "created_at": outcome["created_at"].isoformat()}
+        await pubsub.hub.publish(event, pubsub.Audience(user_public_ids=public_ids))
+    return outcome
+
+@router.post("/resolve", response_model=Dict[str, Any])
+async def resolve_appeals(payload: ResolveAppeals, current_user: models.User = Depends(auth.require_teacher), db: AsyncSession = Depends(database.get_db)):
+    # One transaction: lock the appeals, correct the linked records and rollups, notify the students
+    outcome = await _resolve(db, current_user, [r.model_dump() for r in payload.resolutions], payload.note)
+    summary = {"approved": 0, "rejected": 0, "skipped": 0, "error": 0}
+    for r in outcome["results"]:
+        summary[r["result"]] += 1
+    return {**summary, "results": outcome["results"]}
+
+async def _resolve_one(appeal_id: int, decision: str, actor: auth.Principal, db: AsyncSession) -> Dict[str, Any]:
+    result = (await _resolve(db, actor, [{"appeal_id": appeal_id, "decision": decision}]))["results"][0]
+    if result["result"] == "error":
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Appeal not found")
-    a.status = "approved"
-    db.commit()
-    return {"ok": True}
+    return {"ok": True, **result}
+
+@router.post("/{appeal_id}/approve")
+async def approve_appeal(appeal_id: int, current_user: models.User = Depends(auth.require_teacher), db: AsyncSession = Depends(database.get_db)):
+    return await _resolve_one(appeal_id, "approved", current_user, db)
 
 @router.post("/{appeal_id}/reject")
-async def reject_appeal(appeal_id: int, _: models.User = Depends(auth.require_teacher), db: Session = Depends(database.get_db)):
-    a = db.query(models.Appeal).filter(models.Appeal.id == appeal_id).first()
-    if not a:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Appeal not found")
-    a.status = "rejected"
-    db.commit()
-    return {"ok": True}
+async def reject_appeal(appeal_id: int, current_user: models.User = Depends(auth.require_teacher), db: AsyncSession = Depends(database.get_db)):
+    return await _resolve_one(appeal_id, "rejected", current_user, db)
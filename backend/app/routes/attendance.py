@@ -1,35 +1,310 @@
-from fastapi import APIRouter, Depends, Response, Query
-from sqlalchemy.orm import Session
-from typing import Dict, Any
+from fastapi import APIRouter, Depends, File, HTTPException, Query, UploadFile, status
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from typing import Dict, Any, List, Optional
+from datetime import date, datetime, time, timedelta
 import csv
 import io
-from .. import database, models, auth
+import os
+from .. import archive, audit, checkin, database, images, metrics, models, auth, marking, face_index, pagination, replicas
+from ..responses import FastJSONResponse, dumps
 
 router = APIRouter()
 
+MAX_ROLL_CALL_MARKS = 2000
+
+class Mark(BaseModel):
+    user_id: str  # public id of the student
+    status: str = "present"
+    method: str = "manual"
+    confidence_score: Optional[float] = None
+    location: Optional[str] = None
+
+class RollCall(BaseModel):
+    session_id: str = Field(..., min_length=1, max_length=64)
+    type: str = "lecture"
+    timestamp: Optional[datetime] = None
+    marks: List[Mark] = Field(..., max_length=MAX_ROLL_CALL_MARKS)
+
+@router.post("/roll-call", response_model=Dict[str, Any])
+async def roll_call(payload: RollCall, current_user: models.User = Depends(auth.require_teacher), db: AsyncSession = Depends(database.get_db)):
+    # Whole-class marking: one lookup for the students, one multi-row insert, one commit
+    ids = await db.run_sync(marking.resolve_public_ids, [m.user_id for m in payload.marks])
+    marks = [{**m.model_dump(), "user_id": ids.get(m.user_id)} for m in payload.marks]
+    results = await db.run_sync(marking.record_marks, payload.session_id, marks, type=payload.type, timestamp=payload.timestamp)
+    await db.commit()
+    summary = {"created": 0, "duplicate": 0, "error": 0}
+    for mark, result in zip(payload.marks, results):
+        summary[result["result"]] += 1
+        result["user_id"] = mark.user_id
+    await audit.record("attendance.roll_call", current_user.id, session_id=payload.session_id, **summary)
+    return {"session_id": payload.session_id, **summary, "results": results}
+
+class FaceMatch(BaseModel):
+    session_id: str = Field(..., min_length=1, max_length=64)
+    type: str = "lecture"
+    timestamp: Optional[datetime] = None
+    location: Optional[str] = None
+    tolerance: float = Field(face_index.FACE_MATCH_TOLERANCE, gt=0, le=2)
+    encodings: List[List[float]] = Field(..., min_length=1, max_length=MAX_ROLL_CALL_MARKS)
+
+@router.post("/face-match", response_model=Dict[str, Any])
+async def face_match(payload: FaceMatch, current_user: models.User = Depends(auth.require_teacher), db: AsyncSession = Depends(database.get_db)):
+    # Match every captured face against the gallery in one batched search, then mark the matches
+    gallery = await db.run_sync(face_index.get_gallery)
+    try:
+        # The distance computation is CPU-bound numpy work; keep it off the event loop
+        matches = await run_in_threadpool(gallery.search, payload.encodings, tolerance=payload.tolerance)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    marks = [
+        {"user_id": user_id, "status": "present", "method": "face", "location": payload.location,
+         "confidence_score": face_index.confidence_from_distance(distance)}
+        for user_id, _, distance in matches if user_id is not None
+    ]
+    recorded = iter(await db.run_sync(marking.record_marks, payload.session_id, marks, type=payload.type, timestamp=payload.timestamp))
+    await db.commit()
+    results = []
+    for user_id, public_id, distance in matches:
+        if user_id is None:
+            results.append({"result": "no_match", "user_id": None, "distance": distance})
+        else:
+            results.append({**next(recorded), "user_id": public_id, "distance": distance,
+                            "confidence_score": face_index.confidence_from_distance(distance)})
+    matched = sum(1 for r in results if r["result"] != "no_match")
+    await audit.record("attendance.face_match", current_user.id, session_id=payload.session_id, matched=matched,
+                       unmatched=len(results) - matched)
+    return {"session_id": payload.session_id, "matched": matched, "unmatched": len(results) - matched, "results": results}
+
+class QRCode(BaseModel):
+    session_id: str = Field(..., min_length=1, max_length=64)
+    type: str = "lecture"
+    class_code: Optional[str] = None  # only students of this class may check in
+    started_at: Optional[datetime] = None  # echo the value returned by the first call on every refresh
+
+@router.post("/qr/code", response_model=Dict[str, Any])
+async def qr_code(payload: QRCode, _: models.User = Depends(auth.require_teacher)):
+    # Stateless: the display calls this again after refresh_in seconds to rotate the code
+    return checkin.issue_code(payload.session_id, payload.type, payload.class_code, payload.started_at)
+
+class QRCheckIn(BaseModel):
+    code: str = Field(..., max_length=512)
+    location: Optional[str] = Field(None, max_length=255)
+
+@router.post("/qr/check-in", response_model=Dict[str, Any])
+async def qr_check_in(payload: QRCheckIn, current_user: models.User = Depends(auth.require_student)):
+    # Validated from the signature and deduplicated in memory; only new check-ins reach the database, in batches
+    try:
+        claims = checkin.verify_code(payload.code)
+    except ValueError as e:
+        metrics.qr_checkins.inc(result="invalid")
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if claims["c"] and claims["c"] != current_user.class_code:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="This session is for another class")
+    result = await checkin.check_in(current_user, claims, payload.location)
+    if result["result"] == "created":
+        await audit.record("attendance.qr_check_in", current_user.id, session_id=claims["s"], status=result["status"])
+    return {"session_id": claims["s"], **result}
+
+def _empty_stats() -> Dict[str, int]:
+    return {"total": 0, **{s: 0 for s in marking.VALID_STATUSES}}
+
+def _day_bounds(date_from: Optional[date], date_to: Optional[date]):
+    start = datetime.combine(date_from, time.min) if date_from else None
+    end = datetime.combine(date_to + timedelta(days=1), time.min) if date_to else None
+    return start, end
+
 @router.get("/stats", response_model=Dict[str, Any])
-async def attendance_stats(user_id: str = Query(None), current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(database.get_db)):
-    # Simple stats: count by status for current user (or specified user if admin/teacher)
-    target_user = current_user
-    if user_id and current_user.role in ["teacher", "admin"]:
-        target_user = db.query(models.User).filter(models.User.public_id == user_id).first() or current_user
-    q = db.query(models.AttendanceRecord).filter(models.AttendanceRecord.user_id == target_user.id)
-    total = q.count()
-    present = q.filter(models.AttendanceRecord.status == "present").count()
-    late = q.filter(models.AttendanceRecord.status == "late").count()
-    absent = q.filter(models.AttendanceRecord.status == "absent").count()
-    return {"total": total, "present": present, "late": late, "absent": absent}
+async def attendance_stats(
+    user_id: str = Query(None),
+    user_ids: List[str] = Query(None),
+    date_from: Optional[date] = Query(None),
+    date_to: Optional[date] = Query(None),
+    current_user: models.User = Depends(auth.get_current_user),
+    db: AsyncSession = Depends(replicas.get_read_db),
+):
+    # Counts by status for the current user, or for the specified user(s) if admin/teacher.
+    # Without a date range this is a point lookup in the maintained counters; with one it
+    # sums the per-day rollup rows instead of scanning attendance_records.
+    targets = {current_user.id: current_user.public_id}
+    wanted = [p for v in (user_ids or []) for p in v.split(",") if p] + ([user_id] if user_id else [])
+    if wanted and current_user.role in ["teacher", "admin"]:
+        found = await db.run_sync(marking.resolve_public_ids, wanted)
+        if found:
+            targets = {pk: public_id for public_id, pk in found.items()}
+    if date_from or date_to:
+        d = models.AttendanceDaily
+        q = select(d.user_id, d.status, func.sum(d.count)).where(d.user_id.in_(targets))
+        if date_from:
+            q = q.where(d.day >= date_from)
+        if date_to:
+            q = q.where(d.day <= date_to)
+        q = q.group_by(d.user_id, d.status)
+    else:
+        c = models.AttendanceCounter
+        q = select(c.user_id, c.status, c.count).where(c.user_id.in_(targets))
+    per_user = {pk: _empty_stats() for pk in targets}
+    for pk, record_status, count in await db.execute(q):
+        stats = per_user[pk]
+        stats[record_status] = stats.get(record_status, 0) + int(count)
+        stats["total"] += int(count)
+    if user_ids is None:
+        return next(iter(per_user.values()))
+    return FastJSONResponse({"users": {targets[pk]: stats for pk, stats in per_user.items()}})
 
-@router.get("/export")
-async def export_attendance(user_id: str = Query(None), current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(database.get_db)):
-    target_user = current_user
-    if user_id and current_user.role in ["teacher", "admin"]:
-        target_user = db.query(models.User).filter(models.User.public_id == user_id).first() or current_user
-    records = db.query(models.AttendanceRecord).filter(models.AttendanceRecord.user_id == target_user.id).order_by(models.AttendanceRecord.timestamp.desc()).all()
+@router.get("/records", response_model=Dict[str, Any])
+async def list_attendance_records(
+    user_id: Optional[str] = Query(None, description="Student public id (teachers and admins)"),
+    class_code: Optional[str] = Query(None),
+    status_filter: Optional[str] = Query(None, alias="status", pattern="^(present|late|absent)$"),
+    session_id: Optional[str] = Query(None),
+    date_from: Optional[date] = Query(None),
+    date_to: Optional[date] = Query(None),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(pagination.DEFAULT_PAGE_SIZE, ge=1, le=pagination.MAX_PAGE_SIZE),
+    current_user: models.User = Depends(auth.get_current_user),
+    db: AsyncSession = Depends(replicas.get_read_db),
+):
+    # Newest first, keyed on (timestamp, id); students only ever see their own records
+    ar, u = models.AttendanceRecord, models.User
+    q = select(
+        ar.id, u.public_id.label("user_id"), ar.timestamp, ar.type, ar.method, ar.status, ar.session_id,
+        ar.confidence_score.label("confidence"), ar.location, ar.capture_image_url,
+    ).join(u, u.id == ar.user_id)
+    if current_user.role not in ["teacher", "admin"]:
+        q = q.where(ar.user_id == current_user.id)
+    else:
+        if user_id:
+            q = q.where(ar.user_id == (await db.run_sync(marking.resolve_public_ids, [user_id])).get(user_id))
+        if class_code:
+            q = q.where(u.class_code == class_code)
+    if status_filter:
+        q = q.where(ar.status == status_filter)
+    if session_id:
+        q = q.where(ar.session_id == session_id)
+    start, end = _day_bounds(date_from, date_to)
+    if start:
+        q = q.where(ar.timestamp >= start)
+    if end:
+        q = q.where(ar.timestamp < end)
+    rows = (await db.execute(pagination.paginate(q, ar.timestamp, ar.id, cursor, limit))).mappings().all()
+    rows = [{**r, "capture_image_url": images.sign(r["capture_image_url"])} for r in rows]
+    return FastJSONResponse(pagination.page(rows, limit, lambda r: (r["timestamp"], r["id"])))
+
+@router.put("/records/{record_id}/capture-image", response_model=Dict[str, Any])
+async def set_capture_image(record_id: int, file: UploadFile = File(...), current_user: models.User = Depends(auth.require_teacher), db: AsyncSession = Depends(database.get_db)):
+    # The frame the camera matched; stored once per distinct image however often it is sent
+    record = await db.get(models.AttendanceRecord, record_id)
+    if not record:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Attendance record not found")
+    stored = await images.ingest(file)
+    record.capture_image_url = stored["url"]
+    await db.commit()
+    await audit.record("attendance.capture_image_set", current_user.id, record=record_id, sha256=stored["sha256"])
+    return images.signed(stored)
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "2000"))
+EXPORT_FIELDS = ["timestamp", "type", "method", "confidence", "status", "location"]
+
+def _export_query(scope: str, target_id: int, class_code: Optional[str], start: Optional[datetime], end: Optional[datetime]):
+    ar, u = models.AttendanceRecord, models.User
+    cols = [ar.timestamp, ar.type, ar.method, ar.confidence_score, ar.status, ar.location]
+    if scope == "user":
+        q = select(*cols).where(ar.user_id == target_id).order_by(ar.timestamp.desc())
+    else:
+        # (user_id, timestamp) order walks idx_attendance_user_timestamp instead of sorting the table
+        q = select(u.public_id, u.name, *cols).join(u, u.id == ar.user_id).order_by(ar.user_id, ar.timestamp)
+        if scope == "class":
+            q = q.where(u.class_code == class_code)
+    if start:
+        q = q.where(ar.timestamp >= start)
+    if end:
+        q = q.where(ar.timestamp < end)
+    return q
+
+async def _table_batches(query, bind):
+    # Uses its own session (on the request's engine, so possibly a replica) so the request's
+    # session can close; rows come from a server-side cursor in EXPORT_BATCH_SIZE batches
+    async with database.AsyncSessionLocal(bind=bind) as db:
+        result = await db.stream(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        async for batch in result.partitions():
+            yield batch
+
+async def _archived_batches(entry: models.AttendanceArchive, scope: str, target_id: int, class_code: Optional[str],
+                            start: Optional[datetime], end: Optional[datetime], bind):
+    # Rows come off the file in a worker thread; for class and institution exports each batch's
+    # students are looked up by id (on the request's engine), so no user list is held in memory
+    batches = iterate_in_threadpool(archive.export_batches(entry, target_id if scope == "user" else None, start, end))
+    if scope == "user":
+        async for batch in batches:
+            yield [row[1:] for row in batch]
+        return
+    u = models.User
+    async with database.AsyncSessionLocal(bind=bind) as db:
+        async for batch in batches:
+            q = select(u.id, u.public_id, u.name).where(u.id.in_({row[0] for row in batch}))
+            if scope == "class":
+                q = q.where(u.class_code == class_code)
+            users = {user_id: (public_id, name) for user_id, public_id, name in await db.execute(q)}
+            # Like the table query's join: other classes and deleted users are left out
+            rows = [users[row[0]] + row[1:] for row in batch if row[0] in users]
+            if rows:
+                yield rows
+
+async def _stream_export(sources, fields: List[str], fmt: str):
+    # Each batch is sent as soon as it is encoded
     buf = io.StringIO()
     writer = csv.writer(buf)
-    writer.writerow(["timestamp","type","method","confidence","status","location"])
-    for r in records:
-        writer.writerow([r.timestamp.isoformat(), r.type, r.method, r.confidence_score or "", r.status, r.location or ""])
-    csv_bytes = buf.getvalue().encode("utf-8")
-    return Response(content=csv_bytes, media_type="text/csv", headers={"Content-Disposition": "attachment; filename=attendance.csv"})
+    if fmt == "csv":
+        writer.writerow(fields)
+    for source in sources:
+        async for batch in source:
+            for row in batch:
+                values = [v.isoformat() if isinstance(v, datetime) else v for v in row]
+                if fmt == "csv":
+                    writer.writerow(["" if v is None else v for v in values])
+                else:
+                    buf.write(dumps(dict(zip(fields, values))).decode("utf-8"))
+                    buf.write("\n")
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+@router.get("/export")
+async def export_attendance(
+    user_id: str = Query(None),
+    scope: str = Query("user", pattern="^(user|class|institution)$"),
+    class_code: Optional[str] = Query(None),
+    date_from: Optional[date] = Query(None),
+    date_to: Optional[date] = Query(None),
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    current_user: models.User = Depends(auth.get_current_user),
+    db: AsyncSession = Depends(replicas.get_read_db),
+):
+    target_id = current_user.id
+    if scope != "user":
+        if current_user.role not in ["teacher", "admin"]:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Insufficient permissions")
+        if scope == "class" and not class_code:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="class_code is required for class exports")
+    elif user_id and current_user.role in ["teacher", "admin"]:
+        target_id = (await db.run_sync(marking.resolve_public_ids, [user_id])).get(user_id, current_user.id)
+    start, end = _day_bounds(date_from, date_to)
+    fields = EXPORT_FIELDS if scope == "user" else ["user_id", "name"] + EXPORT_FIELDS
+    query = _export_query(scope, target_id, class_code, start, end)
+    # Closed terms moved to archive files are read from there when the range reaches into them
+    archived = [
+        _archived_batches(entry, scope, target_id, class_code, start, end, db.bind)
+        for entry in await db.run_sync(archive.archives_overlapping, start, end)
+    ]
+    # Archived terms are older: after the table for newest-first user exports, before it otherwise
+    sources = [_table_batches(query, db.bind), *archived[::-1]] if scope == "user" else [*archived, _table_batches(query, db.bind)]
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    filename = f"attendance.{format}"
+    return StreamingResponse(_stream_export(sources, fields, format), media_type=media_type,
+                             headers={"Content-Disposition": f"attachment; filename={filename}"})
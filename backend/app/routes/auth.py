@@ -1,11 +1,13 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Body
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Dict, Any
 import uuid
 
-from .. import database, models, auth
-from ..auth import get_password_hash, verify_password, create_tokens, refresh_access_token, create_password_reset, verify_password_reset, mark_password_reset_used, require_admin, require_teacher, require_student
+from .. import audit, database, models, auth
+from ..auth import create_tokens, refresh_access_token, create_password_reset, verify_password_reset, mark_password_reset_used, require_admin, require_teacher, require_student
+from ..passwords import hash_password_async, verify_password_async
 
 router = APIRouter()
 
@@ -15,10 +17,10 @@ async def register_user(
     email: str = Body(...),
     password: str = Body(...),
     role: str = Body(...),
-    db: Session = Depends(database.get_db)
+    db: AsyncSession = Depends(database.get_db)
 ):
     # Check if user already exists
-    existing_user = db.query(models.User).filter(models.User.email == email).first()
+    existing_user = (await db.execute(select(models.User.id).where(models.User.email == email))).first()
     if existing_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -33,7 +35,7 @@ async def register_user(
         )
     
     # Create new user
-    hashed_password = get_password_hash(password)
+    hashed_password = await hash_password_async(password)
     public_id = str(uuid.uuid4())
     
     new_user = models.User(
@@ -45,8 +47,8 @@ async def register_user(
     )
     
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await audit.record("user.register", new_user.id, role=role)
     
     # Create tokens
     tokens = create_tokens({"sub": public_id})
@@ -65,19 +67,27 @@ async def register_user(
 async def login(
     form_data: OAuth2PasswordRequestForm = Depends(),
     role: str = Body(...),
-    db: Session = Depends(database.get_db)
+    db: AsyncSession = Depends(database.get_db)
 ):
     # Find user by email
-    user = db.query(models.User).filter(models.User.email == form_data.username).first()
+    user = (await db.execute(select(models.User).where(models.User.email == form_data.username))).scalar_one_or_none()
     
     # Verify user exists, password is correct, and role matches
-    if not user or not verify_password(form_data.password, user.password) or user.role != role:
+    password_ok, new_hash = await verify_password_async(form_data.password, user.password) if user else (False, None)
+    if not password_ok or user.role != role:
+        await audit.record("auth.login_failed", user.id if user else None, email=form_data.username, role=role)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email, password, or role",
             headers={"WWW-Authenticate": "Bearer"},
         )
     
+    # Upgrade hashes made with a different BCRYPT_ROUNDS while we have the plain password
+    if new_hash:
+        user.password = new_hash
+        await db.commit()
+    await audit.record("auth.login", user.id)
+    
     # Create tokens
     tokens = create_tokens({"sub": user.public_id})
     
@@ -94,11 +104,11 @@ async def login(
 @router.post("/refresh", response_model=Dict[str, Any])
 async def refresh_token(
     refresh_token: str = Body(..., embed=True),
-    db: Session = Depends(database.get_db)
+    db: AsyncSession = Depends(database.get_db)
 ):
     # Use the refresh token to get a new access token
     try:
-        new_token = refresh_access_token(refresh_token, db)
+        new_token = await refresh_access_token(refresh_token, db)
         return new_token
     except HTTPException as e:
         raise e
@@ -121,22 +131,23 @@ async def get_user_info(current_user: models.User = Depends(auth.get_current_use
 # Password reset (request + confirm) using OTP-like token stored in DB
 
 @router.post("/password/reset/request")
-async def request_password_reset(email: str = Body(...), db: Session = Depends(database.get_db)):
-    user = db.query(models.User).filter(models.User.email == email).first()
+async def request_password_reset(email: str = Body(...), db: AsyncSession = Depends(database.get_db)):
+    user = (await db.execute(select(models.User).where(models.User.email == email))).scalar_one_or_none()
     if not user:
         # To avoid user enumeration, return success regardless
         return {"message": "If the email exists, a reset token has been generated."}
-    pr = create_password_reset(user, db)
+    pr = await create_password_reset(user, db)
     # NOTE: Here you would send the token via email/SMS. For now we return masked info.
     return {"message": "Reset token generated and sent.", "mask": email[:2] + "***"}
 
 @router.post("/password/reset/confirm")
-async def confirm_password_reset(token: str = Body(...), new_password: str = Body(...), db: Session = Depends(database.get_db)):
-    user = verify_password_reset(token, db)
-    user.password = get_password_hash(new_password)
+async def confirm_password_reset(token: str = Body(...), new_password: str = Body(...), db: AsyncSession = Depends(database.get_db)):
+    user = await verify_password_reset(token, db)
+    user.password = await hash_password_async(new_password)
     db.add(user)
-    mark_password_reset_used(token, db)
-    db.commit()
+    await mark_password_reset_used(token, db)
+    await db.commit()
+    await audit.record("auth.password_reset", user.id)
     return {"message": "Password has been reset successfully"}
 
 # Example protected routes using role dependencies
@@ -0,0 +1,20 @@
+from fastapi import APIRouter, HTTPException, Query, status
+from fastapi.responses import FileResponse
+import os
+import time
+from .. import images
+
+router = APIRouter()
+
+@router.get("/{directory}/{name}", include_in_schema=False)
+async def get_image(directory: str, name: str, expires: int = Query(0), sig: str = Query("")):
+    # Links come signed from handlers that checked the caller may see the student's image
+    path = images.file_path(directory, name)
+    if path is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found")
+    if not images.verify(f"{images.MEDIA_URL}/{directory}/{name}", expires, sig):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Image link is invalid or has expired")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found")
+    max_age = max(0, expires - int(time.time()))
+    return FileResponse(path, media_type="image/jpeg", headers={"Cache-Control": f"private, max-age={max_age}"})
@@ -1,16 +1,39 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Body
-from sqlalchemy.orm import Session
-from typing import List, Dict, Any
-from .. import database, models, auth
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status, Body
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime
+from typing import List, Dict, Any, Optional
+import asyncio
+import os
+from .. import audit, database, models, auth, notify, pagination, pubsub
+from ..responses import FastJSONResponse, dumps
+
+STREAM_HEARTBEAT_SEC = float(os.getenv("STREAM_HEARTBEAT_SEC", "15"))
 
 router = APIRouter()
 
-@router.get("/", response_model=List[Dict[str, Any]])
-async def list_notifications(current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(database.get_db)):
-    items = db.query(models.Notification).filter(models.Notification.user_id == current_user.id).order_by(models.Notification.created_at.desc()).all()
-    return [
-        {"id": n.id, "title": n.title, "message": n.message, "type": n.type, "is_read": n.is_read, "created_at": n.created_at.isoformat()} for n in items
-    ]
+def _event(title: str, message: str, type: str, created_at: datetime, id: Optional[int] = None) -> Dict[str, Any]:
+    return {"id": id, "title": title, "message": message, "type": type, "created_at": created_at.isoformat()}
+
+@router.get("/", response_model=Dict[str, Any])
+async def list_notifications(
+    unread: bool = Query(False, description="Only unread notifications"),
+    type: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(pagination.DEFAULT_PAGE_SIZE, ge=1, le=pagination.MAX_PAGE_SIZE),
+    current_user: models.User = Depends(auth.get_current_user),
+    db: AsyncSession = Depends(database.get_db),
+):
+    # Newest first via idx_notification_user_created; pass next_cursor back as ?cursor=
+    n = models.Notification
+    q = select(n.id, n.title, n.message, n.type, n.is_read, n.created_at).where(n.user_id == current_user.id)
+    if unread:
+        q = q.where(n.is_read == False)
+    if type:
+        q = q.where(n.type == type)
+    rows = (await db.execute(pagination.paginate(q, n.created_at, n.id, cursor, limit))).mappings().all()
+    return FastJSONResponse(pagination.page(rows, limit, lambda r: (r["created_at"], r["id"])))
 
 @router.post("/", response_model=Dict[str, Any])
 async def send_notification(
@@ -18,23 +41,94 @@ async def send_notification(
     title: str = Body(...),
     message: str = Body(...),
     type: str = Body("info"),
-    _: models.User = Depends(auth.require_teacher),
-    db: Session = Depends(database.get_db)
+    current_user: models.User = Depends(auth.require_teacher),
+    db: AsyncSession = Depends(database.get_db)
 ):
-    user = db.query(models.User).filter(models.User.public_id == user_public_id).first()
+    user = (await db.execute(select(models.User.id).where(models.User.public_id == user_public_id))).first()
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-    n = models.Notification(user_id=user.id, title=title, message=message, type=type)
+    n = models.Notification(user_id=user.id, title=title, message=message, type=type, created_at=datetime.utcnow())
     db.add(n)
-    db.commit()
-    db.refresh(n)
+    await db.commit()
+    await audit.record("notification.send", current_user.id, notification_id=n.id, to=user_public_id)
+    await pubsub.hub.publish(_event(n.title, n.message, n.type, n.created_at, id=n.id), pubsub.Audience(user_public_ids=[user_public_id]))
     return {"id": n.id}
 
+@router.post("/broadcast", response_model=Dict[str, Any])
+async def broadcast_notification(
+    title: str = Body(...),
+    message: str = Body(...),
+    type: str = Body("info"),
+    role: Optional[str] = Body(None),
+    user_public_ids: Optional[List[str]] = Body(None),
+    class_code: Optional[str] = Body(None),
+    current_user: models.User = Depends(auth.require_teacher),
+    db: AsyncSession = Depends(database.get_db)
+):
+    # Filters combine, e.g. role="student" + class_code targets the students of one class
+    if not role and user_public_ids is None and not class_code:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Specify role, user_public_ids or class_code")
+    if role and role not in ("student", "teacher", "admin"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid role")
+    created_at = datetime.utcnow()
+    sent = await db.run_sync(
+        notify.broadcast, title, message, type, role=role, user_public_ids=user_public_ids, class_code=class_code, created_at=created_at
+    )
+    await db.commit()
+    await audit.record("notification.broadcast", current_user.id, sent=sent, role=role, class_code=class_code,
+                       users=len(user_public_ids) if user_public_ids is not None else None)
+    if sent:
+        await pubsub.hub.publish(_event(title, message, type, created_at), pubsub.Audience(role, user_public_ids, class_code))
+    return {"sent": sent}
+
+@router.get("/unread-count", response_model=Dict[str, int])
+async def unread_count(current_user: models.User = Depends(auth.get_current_user), db: AsyncSession = Depends(database.get_db)):
+    # Answered from idx_notification_user_read without loading any rows
+    count = (await db.execute(
+        select(func.count()).select_from(models.Notification).where(
+            models.Notification.user_id == current_user.id, models.Notification.is_read == False
+        )
+    )).scalar_one()
+    return {"unread": count}
+
+@router.get("/stream")
+async def stream_notifications(request: Request, token: Optional[str] = Query(None, description="Access token, for EventSource clients that cannot set headers")):
+    """Server-Sent Events feed of new notifications for the current user.
+
+    Events are pushed from memory as they are published; the database is only
+    touched to authenticate (and not even then on a principal cache hit).
+    """
+    authorization = request.headers.get("authorization", "")
+    if authorization[:7].lower() == "bearer ":
+        token = authorization[7:]
+    if not token:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    user = await auth.authenticate(token)
+
+    async def events():
+        sub = await pubsub.hub.subscribe(user.public_id, user.role, user.class_code)
+        try:
+            yield f"retry: {int(STREAM_HEARTBEAT_SEC * 1000)}\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(sub.queue.get(), timeout=STREAM_HEARTBEAT_SEC)
+                except asyncio.TimeoutError:
+                    # Comment line keeps proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                    continue
+                yield b"event: notification\ndata: " + dumps(event) + b"\n\n"
+        finally:
+            pubsub.hub.unsubscribe(sub)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @router.post("/{notification_id}/read")
-async def mark_read(notification_id: int, current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(database.get_db)):
-    n = db.query(models.Notification).filter(models.Notification.id == notification_id, models.Notification.user_id == current_user.id).first()
+async def mark_read(notification_id: int, current_user: models.User = Depends(auth.get_current_user), db: AsyncSession = Depends(database.get_db)):
+    n = (await db.execute(
+        select(models.Notification).where(models.Notification.id == notification_id, models.Notification.user_id == current_user.id)
+    )).scalar_one_or_none()
     if not n:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
     n.is_read = True
-    db.commit()
+    await db.commit()
     return {"ok": True}
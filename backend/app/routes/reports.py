@@ -1,13 +1,52 @@
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
-from typing import Dict, Any
-from .. import database, models, auth
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from typing import Dict, Any, Optional
+from .. import models, auth, marking, replicas, rollups, defaulters
+from ..responses import FastJSONResponse
 
 router = APIRouter()
 
 @router.get("/trends", response_model=Dict[str, Any])
-async def report_trends(current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(database.get_db)):
-    # Placeholder: aggregate attendance percentages last 6 months
-    labels = ["Apr", "May", "Jun", "Jul", "Aug", "Sep"]
-    values = [72, 78, 81, 79, 85, 88]
-    return {"labels": labels, "values": values}
+async def report_trends(
+    period: str = Query("month", pattern="^(month|week)$"),
+    periods: int = Query(6, ge=1, le=104),
+    scope: str = Query("user", pattern="^(user|class|institution)$"),
+    user_id: Optional[str] = Query(None),
+    class_code: Optional[str] = Query(None),
+    current_user: models.User = Depends(auth.get_current_user),
+    db: AsyncSession = Depends(replicas.get_read_db),
+):
+    # Attendance percentage per month/week, served from the daily rollup tables
+    if scope != "user" and current_user.role not in ["teacher", "admin"]:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Insufficient permissions")
+    if scope == "class" and not class_code:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="class_code is required for class trends")
+    target_id = None
+    if scope == "user":
+        target_id = current_user.id
+        if user_id and current_user.role in ["teacher", "admin"]:
+            target_id = (await db.run_sync(marking.resolve_public_ids, [user_id])).get(user_id, current_user.id)
+    trend = await db.run_sync(rollups.attendance_trend, period, periods, user_id=target_id, class_code=class_code if scope == "class" else None)
+    return FastJSONResponse({"period": period, "scope": scope, **trend})
+
+@router.get("/defaulters", response_model=Dict[str, Any])
+async def report_defaulters(
+    threshold: float = Query(defaulters.DEFAULTER_THRESHOLD, ge=0, le=100),
+    class_code: Optional[str] = Query(None),
+    term_id: Optional[int] = Query(None, description="Defaults to the term containing today"),
+    limit: int = Query(500, ge=1, le=5000),
+    _: models.User = Depends(auth.require_teacher),
+):
+    # Students below the threshold, lowest first, from the cached per-term bitmaps
+    attendance = await run_in_threadpool(defaulters.term_attendance, term_id)
+    if attendance is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No academic term found")
+    rows = attendance.below(threshold, class_code)
+    return FastJSONResponse({
+        "term": attendance.term_name,
+        "threshold": threshold,
+        "count": len(rows),
+        "students": [attendance.describe(row) for row in rows[:limit]],
+        "computed_at": attendance.built_at,
+    })
@@ -1,28 +1,108 @@
-from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, status
-from sqlalchemy.orm import Session
-import csv
-from io import StringIO
-from .. import database, models, auth
+from fastapi import APIRouter, BackgroundTasks, Depends, UploadFile, File, HTTPException, Query, status, Body
+from starlette.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List
+import logging
+import os
+import shutil
+import tempfile
+from .. import audit, database, models, auth, face_index, images, importer, jobs
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+def _import_file(stream) -> dict:
+    with database.SessionLocal() as db:
+        return importer.import_students(db, importer.iter_csv_rows(stream))
+
+def _run_import_job(job: jobs.Job, path: str) -> None:
+    jobs.registry.start(job)
+    try:
+        with open(path, "rb") as stream, database.SessionLocal() as db:
+            report = importer.import_students(
+                db, importer.iter_csv_rows(stream), on_progress=lambda p: jobs.registry.update(job, **p)
+            )
+        jobs.registry.finish(job, report)
+    except Exception as e:
+        logger.exception(f"Student import job {job.id} failed")
+        jobs.registry.fail(job, str(e))
+    finally:
+        os.unlink(path)
+
+def _spool(source, target) -> None:
+    source.seek(0)
+    shutil.copyfileobj(source, target, 1024 * 1024)
+    target.close()
+
 @router.post("/bulk-upload")
-async def bulk_upload_students(file: UploadFile = File(...), _: models.User = Depends(auth.require_teacher), db: Session = Depends(database.get_db)):
+async def bulk_upload_students(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    background: bool = Query(False, description="Import after responding; poll /students/import-jobs/{job_id}"),
+    current_user: auth.Principal = Depends(auth.require_teacher),
+):
     if file.content_type not in ("text/csv", "application/vnd.ms-excel"):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="CSV file required")
-    content = (await file.read()).decode("utf-8", errors="ignore")
-    reader = csv.DictReader(StringIO(content))
-    created = 0
-    for row in reader:
-        name = (row.get("name") or "").strip()
-        email = (row.get("email") or "").strip()
-        if not name or not email:
-            continue
-        existing = db.query(models.User).filter(models.User.email == email).first()
-        if existing:
-            continue
-        u = models.User(name=name, email=email, password="", role="student")
-        db.add(u)
-        created += 1
-    db.commit()
-    return {"created": created}
+    if not background:
+        # Parsing and the chunked inserts are blocking work; keep them off the event loop
+        report = await run_in_threadpool(_import_file, file.file)
+        await audit.record("student.import", current_user.id, **{k: report[k] for k in ("rows", "created", "duplicates", "failed")})
+        return report
+    # The upload is closed once the response is sent, so the job reads its own copy
+    spooled = tempfile.NamedTemporaryFile(prefix="student-import-", suffix=".csv", delete=False)
+    await run_in_threadpool(_spool, file.file, spooled)
+    job = jobs.registry.create("student_import", owner=current_user.public_id)
+    background_tasks.add_task(_run_import_job, job, spooled.name)
+    await audit.record("student.import", current_user.id, job_id=job.id)
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content={"job_id": job.id, "status": job.status})
+
+@router.get("/import-jobs/{job_id}")
+async def get_import_job(job_id: str, current_user: auth.Principal = Depends(auth.require_teacher)):
+    job = jobs.registry.get(job_id)
+    # Other users' jobs look exactly like unknown ones
+    if not job or job.kind != "student_import" or job.owner != current_user.public_id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Import job not found")
+    return job.to_dict()
+
+@router.put("/{public_id}/face-encoding")
+async def set_face_encoding(public_id: str, encoding: List[float] = Body(..., embed=True), current_user: models.User = Depends(auth.require_teacher), db: AsyncSession = Depends(database.get_db)):
+    if len(encoding) != face_index.gallery.dim:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Face encoding must have {face_index.gallery.dim} values")
+    u = (await db.execute(select(models.User).where(models.User.public_id == public_id))).scalar_one_or_none()
+    if not u:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    face_index.store_encoding(u, encoding)
+    await db.commit()
+    # Keep the in-process gallery in step without reloading it
+    if face_index.gallery.loaded:
+        face_index.gallery.upsert(u.id, u.public_id, encoding)
+    await audit.record("student.face_encoding_set", current_user.id, student=public_id)
+    return {"ok": True}
+
+@router.delete("/{public_id}/face-encoding")
+async def clear_face_encoding(public_id: str, current_user: models.User = Depends(auth.require_teacher), db: AsyncSession = Depends(database.get_db)):
+    u = (await db.execute(select(models.User).where(models.User.public_id == public_id))).scalar_one_or_none()
+    if not u:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    face_index.store_encoding(u, None)
+    await db.commit()
+    face_index.gallery.remove(u.id)
+    await audit.record("student.face_encoding_cleared", current_user.id, student=public_id)
+    return {"ok": True}
+
+@router.put("/{public_id}/profile-image")
+async def set_profile_image(public_id: str, file: UploadFile = File(...), current_user: models.User = Depends(auth.get_current_user), db: AsyncSession = Depends(database.get_db)):
+    # Students may only change their own picture
+    if current_user.public_id != public_id and current_user.role not in ["teacher", "admin"]:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not enough permissions")
+    u = (await db.execute(select(models.User).where(models.User.public_id == public_id))).scalar_one_or_none()
+    if not u:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    stored = await images.ingest(file)
+    u.profile_image_url = stored["url"]
+    await db.commit()
+    await audit.record("student.profile_image_set", current_user.id, student=public_id, sha256=stored["sha256"])
+    return images.signed(stored)
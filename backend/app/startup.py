@@ -0,0 +1,146 @@
+"""Startup phases run once per worker by the application lifespan.
+
+Each phase is timed; the breakdown is logged and exported as
+``edutrack_startup_phase_seconds`` so slow cold starts are visible.
+"""
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+import asyncio
+import hashlib
+import logging
+import os
+import time
+
+from sqlalchemy import delete, select, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from . import auth, database, face_index, metrics, migrations, models
+
+logger = logging.getLogger(__name__)
+
+# "false" when the schema is managed by migrations outside the app; startup then only checks it
+SCHEMA_AUTO_CREATE = os.getenv("SCHEMA_AUTO_CREATE", "true").lower() == "true"
+DB_POOL_PREFILL = int(os.getenv("DB_POOL_PREFILL", str(database.POOL_SETTINGS["pool_size"])))
+PRELOAD_FACE_GALLERY = os.getenv("PRELOAD_FACE_GALLERY", "true").lower() == "true"
+AUTH_PRELOAD_USERS = int(os.getenv("AUTH_PRELOAD_USERS", "1000"))
+
+startup_phase_seconds = metrics.Gauge("edutrack_startup_phase_seconds", "Duration of each startup phase of this worker", ("phase",))
+
+
+# Bumped when fingerprints may have been recorded for a schema that did not match,
+# so those databases are checked once more
+_FINGERPRINT_FORMAT = "2"
+
+
+def schema_fingerprint() -> str:
+    """Stable hash of every table, column and index declared in models.py"""
+    parts = [_FINGERPRINT_FORMAT]
+    for table in models.Base.metadata.sorted_tables:
+        parts.append(table.name)
+        parts.extend(f"{c.name}:{c.type}:{c.nullable}:{c.primary_key}" for c in table.columns)
+        parts.extend(
+            f"{i.name}:{','.join(c.name for c in i.columns)}:{i.unique}" for i in sorted(table.indexes, key=lambda i: i.name)
+        )
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()[:16]
+
+
+def _recorded_version(conn) -> Optional[str]:
+    try:
+        return conn.execute(select(models.SchemaVersion.version)).scalar_one_or_none()
+    except SQLAlchemyError:
+        # Probing a missing table aborts the transaction on some databases
+        conn.rollback()
+        return None
+
+
+def ensure_schema(conn) -> bool:
+    """Upgrade the schema when the recorded fingerprint differs; returns True if it was checked.
+
+    The new fingerprint is only recorded once reflection shows every table,
+    column and index of models.py exists; otherwise RuntimeError is raised.
+    """
+    version = schema_fingerprint()
+    if _recorded_version(conn) == version:
+        return False
+    try:
+        migrations.upgrade(conn)
+        conn.commit()
+    except SQLAlchemyError as e:
+        # Usually another worker starting at the same time applied it first
+        conn.rollback()
+        logger.warning(f"Schema upgrade failed, re-checking: {e}")
+    left = migrations.missing(conn)
+    if left:
+        raise RuntimeError(f"Database schema is missing {migrations.describe(left)}; run python -m app.cli migrate-schema")
+    conn.execute(delete(models.SchemaVersion))
+    conn.execute(models.SchemaVersion.__table__.insert().values(version=version))
+    conn.commit()
+    return True
+
+
+def check_schema(conn) -> None:
+    """Raise RuntimeError unless the database has everything models.py declares"""
+    if _recorded_version(conn) == schema_fingerprint():
+        return
+    left = migrations.missing(conn)
+    if left:
+        raise RuntimeError(f"Database schema is missing {migrations.describe(left)}; run python -m app.cli migrate-schema")
+
+
+async def prefill_pool(size: int) -> int:
+    """Open up to ``size`` connections at once and return them to the pool idle"""
+    size = min(size, database.POOL_SETTINGS["pool_size"])
+    opened = await asyncio.gather(*(database.async_engine.connect().start() for _ in range(size)), return_exceptions=True)
+    ready = 0
+    for conn in opened:
+        if isinstance(conn, BaseException):
+            logger.warning(f"Could not prefill a pooled connection: {conn}")
+            continue
+        try:
+            await conn.execute(text("SELECT 1"))
+            ready += 1
+        finally:
+            await conn.close()
+    return ready
+
+
+@asynccontextmanager
+async def _phase(timings: Dict[str, float], name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = round(time.perf_counter() - start, 4)
+        startup_phase_seconds.set(timings[name], phase=name)
+
+
+async def warm_up() -> Dict[str, float]:
+    """Run every startup phase; returns seconds per phase"""
+    timings: Dict[str, float] = {}
+    started = time.perf_counter()
+    async with _phase(timings, "schema"):
+        async with database.async_engine.connect() as conn:
+            if SCHEMA_AUTO_CREATE:
+                checked = await conn.run_sync(ensure_schema)
+                logger.info("Schema checked and up to date" if checked else "Schema version matches, skipping the check")
+            else:
+                # Refuse to serve against a database the queries would fail on
+                await conn.run_sync(check_schema)
+    if DB_POOL_PREFILL > 0:
+        async with _phase(timings, "pool_prefill"):
+            ready = await prefill_pool(DB_POOL_PREFILL)
+            logger.info(f"Prefilled {ready} pooled connections")
+    if PRELOAD_FACE_GALLERY:
+        async with _phase(timings, "face_gallery"):
+            async with database.AsyncSessionLocal() as db:
+                gallery = await db.run_sync(face_index.get_gallery)
+            logger.info(f"Face gallery ready with {len(gallery)} encodings")
+    if AUTH_PRELOAD_USERS > 0:
+        async with _phase(timings, "principals"):
+            async with database.AsyncSessionLocal() as db:
+                loaded = await auth.preload_principals(db, AUTH_PRELOAD_USERS)
+            logger.info(f"Preloaded {loaded} user principals")
+    timings["total"] = round(time.perf_counter() - started, 4)
+    startup_phase_seconds.set(timings["total"], phase="total")
+    logger.info("Startup timings: " + ", ".join(f"{k}={v * 1000:.0f}ms" for k, v in timings.items()))
+    return timings
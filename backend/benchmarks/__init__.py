@@ -0,0 +1,15 @@
+"""Synthetic data generator (seed.py) and in-process HTTP load driver (run.py)"""
+import os
+
+# Offline defaults, applied before the app modules read their settings
+DEFAULT_DATABASE_URL = "sqlite:///./bench.db"
+BENCH_PASSWORD = "bench-password"
+TEACHER_EMAIL = "teacher@bench.local"
+
+
+def configure_environment(database_url=None) -> None:
+    os.environ["DATABASE_URL"] = database_url or os.environ.get("BENCH_DATABASE_URL", DEFAULT_DATABASE_URL)
+    os.environ.pop("ASYNC_DATABASE_URL", None)
+    # The driver sends everything from one client address
+    for name in ("RATE_LIMIT_REQUESTS", "RATE_LIMIT_USER_REQUESTS", "RATE_LIMIT_LOGIN_REQUESTS"):
+        os.environ.setdefault(name, "1000000000")
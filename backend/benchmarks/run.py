@@ -0,0 +1,224 @@
+"""Drive the API in-process and report throughput and latency percentiles.
+
+    python -m benchmarks.seed --students 2000
+    python -m benchmarks.run [--scenarios stats,export] [--concurrency 20] [--duration 10] [--json out.json]
+
+Requests go through httpx's ASGI transport straight into the application, so
+no server or network is involved and results depend only on the code and the
+database. Each scenario runs on its own for --duration seconds (or --requests
+requests) with --concurrency requests in flight.
+"""
+from dataclasses import asdict, dataclass
+from typing import Awaitable, Callable, Dict, List, Optional
+import argparse
+import asyncio
+import itertools
+import json
+import platform
+import subprocess
+import sys
+import time
+import uuid
+
+from . import BENCH_PASSWORD, TEACHER_EMAIL, configure_environment
+
+
+@dataclass
+class Context:
+    teacher: Dict[str, str]
+    students: List[Dict[str, str]]
+    emails: List[str]
+    class_codes: List[str]
+    run_id: str
+
+
+@dataclass
+class Result:
+    scenario: str
+    requests: int
+    errors: int
+    seconds: float
+    rps: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    max_ms: float
+
+
+def _student(ctx: Context, i: int) -> Dict[str, str]:
+    return ctx.students[i % len(ctx.students)]
+
+
+def _upload(ctx: Context, i: int, rows: int = 200):
+    lines = ["name,email,class_code"] + [
+        f"Bench {i}-{k},bench-{ctx.run_id}-{i}-{k}@bench.local,{ctx.class_codes[k % len(ctx.class_codes)]}" for k in range(rows)
+    ]
+    return {"file": ("students.csv", ("\n".join(lines) + "\n").encode(), "text/csv")}
+
+
+Scenario = Callable[..., Awaitable]
+
+SCENARIOS: Dict[str, Scenario] = {
+    "login": lambda c, ctx, i: c.post("/api/v1/auth/login", data={
+        "username": ctx.emails[i % len(ctx.emails)], "password": BENCH_PASSWORD, "role": "student"}),
+    "me": lambda c, ctx, i: c.get("/api/v1/auth/me", headers=_student(ctx, i)),
+    "stats": lambda c, ctx, i: c.get("/api/v1/attendance/stats", headers=_student(ctx, i)),
+    "stats_range": lambda c, ctx, i: c.get("/api/v1/attendance/stats", params={"date_from": "2000-01-01"}, headers=_student(ctx, i)),
+    "records": lambda c, ctx, i: c.get("/api/v1/attendance/records", headers=_student(ctx, i)),
+    "notifications": lambda c, ctx, i: c.get("/api/v1/notifications/", headers=_student(ctx, i)),
+    "appeals": lambda c, ctx, i: c.get("/api/v1/appeals/", headers=ctx.teacher),
+    "trends": lambda c, ctx, i: c.get("/api/v1/reports/trends", params={
+        "scope": "class", "class_code": ctx.class_codes[i % len(ctx.class_codes)]}, headers=ctx.teacher),
+    "defaulters": lambda c, ctx, i: c.get("/api/v1/reports/defaulters", headers=ctx.teacher),
+    "export": lambda c, ctx, i: c.get("/api/v1/attendance/export", params={
+        "scope": "class", "class_code": ctx.class_codes[i % len(ctx.class_codes)]}, headers=ctx.teacher),
+    "bulk_upload": lambda c, ctx, i: c.post("/api/v1/students/bulk-upload", files=_upload(ctx, i), headers=ctx.teacher),
+}
+DEFAULT_SCENARIOS = ["login", "stats", "stats_range", "records", "notifications", "appeals", "trends", "defaulters", "export", "bulk_upload"]
+
+
+def load_context() -> Context:
+    from sqlalchemy import select
+
+    from app import auth, database, models
+
+    with database.SessionLocal() as db:
+        teacher = db.execute(select(models.User.public_id).where(models.User.email == TEACHER_EMAIL)).scalar_one_or_none()
+        students = db.execute(
+            select(models.User.public_id, models.User.email)
+            .where(models.User.role == "student", models.User.email.like("student%@bench.local"))
+            .order_by(models.User.id).limit(500)
+        ).all()
+        class_codes = sorted(c for c in db.execute(select(models.User.class_code).distinct()).scalars() if c)
+    if teacher is None or not students:
+        raise SystemExit("No benchmark data found; run python -m benchmarks.seed first")
+
+    def header(public_id):
+        return {"Authorization": "Bearer " + auth.create_tokens({"sub": public_id})["access_token"]}
+
+    return Context(
+        teacher=header(teacher),
+        students=[header(s.public_id) for s in students],
+        emails=[s.email for s in students],
+        class_codes=class_codes,
+        run_id=uuid.uuid4().hex[:8],
+    )
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+async def run_scenario(client, name: str, ctx: Context, concurrency: int, duration: float,
+                       requests: Optional[int], warmup: int) -> Result:
+    fn = SCENARIOS[name]
+    for i in range(warmup):
+        await fn(client, ctx, i)
+    latencies: List[float] = []
+    errors = 0
+    counter = itertools.count(warmup)
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal errors
+        while True:
+            i = next(counter)
+            if requests is not None and i - warmup >= requests:
+                return
+            if requests is None and time.perf_counter() >= deadline:
+                return
+            start = time.perf_counter()
+            try:
+                response = await fn(client, ctx, i)
+                failed = response.status_code >= 400
+            except Exception:
+                failed = True
+            latencies.append(time.perf_counter() - start)
+            errors += failed
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    ms = [v * 1000.0 for v in latencies]
+    return Result(
+        scenario=name,
+        requests=len(latencies),
+        errors=errors,
+        seconds=round(elapsed, 2),
+        rps=round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        p50_ms=round(_percentile(ms, 50), 1),
+        p95_ms=round(_percentile(ms, 95), 1),
+        p99_ms=round(_percentile(ms, 99), 1),
+        max_ms=round(ms[-1], 1) if ms else 0.0,
+    )
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def run(args) -> dict:
+    import httpx
+    from app.database import SQLALCHEMY_DATABASE_URL
+    from app.main import create_app
+
+    ctx = load_context()
+    app = create_app()
+    results = []
+    transport = httpx.ASGITransport(app=app, client=("127.0.0.1", 50000))
+    # ASGITransport does not send lifespan events; run the startup phases explicitly
+    async with app.router.lifespan_context(app), \
+            httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for name in args.scenarios:
+            result = await run_scenario(client, name, ctx, args.concurrency, args.duration, args.requests, args.warmup)
+            results.append(result)
+            print(_format_row(result), flush=True)
+    return {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "database": SQLALCHEMY_DATABASE_URL.split("://", 1)[0],
+        "concurrency": args.concurrency,
+        "results": [asdict(r) for r in results],
+    }
+
+
+HEADER = f"{'scenario':<14}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+
+
+def _format_row(r: Result) -> str:
+    return f"{r.scenario:<14}{r.requests:>9}{r.errors:>8}{r.rps:>9.1f}{r.p50_ms:>9.1f}{r.p95_ms:>9.1f}{r.p99_ms:>9.1f}{r.max_ms:>9.1f}"
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description="In-process API load test")
+    parser.add_argument("--scenarios", default=",".join(DEFAULT_SCENARIOS), help=f"Comma-separated; available: {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per scenario")
+    parser.add_argument("--requests", type=int, default=None, help="Fixed request count per scenario instead of --duration")
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--json", default=None, help="Also write the results to this file")
+    parser.add_argument("--database-url", default=None, help="Defaults to BENCH_DATABASE_URL or sqlite:///./bench.db")
+    args = parser.parse_args(argv)
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in args.scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    configure_environment(args.database_url)
+    print(HEADER)
+    report = asyncio.run(run(args))
+    print(f"commit={report['commit']} database={report['database']} concurrency={report['concurrency']}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())